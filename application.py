@@ -1,18 +1,26 @@
 from flask import Flask
-from flask import render_template, request
+from flask import render_template, request, jsonify, Response
 import json
 import os
+import asyncio
+from functools import partial
+from html import escape
+import logging
 import config
 import pickle
-from backend.index import GensimIndex, ElasticSearchIndex
-from backend.tokenizer import SciSpacyTokenizer
+# Only light modules are imported here; the index and its dependencies
+# are loaded by IndexLoader in the background
+from backend.settings import CONFIG
+from backend.metrics import REGISTRY, CONTENT_TYPE, span
+from backend.loader import IndexLoader
+from backend.breaker import CircuitOpenError
 
 DEBUG=True
 
 def format_result(doc, score):
     title = doc.title
     authors = ""
-    for author in doc.metadata["authors"]:
+    for author in doc.metadata.get("authors", []):
         authors += author + ", "
     authors = authors[:-2]
     if authors == "":
@@ -21,8 +29,34 @@ def format_result(doc, score):
         url = doc.metadata["url"]
     else:
         url = None
+    # Highlighted fragments are HTML-escaped by Elastic Search
+    snippet = doc.content.get("highlight")
+    if snippet is None and "passage" in doc.content:
+        # Passages that only matched by title or concepts have no highlight
+        snippet = escape(doc.content["passage"])
 
-    return {"title": title, "authors": authors, "url": url}
+    return {"title": title, "authors": authors, "url": url, "snippet": snippet}
+
+def clamp_paging(page, size):
+    """
+    Keep page and size in range. Pages are capped so that no result past the
+    first MAX_RESULT_WINDOW is requested, which Elastic Search refuses and
+    which Gensim indices would have to rank.
+    Returns:
+        (page, size, last page)
+    """
+    size = min(max(size, 1), CONFIG["MAX_PAGE_SIZE"])
+    last_page = max(CONFIG["MAX_RESULT_WINDOW"] // size, 1)
+    page = min(max(page, 1), last_page)
+    return page, size, last_page
+
+def format_results(results):
+    # Iterating LazyResults also hydrates them, which may read from disk or Elastic Search
+    formated_result = []
+    for doc, score in results:
+        if doc.title != "":
+            formated_result.append(format_result(doc, score))
+    return formated_result
 
 def create_app():
 
@@ -32,12 +66,22 @@ def create_app():
     # (only then will the CSS work)
     app = Flask(__name__, template_folder='frontend/templates', static_folder='frontend/static')
 
-    try:
-        print("Loading index...")
-        indexer = ElasticSearchIndex.load_latest()
-    except FileNotFoundError:
-        indexer = ElasticSearchIndex()
-        indexer.init()
+    # Write query stage timings to stderr as JSON lines
+    if CONFIG["TRACE_LOGGING"]:
+        trace_logger = logging.getLogger("covidqa.trace")
+        trace_logger.setLevel(logging.INFO)
+        # The logger is global, so an app created again must not add another handler
+        if not trace_logger.handlers:
+            trace_logger.addHandler(logging.StreamHandler())
+        trace_logger.propagate = False
+
+    # Backend is chosen by "INDEX" in config.json
+    loader = IndexLoader(CONFIG["INDEX"], CONFIG["WARMUP_RETRY_INTERVAL"]).start()
+    app.loader = loader
+
+    def not_ready():
+        return ("The search index is still loading, please try again shortly.", 503,
+            {"Retry-After": str(int(CONFIG["WARMUP_RETRY_INTERVAL"]))})
 
     @app.route('/')
     @app.route('/index')
@@ -54,21 +98,90 @@ def create_app():
     def advanced():
         return render_template('advanced.html')
 
-    # Actually run search
+    # Actually run search. The view only waits on the index's event loop,
+    # which multiplexes the ES and MetaMap calls of every request thread
     @app.route('/query', methods=['GET'])
-    def query():
+    async def query():
         data = request.args
         query = data["query"]
-        results = indexer.query(query)
-
-        formated_result = []
-        for result in results:
-            doc = result[0]
-            score = result[1]
-            if doc.title != "":
-                formated_result.append(format_result(doc, score))
- 
-        return render_template("result.html", orig_query=query, results=formated_result)
+        page, size, last_page = clamp_paging(data.get("page", 1, type=int),
+            data.get("size", CONFIG["PAGE_SIZE"], type=int))
+        loop = asyncio.get_running_loop()
+        indexer = loader.get(timeout=0)
+        if indexer is None:
+            indexer = await loop.run_in_executor(
+                None, partial(loader.get, timeout=CONFIG["READY_WAIT"]))
+        if indexer is None:
+            return not_ready()
+        with span("query", index=CONFIG["INDEX"], page=page, size=size):
+            try:
+                results = await indexer.aquery(query, page=page, size=size)
+                with span("format"):
+                    formated_result = await loop.run_in_executor(None, format_results, results)
+            except CircuitOpenError:
+                return ("Search is temporarily unavailable, please try again shortly.", 503,
+                    {"Retry-After": str(int(CONFIG["ES_BREAKER_RESET"]))})
+
+            with span("render"):
+                return render_template("result.html", orig_query=query, results=formated_result,
+                    page=page, size=size, has_next=len(results) >= size and page < last_page)
+
+    # Answer many queries in one request, e.g. for evaluation runs
+    @app.route('/query_batch', methods=['POST'])
+    def query_batch():
+        data = request.get_json(silent=True) or {}
+        queries = data.get("queries")
+        if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+            return jsonify({"error": "queries must be a list of strings"}), 400
+        if len(queries) > CONFIG["MAX_BATCH_QUERIES"]:
+            return jsonify({"error": "at most {} queries per batch".format(
+                CONFIG["MAX_BATCH_QUERIES"])}), 400
+        try:
+            page, size, _ = clamp_paging(int(data.get("page", 1)),
+                int(data.get("size", CONFIG["PAGE_SIZE"])))
+        except (TypeError, ValueError):
+            return jsonify({"error": "page and size must be integers"}), 400
+        indexer = loader.get(timeout=CONFIG["READY_WAIT"])
+        if indexer is None:
+            return not_ready()
+        with span("query_batch", index=CONFIG["INDEX"], queries=len(queries), page=page, size=size):
+            try:
+                batch = indexer.query_many(queries, page=page, size=size)
+                with span("format"):
+                    formated_batch = []
+                    for results in batch:
+                        formated_result = []
+                        for doc, score in results:
+                            if doc.title != "":
+                                formated = format_result(doc, score)
+                                formated["score"] = float(score)
+                                formated_result.append(formated)
+                        formated_batch.append(formated_result)
+            except CircuitOpenError:
+                return ("Search is temporarily unavailable, please try again shortly.", 503,
+                    {"Retry-After": str(int(CONFIG["ES_BREAKER_RESET"]))})
+        return jsonify({"results": formated_batch})
+
+    @app.route('/stats/cache', methods=['GET'])
+    def cache_stats():
+        cache = getattr(loader.get(timeout=0), "cache", None)
+        if cache is None:
+            return jsonify({})
+        return jsonify(cache.stats())
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+    # Liveness: the process is up and serving requests
+    @app.route('/healthz', methods=['GET'])
+    def healthz():
+        return jsonify({"status": "ok"})
+
+    # Readiness: the index is loaded and warmed up, so queries are answered quickly
+    @app.route('/ready', methods=['GET'])
+    def ready():
+        return jsonify(loader.status()), 200 if loader.ready else 503
 
     return app
 
@@ -1,3 +1,18 @@
-from .document import Document
-from .index import GensimIndex, ElasticSearchIndex
-from .tokenizer import SciSpacyTokenizer
\ No newline at end of file
+import importlib
+
+# Submodules are imported on first use, so that e.g. reading the configuration
+# or metrics does not pull in gensim, spaCy and MetaMap
+_EXPORTS = {
+    "Document": ".document",
+    "GensimIndex": ".index",
+    "ElasticSearchIndex": ".index",
+    "HybridIndex": ".index",
+    "SciSpacyTokenizer": ".tokenizer"
+}
+
+__all__ = list(_EXPORTS)
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    return getattr(importlib.import_module(_EXPORTS[name], __name__), name)
@@ -0,0 +1,168 @@
+import os
+import time
+import argparse
+import multiprocessing as mp
+from .ner import _init_worker, _extract_concepts
+from .utils import ESHandler, CONFIG
+
+def _annotate(item):
+    """
+    Run MetaMap over the chunks of one document.
+    Args:
+        item (tuple[str, list[str]]) : document id and its text chunks
+    Returns:
+        document id, sorted list of unique CUIs, list of concepts as lists
+    """
+    doc_id, chunks = item
+    if not chunks:
+        return doc_id, [], []
+    ids = [str(i) for i in range(len(chunks))]
+    concepts = _extract_concepts(chunks, ids)
+    cuis = sorted(set(c.cui for c in concepts))
+    return doc_id, cuis, [list(c) for c in concepts]
+
+def split_chunks(text, max_length):
+    """
+    Split text into chunks of at most max_length characters along paragraph
+    and then word boundaries. MetaMap only accepts ASCII, one line per input,
+    so other characters and line breaks are dropped.
+    """
+    chunks = []
+    current = ""
+    for paragraph in text.split("\n"):
+        paragraph = paragraph.encode("ascii", "ignore").decode("ascii")
+        paragraph = " ".join(paragraph.replace("|", " ").split())
+        while len(paragraph) > max_length:
+            cut = paragraph.rfind(" ", 0, max_length)
+            if cut <= 0:
+                cut = max_length
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(paragraph[:cut])
+            paragraph = paragraph[cut:].strip()
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) + 1 > max_length:
+            chunks.append(current)
+            current = ""
+        current = current + " " + paragraph if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+class MetamapAnnotator():
+    """
+    Offline annotator that fills content.concepts and annotations["metamap"]
+    for every document in Elastic Search.
+
+    Ids of the documents to annotate are collected first, and the documents
+    are then fetched by id one batch at a time, split into chunks and run
+    through MetaMap in parallel worker processes. Unlike a scroll, which
+    expires while MetaMap works through a batch, this holds no search
+    context open on ES. Results are written back with partial bulk
+    updates, and the passages of annotated documents are indexed again so
+    that they carry the concepts too. Ids of annotated documents are appended to a checkpoint file so an
+    interrupted run resumes where it stopped.
+    """
+    CHUNK_LENGTH = 2000
+    CHECKPOINT_PATH = CONFIG["SAVE_DIR"] + "/annotator/metamap.checkpoint"
+
+    def __init__(self, workers=None, batch_size=256, checkpoint_path=None):
+        self.workers = workers or mp.cpu_count()
+        self.batch_size = batch_size
+        self.checkpoint_path = checkpoint_path or MetamapAnnotator.CHECKPOINT_PATH
+        self.es_handler = ESHandler()
+
+        dir_path = os.path.dirname(self.checkpoint_path)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return set()
+        with open(self.checkpoint_path, "r") as fp:
+            return set(line.strip() for line in fp if line.strip())
+
+    def _items(self, ids):
+        """
+        Fetch documents of ids and split them into chunks for MetaMap
+        Returns:
+            documents by id, list of (document id, chunks)
+        """
+        documents = {}
+        items = []
+        for doc in self.es_handler.get_many(ids, fields=["title", "metadata", "content"],
+                maintenance=True):
+            # Deleted since its id was collected
+            if doc is None:
+                continue
+            documents[doc.id] = doc
+            text = doc.title + "\n" + doc._content_to_str()
+            items.append((doc.id, split_chunks(text, MetamapAnnotator.CHUNK_LENGTH)))
+        return documents, items
+
+    def _write(self, results, documents, checkpoint):
+        updates = []
+        for doc_id, cuis, concepts in results:
+            fields = {
+                "content": {"concepts": cuis},
+                "annotations": {"metamap": concepts}
+            }
+            updates.append((doc_id, fields))
+        stats = self.es_handler.update_many(updates)
+
+        failed = set()
+        for error in stats["errors"]:
+            print("Failed to update document:", error)
+            failed.add(error.get("update", {}).get("_id"))
+
+        annotated = []
+        for doc_id, cuis, _ in results:
+            if doc_id not in failed:
+                documents[doc_id].content["concepts"] = cuis
+                annotated.append(documents[doc_id])
+        stats = self.es_handler.insert_passages(annotated)
+        for error in stats["errors"]:
+            print("Failed to insert passage:", error)
+            # Annotate the document again next time so its passages are retried
+            failed.add(error.get("index", {}).get("_id", "").rsplit("-", 1)[0])
+
+        for doc_id, _, _ in results:
+            if doc_id not in failed:
+                checkpoint.write(doc_id + "\n")
+        checkpoint.flush()
+        return len(results) - len(failed)
+
+    def run(self):
+        done = self._load_checkpoint()
+        print("Annotating documents, {} already done...".format(len(done)))
+        ids = [doc_id for doc_id in self.es_handler.get_all_ids() if doc_id not in done]
+        total = 0
+        start = time.time()
+
+        with mp.Pool(
+                processes=self.workers,
+                initializer=_init_worker,
+                initargs=(os.path.abspath(CONFIG["MM_PATH"]),)) as pool, \
+                open(self.checkpoint_path, "a") as checkpoint:
+            # Feed the pool one batch at a time so memory stays bounded
+            for offset in range(0, len(ids), self.batch_size):
+                documents, batch = self._items(ids[offset:offset + self.batch_size])
+                results = list(pool.imap_unordered(_annotate, batch))
+                total += self._write(results, documents, checkpoint)
+                elapsed = time.time() - start
+                print("Annotated {} documents ({:.1f} docs/sec)".format(
+                    total, total / elapsed))
+
+        print("Finished!")
+        return total
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Annotate documents with MetaMap")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args()
+
+    annotator = MetamapAnnotator(workers=args.workers, batch_size=args.batch_size)
+    annotator.run()
@@ -0,0 +1,107 @@
+import time
+import threading
+from .metrics import REGISTRY
+
+BREAKER_OPENED = REGISTRY.counter(
+    "covidqa_breaker_opened",
+    "Times a circuit breaker opened after repeated failures",
+    labels=("name",)
+)
+BREAKER_REJECTED = REGISTRY.counter(
+    "covidqa_breaker_rejected",
+    "Calls failed fast because a circuit breaker was open",
+    labels=("name",)
+)
+
+class CircuitOpenError(Exception):
+    """ Raised instead of calling a service whose circuit breaker is open """
+
+class CircuitBreaker():
+    """
+    Stops calls to an unhealthy service so callers fail fast instead of
+    waiting for timeouts.
+
+    After failure_threshold consecutive failures the breaker opens and
+    rejects every call for reset_timeout seconds. It then lets calls through
+    again (half-open): the first success closes it, the first failure opens
+    it for another reset_timeout.
+
+    Attributes:
+        name (str) : name used in metrics and logs
+        failure_threshold (int) : consecutive failures that open the breaker
+        reset_timeout (float) : seconds the breaker stays open
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=10.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = CircuitBreaker.CLOSED
+        self._failures = 0
+        self._opened = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == CircuitBreaker.OPEN \
+                    and time.monotonic() - self._opened >= self.reset_timeout:
+                self._state = CircuitBreaker.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """ Return True if a call may be made now """
+        if self.state != CircuitBreaker.OPEN:
+            return True
+        BREAKER_REJECTED.inc(name=self.name)
+        return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = CircuitBreaker.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == CircuitBreaker.HALF_OPEN \
+                    or self._failures >= self.failure_threshold:
+                if self._state != CircuitBreaker.OPEN:
+                    print("Circuit breaker {} opened after {} failures".format(
+                        self.name, self._failures))
+                    BREAKER_OPENED.inc(name=self.name)
+                self._state = CircuitBreaker.OPEN
+                self._opened = time.monotonic()
+
+    def call(self, fn, *args, is_failure=None, **kwargs):
+        """
+        Call fn unless the breaker is open.
+        Args:
+            is_failure (callable) : takes an exception raised by fn and returns
+                whether it counts as a failure of the service. Every exception
+                counts if None.
+        Raises:
+            CircuitOpenError if the breaker is open
+        """
+        if not self.allow():
+            raise CircuitOpenError("{} is unavailable".format(self.name))
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as err:
+            if is_failure is None or is_failure(err):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "state": self.state,
+            "failures": self._failures
+        }
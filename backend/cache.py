@@ -0,0 +1,153 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+def normalize_query(query, **options):
+    """
+    Build a cache key from a query and the options it was run with.
+    Whitespace is collapsed but case is kept, since query_string operators
+    such as OR and AND are case sensitive.
+    """
+    return (" ".join(query.split()), tuple(sorted(options.items())))
+
+def approx_size(obj):
+    """ Rough number of bytes held by obj and everything it references """
+    if isinstance(obj, (str, bytes)):
+        return sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(approx_size(key) + approx_size(value)
+            for key, value in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(approx_size(item) for item in obj)
+    if hasattr(obj, "to_dict"):
+        return approx_size(obj.to_dict())
+    return sys.getsizeof(obj)
+
+class QueryCache():
+    """
+    Thread-safe LRU cache of query results with a TTL and a memory cap.
+
+    Entries are dropped when the generation reported by generation_fn changes,
+    e.g. after the crawler writes to the corpus. The generation
+    is checked at most once every check_interval seconds.
+
+    Expired entries are kept for another stale_ttl seconds, so get_stale can
+    still answer with them while the backend is unavailable.
+
+    Attributes:
+        max_entries (int) : max number of cached queries
+        ttl (float) : seconds an entry stays valid
+        max_bytes (int) : approximate memory cap for all entries
+        stale_ttl (float) : seconds an expired entry is kept for get_stale
+    """
+    def __init__(self, max_entries=1024, ttl=3600, max_bytes=256 * 1024 * 1024,
+            generation_fn=None, check_interval=1.0, stale_ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stale_ttl = stale_ttl
+        self.generation_fn = generation_fn
+        self.check_interval = check_interval
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._generation = generation_fn() if generation_fn else None
+        self._checked = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale_hits = 0
+
+    def _check_generation(self, now):
+        if self.generation_fn is None or now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        generation = self.generation_fn()
+        if generation != self._generation:
+            self._generation = generation
+            self._entries.clear()
+            self._bytes = 0
+            self.invalidations += 1
+
+    def _pop(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        """ Return cached value for key or None on a miss """
+        now = time.monotonic()
+        with self._lock:
+            self._check_generation(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires, _ = entry
+            if expires < now:
+                if expires + self.stale_ttl < now:
+                    self._pop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_stale(self, key):
+        """ Return value for key even if it expired less than stale_ttl ago, or None """
+        now = time.monotonic()
+        with self._lock:
+            self._check_generation(now)
+            entry = self._entries.get(key)
+            if entry is None or entry[1] + self.stale_ttl < now:
+                return None
+            self.stale_hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None, ttl=None):
+        """
+        Store value for key, evicting least recently used entries to stay under the caps.
+        Args:
+            ttl (float) : seconds this entry stays valid, the cache's ttl if None
+        """
+        if size is None:
+            size = approx_size(value)
+        if size > self.max_bytes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._check_generation(now)
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (value, now + (self.ttl if ttl is None else ttl), size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._pop(oldest)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "stale_hits": self.stale_hits,
+                "generation": self._generation
+            }
@@ -0,0 +1,295 @@
+import os
+import json
+import shutil
+import numpy as np
+
+def _normalize(rows):
+    norms = np.linalg.norm(rows, axis=1)
+    norms[norms == 0] = 1.0
+    return rows / norms[:, None]
+
+def _quantize(rows):
+    """ Symmetric per-row int8 quantization, returns int8 rows and float32 scales """
+    scales = np.abs(rows).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.round(rows / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+def _kmeans(sample, num_lists, iterations=10, seed=0):
+    """ Spherical k-means over normalized rows, returns normalized centroids """
+    rng = np.random.RandomState(seed)
+    choice = rng.choice(len(sample), num_lists, replace=False)
+    centroids = sample[choice].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        empty = ~sums.any(axis=1)
+        # Keep old centroids for lists that lost all their members
+        sums[empty] = centroids[empty]
+        centroids = _normalize(sums).astype(np.float32)
+    return centroids
+
+def _dense_rows(vectors, num_features, block_size):
+    """ Turn a stream of gensim sparse vectors into blocks of dense float32 rows """
+    block = []
+    for vec in vectors:
+        row = np.zeros(num_features, dtype=np.float32)
+        for feature, value in vec:
+            row[feature] = value
+        block.append(row)
+        if len(block) == block_size:
+            yield np.vstack(block)
+            block = []
+    if block:
+        yield np.vstack(block)
+
+class DenseVectorIndex():
+    """
+    Memory-mapped matrix of normalized document vectors with blocked top-k search.
+
+    Rows are stored as float32, or as int8 with a float32 scale per row when
+    quantize is set. With num_lists > 0 the rows are partitioned into that
+    many lists around k-means centroids (IVF) and stored list by list, so a
+    query only scores the lists of its nearest probes centroids. Rows added
+    after the build are appended to an unpartitioned tail that every query
+    scans.
+
+    Files in path:
+        meta.json : num_features, count, quantize, num_lists and tail_start
+        vectors.bin : rows in storage order
+        scales.bin : per-row scales of quantized rows
+        row_ids.bin : original row number of every stored row
+        centroids.npy, offsets.npy : IVF centroids and start of every list
+    """
+    BLOCK_SIZE = 65536
+    SAMPLE_SIZE = 100000
+
+    def __init__(self, path):
+        self.path = path
+        with open(self._file("meta.json"), "r") as fp:
+            self.meta = json.load(fp)
+        self.num_features = self.meta["num_features"]
+        self.quantize = self.meta["quantize"]
+        self.num_lists = self.meta["num_lists"]
+        self.probes = self.meta.get("probes", 8)
+        self._map()
+
+    def _file(self, name):
+        return self.path + "/" + name
+
+    def _map(self):
+        count = self.meta["count"]
+        dtype = np.int8 if self.quantize else np.float32
+        if count:
+            self.vectors = np.memmap(self._file("vectors.bin"), dtype=dtype,
+                mode="r", shape=(count, self.num_features))
+            self.row_ids = np.memmap(self._file("row_ids.bin"), dtype=np.int64,
+                mode="r", shape=(count,))
+            if self.quantize:
+                self.scales = np.memmap(self._file("scales.bin"),
+                    dtype=np.float32, mode="r", shape=(count,))
+        else:
+            self.vectors = np.zeros((0, self.num_features), dtype=dtype)
+            self.row_ids = np.zeros(0, dtype=np.int64)
+            self.scales = np.zeros(0, dtype=np.float32)
+        if self.num_lists:
+            self.centroids = np.load(self._file("centroids.npy"))
+            self.offsets = np.load(self._file("offsets.npy"))
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def _write_meta(self):
+        tmp_path = self._file("meta.json.tmp")
+        with open(tmp_path, "w") as fp:
+            json.dump(self.meta, fp)
+        os.replace(tmp_path, self._file("meta.json"))
+
+    def _append_rows(self, rows, row_ids):
+        """ Append normalized float32 rows to the storage files """
+        with open(self._file("vectors.bin"), "ab") as fp:
+            if self.quantize:
+                quantized, scales = _quantize(rows)
+                fp.write(quantized.tobytes())
+                with open(self._file("scales.bin"), "ab") as scale_fp:
+                    scale_fp.write(scales.tobytes())
+            else:
+                fp.write(rows.astype(np.float32).tobytes())
+        with open(self._file("row_ids.bin"), "ab") as fp:
+            fp.write(np.asarray(row_ids, dtype=np.int64).tobytes())
+
+    def add_documents(self, vectors):
+        """ Append gensim sparse vectors as new rows at the end of the index """
+        count = self.meta["count"]
+        for rows in _dense_rows(vectors, self.num_features, DenseVectorIndex.BLOCK_SIZE):
+            rows = _normalize(rows)
+            self._append_rows(rows, np.arange(count, count + len(rows)))
+            count += len(rows)
+        self.meta["count"] = count
+        self._write_meta()
+        self._map()
+
+    def _ranges(self, query):
+        """ Storage ranges a query has to score """
+        if not self.num_lists:
+            return [(0, len(self))]
+        scores = self.centroids @ query
+        probes = min(self.probes, self.num_lists)
+        lists = np.argpartition(-scores, probes - 1)[:probes]
+        ranges = [(self.offsets[l], self.offsets[l + 1]) for l in lists]
+        ranges.append((self.meta["tail_start"], len(self)))
+        return ranges
+
+    def _score_block(self, start, end, queries):
+        block = self.vectors[start:end].astype(np.float32)
+        scores = block @ queries.T
+        if self.quantize:
+            scores *= self.scales[start:end][:, None]
+        return scores
+
+    def topk(self, query, k=100):
+        """
+        Args:
+            query (np.ndarray) : dense query vector of num_features
+            k (int) : number of results
+        Returns:
+            list of (row number, cosine similarity), best first
+        """
+        query = _normalize(np.asarray(query, dtype=np.float32)[None, :])[0]
+        positions = []
+        scores = []
+        for range_start, range_end in self._ranges(query):
+            for start in range(range_start, range_end, DenseVectorIndex.BLOCK_SIZE):
+                end = min(start + DenseVectorIndex.BLOCK_SIZE, range_end)
+                block_scores = self._score_block(start, end, query[None, :])[:, 0]
+                if len(block_scores) > k:
+                    best = np.argpartition(-block_scores, k - 1)[:k]
+                else:
+                    best = np.arange(len(block_scores))
+                positions.append(best + start)
+                scores.append(block_scores[best])
+        if not positions:
+            return []
+
+        positions = np.concatenate(positions)
+        scores = np.concatenate(scores)
+        if len(scores) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            positions, scores = positions[best], scores[best]
+        order = np.argsort(-scores)
+        row_ids = self.row_ids[positions[order]]
+        return list(zip(row_ids.tolist(), scores[order].tolist()))
+
+    def topk_many(self, queries, k=100):
+        """
+        Top-k of many queries at once. Each storage block is scored against
+        every query with a single matrix product.
+        Args:
+            queries (np.ndarray) : query vectors, one row per query
+            k (int) : number of results per query
+        Returns:
+            list of topk results in the order of queries
+        """
+        queries = _normalize(np.asarray(queries, dtype=np.float32))
+        if self.num_lists:
+            # Every query probes its own lists, so they are scored one by one
+            return [self.topk(query, k) for query in queries]
+        if len(self) == 0 or len(queries) == 0:
+            return [[] for _ in queries]
+
+        positions = []
+        scores = []
+        for start in range(0, len(self), DenseVectorIndex.BLOCK_SIZE):
+            end = min(start + DenseVectorIndex.BLOCK_SIZE, len(self))
+            block_scores = self._score_block(start, end, queries)
+            if len(block_scores) > k:
+                best = np.argpartition(-block_scores, k - 1, axis=0)[:k]
+                block_scores = np.take_along_axis(block_scores, best, axis=0)
+            else:
+                best = np.broadcast_to(np.arange(len(block_scores))[:, None], block_scores.shape)
+            positions.append(best + start)
+            scores.append(block_scores)
+
+        # Rows are candidates, columns are queries
+        positions = np.concatenate(positions)
+        scores = np.concatenate(scores)
+        if len(scores) > k:
+            best = np.argpartition(-scores, k - 1, axis=0)[:k]
+            positions = np.take_along_axis(positions, best, axis=0)
+            scores = np.take_along_axis(scores, best, axis=0)
+        order = np.argsort(-scores, axis=0)
+        positions = np.take_along_axis(positions, order, axis=0)
+        scores = np.take_along_axis(scores, order, axis=0)
+        row_ids = self.row_ids[positions]
+        return [list(zip(row_ids[:, j].tolist(), scores[:, j].tolist()))
+            for j in range(len(queries))]
+
+    @staticmethod
+    def build(path, vectors, num_features, quantize=False, num_lists=0, probes=8):
+        """
+        Build an index at path from gensim sparse vectors, removing any existing one.
+        Args:
+            vectors (iterable[list[tuple[int, float]]]) : document vectors in row order
+            num_features (int) : dimension of the vectors
+            quantize (bool) : store rows as int8 instead of float32
+            num_lists (int) : number of IVF lists, 0 to always score every row
+            probes (int) : number of IVF lists scored per query
+        """
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+        # First pass: write normalized float32 rows in original order
+        raw_path = path + "/raw.bin"
+        count = 0
+        with open(raw_path, "wb") as fp:
+            for rows in _dense_rows(vectors, num_features, DenseVectorIndex.BLOCK_SIZE):
+                fp.write(_normalize(rows).astype(np.float32).tobytes())
+                count += len(rows)
+        if count:
+            raw = np.memmap(raw_path, dtype=np.float32, mode="r",
+                shape=(count, num_features))
+        num_lists = min(num_lists, count)
+
+        meta = {
+            "num_features": num_features,
+            "count": count,
+            "quantize": quantize,
+            "num_lists": num_lists,
+            "probes": probes,
+            "tail_start": count
+        }
+        with open(path + "/meta.json", "w") as fp:
+            json.dump(meta, fp)
+        index = DenseVectorIndex.__new__(DenseVectorIndex)
+        index.path = path
+        index.meta = meta
+        index.quantize = quantize
+        index.num_features = num_features
+
+        if num_lists:
+            rng = np.random.RandomState(0)
+            sample_size = min(count, DenseVectorIndex.SAMPLE_SIZE)
+            sample = np.sort(rng.choice(count, sample_size, replace=False))
+            centroids = _kmeans(np.asarray(raw[sample]), num_lists)
+            assignments = np.empty(count, dtype=np.int64)
+            for start in range(0, count, DenseVectorIndex.BLOCK_SIZE):
+                end = min(start + DenseVectorIndex.BLOCK_SIZE, count)
+                assignments[start:end] = np.argmax(raw[start:end] @ centroids.T, axis=1)
+            order = np.argsort(assignments, kind="stable")
+            offsets = np.searchsorted(assignments[order], np.arange(num_lists + 1))
+            np.save(path + "/centroids.npy", centroids)
+            np.save(path + "/offsets.npy", offsets)
+        else:
+            order = np.arange(count)
+
+        # Second pass: store rows list by list so every list is contiguous
+        for start in range(0, count, DenseVectorIndex.BLOCK_SIZE):
+            end = min(start + DenseVectorIndex.BLOCK_SIZE, count)
+            index._append_rows(np.asarray(raw[order[start:end]]), order[start:end])
+
+        if count:
+            del raw
+        os.remove(raw_path)
+        return DenseVectorIndex(path)
@@ -0,0 +1,140 @@
+import os
+import mmap
+import shutil
+from array import array
+try:
+    from document import Document
+except:
+    from .document import Document
+
+class DocStore():
+    """
+    Append-only local store of Document records.
+
+    Records are JSON-encoded documents written back to back into records.bin.
+    offsets.bin holds the end offset of every record as uint64, and ids.txt
+    holds one document id per line, so row i is the i-th appended document.
+    Both binary files are memory-mapped on load: reading a row only touches
+    its own bytes and nothing else is parsed.
+
+    Attributes:
+        path (str) : directory holding the store
+    """
+    RECORDS = "records.bin"
+    OFFSETS = "offsets.bin"
+    IDS = "ids.txt"
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._records = None
+        self._offsets = None
+        self._offsets_map = None
+        self.ids = []
+        self.rows = {}
+        self._load()
+
+    def _file(self, name):
+        return self.path + "/" + name
+
+    def _map(self, name):
+        file_path = self._file(name)
+        if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+            return None
+        with open(file_path, "rb") as fp:
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _map_files(self):
+        self.close()
+        self._records = self._map(DocStore.RECORDS)
+        self._offsets_map = self._map(DocStore.OFFSETS)
+        if self._offsets_map is not None:
+            self._offsets = memoryview(self._offsets_map).cast("Q")
+
+    def _load(self):
+        self._map_files()
+        ids = []
+        if os.path.exists(self._file(DocStore.IDS)):
+            with open(self._file(DocStore.IDS), "r") as fp:
+                ids = fp.read().splitlines()
+        # An append interrupted half way leaves extra records or ids, ignore them
+        count = min(len(ids), len(self._offsets) if self._offsets is not None else 0)
+        self.ids = ids[:count]
+        self.rows = {id: row for row, id in enumerate(self.ids)}
+        # Bytes of ids.txt holding the ids in use
+        self._ids_size = sum(len(id.encode("utf-8")) + 1 for id in self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, documents):
+        """ Append documents at the end of the store """
+        end = self._offsets[len(self) - 1] if len(self) else 0
+        offsets = array("Q")
+        ids = []
+        with open(self._file(DocStore.RECORDS), "r+b" if end else "wb") as fp:
+            # Drop bytes of an interrupted append before writing
+            fp.truncate(end)
+            fp.seek(end)
+            for doc in documents:
+                record = doc.to_json().encode("utf-8")
+                fp.write(record)
+                end += len(record)
+                offsets.append(end)
+                ids.append(doc.id)
+
+        with open(self._file(DocStore.OFFSETS), "r+b" if len(self) else "wb") as fp:
+            fp.truncate(len(self) * offsets.itemsize)
+            fp.seek(0, os.SEEK_END)
+            offsets.tofile(fp)
+        # Only the new ids are written, so appending in many small batches stays cheap
+        data = "".join(id + "\n" for id in ids).encode("utf-8")
+        with open(self._file(DocStore.IDS), "r+b" if len(self) else "wb") as fp:
+            fp.truncate(self._ids_size)
+            fp.seek(self._ids_size)
+            fp.write(data)
+        self._ids_size += len(data)
+
+        for id in ids:
+            self.rows[id] = len(self.ids)
+            self.ids.append(id)
+        self._map_files()
+
+    def record(self, row):
+        """ Return the raw bytes of a row as a memoryview over the mapped file """
+        start = self._offsets[row - 1] if row > 0 else 0
+        end = self._offsets[row]
+        return memoryview(self._records)[start:end]
+
+    def get_row(self, row):
+        """ Return Document stored at row """
+        return Document.from_json(self.record(row).tobytes())
+
+    def get(self, id):
+        """ Return Document with id or None if it is not stored """
+        row = self.rows.get(id)
+        if row is None:
+            return None
+        return self.get_row(row)
+
+    def get_many(self, ids):
+        return [self.get(id) for id in ids]
+
+    def close(self):
+        if self._offsets is not None:
+            self._offsets.release()
+            self._offsets = None
+        if self._offsets_map is not None:
+            self._offsets_map.close()
+            self._offsets_map = None
+        if self._records is not None:
+            self._records.close()
+            self._records = None
+
+    @staticmethod
+    def create(path):
+        """ Create an empty store at path, removing any existing one """
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        return DocStore(path)
@@ -1,4 +1,5 @@
 import json
+import marshal
 from pymetamap.Concept import ConceptMMI
 
 class Document:
@@ -11,76 +12,126 @@ class Document:
     title: str
         Title of document
     metadata : dict [str, Union[list[str], str]]
-        Dictionary containing metadata. 
+        Dictionary containing metadata.
         Ex: {"authors": ["John Smith", "Alic Smith"], "date": "2020-03-10", "doi": "10.1000/xyz123"}
     content : dict [str, str]
         Actual content of the document. Dictionary is used to categorize type of text.
         Ex: {"abstract": "...<abstract>...", "body": "...<body>...", "supplementary": "...<figure caption>..."}
-    annotations : dict[list] 
+    annotations : dict[list]
         Annotations provided by NER tools
         Ex: {"bern": [<bern tags>]}
+
+    Documents use slots instead of a __dict__. MetaMap concepts are kept in
+    their serialized form until annotations is first read, and text is built
+    once and cached until title, metadata or content is reassigned. Changing
+    metadata or content in place does not refresh the cached text.
     '''
-    def __init__(self, id, title, metadata, content):
+    __slots__ = ("id", "title", "metadata", "content",
+        "_annotations", "_decoded", "_text")
+
+    FIELDS = ("id", "title", "metadata", "content", "annotations")
+
+    def __init__(self, id, title, metadata, content, annotations=None):
         self.id = id
         self.title = title
         self.metadata = metadata
         self.content = content
-        self.annotations = {}
+        self._annotations = annotations if annotations is not None else {}
+        self._decoded = False
+        self._text = None
+
+    def __setattr__(self, name, value):
+        if name in ("title", "metadata", "content"):
+            object.__setattr__(self, "_text", None)
+        object.__setattr__(self, name, value)
+
+    @property
+    def annotations(self):
+        """ Annotations with MetaMap concepts decoded into ConceptMMI on first access """
+        if not self._decoded:
+            if "metamap" in self._annotations:
+                self._annotations["metamap"] = [ConceptMMI(*concept)
+                    for concept in self._annotations["metamap"]]
+            self._decoded = True
+        return self._annotations
+
+    @annotations.setter
+    def annotations(self, annotations):
+        self._annotations = annotations
+        self._decoded = False
 
     def _metadata_to_str(self):
         """ Return metadata dictionary to string representation """
-        text = ""
+        lines = []
         for key, value in self.metadata.items():
-            text += key + ": "
             if type(value) is list:
-               text += ",".join(value)
-            elif type(value) is str:
-                text += value
-            text += "\n"
-        return text
+                value = ",".join(value)
+            elif type(value) is not str:
+                value = ""
+            lines.append(key + ": " + value + "\n")
+        return "".join(lines)
 
     def _content_to_str(self):
         """ Return content dictionary to string representation """
-        text = ""
-        for value in self.content.values():
-            if type(value) is str:
-                text += value + "\n"
-        return text[:-1]
+        return "\n".join(value for value in self.content.values()
+            if type(value) is str)
 
     @property
     def text(self):
         """ Return raw text representation of document """
-        text = self.title + "\n" + self._metadata_to_str() \
-            + self._content_to_str()
-        return text
+        if self._text is None:
+            self._text = self.title + "\n" + self._metadata_to_str() \
+                + self._content_to_str()
+        return self._text
+
+    def _state(self):
+        # Concepts that were never decoded are still plain lists
+        return (self.id, self.title, self.metadata, self.content, self._annotations)
+
+    def __reduce__(self):
+        # Pickle through to_bytes, so documents sent between processes by
+        # multiprocessing use the compact codec
+        return (Document.from_bytes, (self.to_bytes(),))
 
     def to_json(self):
         """ Serialize Document into form of JSON string """
-        return json.dumps(self.__dict__)
+        return json.dumps(self.to_dict())
 
     def to_dict(self):
-        return self.__dict__
-    
+        return dict(zip(Document.FIELDS, self._state()))
+
+    def to_bytes(self):
+        """
+        Serialize Document into compact bytes for passing between processes.
+        This is also how Documents are pickled. The format depends on the
+        Python version, so use to_json for storage.
+        """
+        annotations = self._annotations
+        if self._decoded and "metamap" in annotations:
+            annotations = dict(annotations)
+            annotations["metamap"] = [list(c) for c in annotations["metamap"]]
+        return marshal.dumps((self.id, self.title, self.metadata, self.content, annotations))
+
+    @staticmethod
+    def from_bytes(data):
+        """ Load bytes made by to_bytes and return new instance of Document """
+        return Document(*marshal.loads(data))
+
     @staticmethod
     def from_json(json_str):
         """ Load JSON string and return new instance of Document """
-        doc = Document(None,None,None,None)
-        state = json.loads(json_str)
-        if "metamap" in state["annotations"]:
-            for i in range(len(state["annotations"]["metamap"])):
-                concept = state["annotations"]["metamap"][i]
-                state["annotations"]["metamap"][i] = ConceptMMI(*concept)
-
-        doc.__dict__ = state
-        return doc
+        return Document.from_dict(json.loads(json_str))
 
     @staticmethod
     def from_dict(state):
-        """ Load Python dict and return new instance of Document """
-        doc = Document(None,None,None,None)
-        if "metamap" in state["annotations"]:
-            for i in range(len(state["annotations"]["metamap"])):
-                concept = state["annotations"]["metamap"][i]
-                state["annotations"]["metamap"][i] = ConceptMMI(*concept)
-        doc.__dict__ = state
-        return doc
+        """
+        Load Python dict and return new instance of Document.
+        Missing fields, e.g. from a projected ES _source, get empty defaults.
+        """
+        return Document(
+            state.get("id"),
+            state.get("title", ""),
+            state.get("metadata", {}),
+            state.get("content", {}),
+            state.get("annotations", {})
+        )
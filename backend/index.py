@@ -1,12 +1,35 @@
-from gensim import corpora, models, similarities
 import config
 import pickle
-import heapq
 import os, time
+import json
+import asyncio
+import numpy as np
+from itertools import islice
 import multiprocessing as mp
-from .utils import ESHandler, CONFIG
+from concurrent.futures import ThreadPoolExecutor, wait
+from .utils import ESHandler, AsyncESHandler, EventLoopThread, CONFIG
 from .document import Document
 from .ner import Metamap
+from .cache import QueryCache, normalize_query
+from .docstore import DocStore
+from .tokencache import TokenCache
+from .dense import DenseVectorIndex
+from .sparse import InvertedIndex
+from .shards import ShardedIndex
+from .metrics import REGISTRY, span
+from .breaker import CircuitOpenError
+
+INDEX_BUILD_SECONDS = REGISTRY.histogram(
+    "covidqa_index_build_seconds",
+    "Duration of full Gensim index builds",
+    labels=("model",),
+    buckets=(1.0, 10.0, 30.0, 60.0, 300.0, 900.0, 1800.0, 3600.0, 7200.0)
+)
+INDEXED_DOCS = REGISTRY.counter(
+    "covidqa_indexed_docs",
+    "Documents added to the Gensim index, by full build or incremental update",
+    labels=("operation",)
+)
 
 class Index():
 
@@ -18,65 +41,364 @@ class Index():
         """ Check if we need to update the index and do update if needed"""
         raise NotImplementedError
 
-    def query(self, query):
-        """  Take query and return list of tuples of the form (document, score) """
+    def query(self, query, page=1, size=100):
+        """
+        Take query and return list of tuples of the form (document, score).
+        Only results of the given page are returned, size per page.
+        Documents may only hold the fields needed for display.
+        """
         raise NotImplementedError
 
+    async def aquery(self, query, page=1, size=100):
+        """
+        Coroutine version of query for async web servers. Runs query in a
+        worker thread unless the backend has a native async pipeline.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.query, query, page, size)
+
+    def query_many(self, queries, page=1, size=100):
+        """
+        Answer a batch of queries. Returns one list of (document, score)
+        tuples per query, in the order of queries. Backends override this
+        when a batch can be answered faster than one query at a time.
+        """
+        return [self.query(query, page, size) for query in queries]
+
     def save(self):
         """ Save itself"""
         raise NotImplementedError
 
+    def warm_up(self):
+        """
+        Make the first queries fast, e.g. by connecting to services and
+        loading models. Raises if the index can not serve queries yet.
+        """
+        pass
+
     @staticmethod
     def load_latest():
         """ Load the latest stored index """
         raise NotImplementedError
 
+# Document fields needed to display a result
+RESULT_FIELDS = ["title", "metadata.authors", "metadata.url"]
+
+class LazyResults():
+    """
+    Sequence of (document, score) tuples whose documents are fetched on demand.
+
+    Documents are hydrated one page at a time with a single call to fetch, so
+    only the results that are actually read cost a round trip. Documents that
+    are missing or have no title are left out when reading.
+
+    Attributes:
+        hits (list[tuple[str, float]]) : document ids and scores, best first
+        fetch (callable) : takes a list of ids and returns a list of Document or None
+        page_size (int) : number of documents fetched together
+    """
+    def __init__(self, hits, fetch, page_size=10):
+        self.hits = hits
+        self.fetch = fetch
+        self.page_size = page_size
+        self._docs = {}
+
+    def __len__(self):
+        return len(self.hits)
+
+    def _hydrate(self, positions):
+        pages = sorted(set(pos // self.page_size for pos in positions
+            if pos not in self._docs))
+        for page in pages:
+            start = page * self.page_size
+            end = min(start + self.page_size, len(self.hits))
+            missing = [pos for pos in range(start, end) if pos not in self._docs]
+            with span("hydrate", docs=len(missing)):
+                docs = self.fetch([self.hits[pos][0] for pos in missing])
+            for pos, doc in zip(missing, docs):
+                self._docs[pos] = doc
+
+    def _results(self, positions):
+        self._hydrate(positions)
+        results = []
+        for pos in positions:
+            doc = self._docs[pos]
+            # Some documents don't have titles, so filter them
+            if doc is not None and doc.title:
+                results.append((doc, float(self.hits[pos][1])))
+        return results
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._results(range(*key.indices(len(self.hits))))
+        results = self._results([range(len(self.hits))[key]])
+        return results[0] if results else None
+
+    def __iter__(self):
+        for start in range(0, len(self.hits), self.page_size):
+            end = min(start + self.page_size, len(self.hits))
+            for result in self._results(range(start, end)):
+                yield result
+
 class ElasticSearchIndex(Index):
+    """
+    With PASSAGE_SEARCH the passage index is searched instead of whole
+    papers. Hits are collapsed to the best passage of each paper, which is
+    returned in doc.content["passage"] and highlighted, so only passages and
+    not full texts are highlighted at query time.
+
+    Attributes:
+        es_handler (ESHandler) : synchronous handler used for maintenance
+        async_handler (AsyncESHandler) : pooled async handler used by queries
+        loop (EventLoopThread) : event loop that runs every query pipeline
+        search_index (str) : name of the searched index
+    """
+    SEARCH_FIELDS = [
+        "title^3",
+        "content.abstract^2",
+        "content.body",
+        "content.supplementary",
+        "content.concepts^4"
+    ]
+    PASSAGE_SEARCH_FIELDS = [
+        "title^3",
+        "text",
+        "concepts^4"
+    ]
 
     def __init__(self):
         self.es_handler = ESHandler()
+        self.async_handler = AsyncESHandler()
+        self.loop = EventLoopThread()
         self.metamap = Metamap()
+        self.passages = CONFIG["PASSAGE_SEARCH"]
+        self.search_index = self.es_handler.passage_index if self.passages \
+            else self.es_handler.index
+        self.cache = QueryCache(
+            max_entries=CONFIG["QUERY_CACHE_ENTRIES"],
+            ttl=CONFIG["QUERY_CACHE_TTL"],
+            max_bytes=CONFIG["QUERY_CACHE_MAX_BYTES"],
+            generation_fn=self.es_handler.generation,
+            stale_ttl=CONFIG["QUERY_CACHE_STALE_TTL"]
+        )
 
     def init(self):
         pass
 
     def update(self):
         pass
-    
-    def query(self, query):
-        concepts = self.metamap(query)
+
+    def query(self, query, page=1, size=100):
+        """
+        Raises:
+            CircuitOpenError if Elastic Search is unhealthy and no cached
+            result, even an expired one, is available
+        """
+        return self.loop.run(self.aquery(query, page, size))
+
+    async def aquery(self, query, page=1, size=100):
+        """
+        Coroutine version of query that can be awaited from any event loop,
+        e.g. that of an async Flask view.
+        """
+        key = normalize_query(query, page=page, size=size)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+        try:
+            # Fail fast instead of waiting for MetaMap when ES is known to be down
+            if not self.async_handler.breaker.allow():
+                raise CircuitOpenError("elasticsearch is unavailable")
+            # The pipeline runs on the index's loop, which owns the pooled ES client
+            result, complete = await self.loop.submit(self.query_async(query, page, size))
+        except Exception as err:
+            stale = self.cache.get_stale(key)
+            if stale is None:
+                raise
+            print("Serving stale results:", repr(err))
+            return stale
+        # Plain text results served because MetaMap was late are only kept
+        # briefly, so the query gets its concepts once MetaMap has answered
+        self.cache.put(key, result,
+            ttl=None if complete else CONFIG["QUERY_CACHE_DEGRADED_TTL"])
+        return result
+
+    def query_many(self, queries, page=1, size=100):
+        """
+        Extract concepts of every uncached query with one MetaMap call and
+        search them with a single multi search request.
+        Raises:
+            CircuitOpenError if Elastic Search is unhealthy and a query has
+            no cached result, even an expired one
+        """
+        keys = [normalize_query(query, page=page, size=size) for query in queries]
+        results = [self.cache.get(key) for key in keys]
+        misses = [i for i, result in enumerate(results) if result is None]
+        if not misses:
+            return results
+
+        try:
+            if not self.es_handler.breaker.allow():
+                raise CircuitOpenError("elasticsearch is unavailable")
+            # The uncached queries go through MetaMap in one run, which takes
+            # longer the more queries there are
+            with span("concepts", queries=len(misses)):
+                concepts = self.metamap.extract_many([queries[i] for i in misses],
+                    timeout=CONFIG["MM_DEADLINE"] + CONFIG["MM_DEADLINE_PER_QUERY"] * len(misses))
+            with span("build"):
+                query_bodies = [self._build_query(queries[i], cuis or [])
+                    for i, cuis in zip(misses, concepts)]
+            with span("es_search", queries=len(misses)):
+                responses = self.es_handler.msearch(query_bodies, size=size,
+                    from_=(page - 1) * size, index=self.search_index)
+        except Exception as err:
+            stale = [self.cache.get_stale(keys[i]) for i in misses]
+            if any(result is None for result in stale):
+                raise
+            print("Serving stale results:", repr(err))
+            for i, result in zip(misses, stale):
+                results[i] = result
+            return results
+
+        with span("hydrate", docs=sum(len(resp["hits"]["hits"]) for resp in responses if resp)):
+            for i, cuis, resp in zip(misses, concepts, responses):
+                results[i] = self._to_results(resp)
+                # Failed searches and plain text fallbacks are not cached, so
+                # they are retried instead of answering interactive queries
+                if resp is not None and cuis is not None:
+                    self.cache.put(keys[i], results[i])
+        return results
+
+    def _build_query(self, query, concepts):
+        if self.passages:
+            return self._build_passage_query(query, concepts)
         for concept in concepts:
             query += " OR (content.concepts:" + concept + ")"
 
-        print("query: ", query)
-        query_body = { 
+        query_body = {
+            "query": {
+                "query_string" : {
+                    "query" : query,
+                    "fields" : ElasticSearchIndex.SEARCH_FIELDS
+                }
+            },
+            # Only fetch what is displayed instead of whole papers
+            "_source": RESULT_FIELDS,
+            "highlight" : {
+                "encoder": "html",
+                "fragment_size": CONFIG["HIGHLIGHT_FRAGMENT_SIZE"],
+                "number_of_fragments": CONFIG["HIGHLIGHT_FRAGMENTS"],
+                "fields" : {
+                    "content.abstract" : {},
+                    "content.body" : {}
+                }
+            }
+        }
+        return query_body
+
+    def _build_passage_query(self, query, concepts):
+        for concept in concepts:
+            query += " OR (concepts:" + concept + ")"
+
+        query_body = {
             "query": {
                 "query_string" : {
                     "query" : query,
-                    "fields" : [
-                        "title^3",
-                        "content.abstract^2",
-                        "content.body",
-                        "content.supplementary",
-                        "content.concepts^4"
-                    ]
+                    "fields" : ElasticSearchIndex.PASSAGE_SEARCH_FIELDS
                 }
             },
+            # One hit per paper, the best of its passages
+            "collapse": {"field": "paper_id"},
+            "_source": ["paper_id", "text"] + RESULT_FIELDS,
             "highlight" : {
+                "encoder": "html",
+                # Passages are short, so they are highlighted whole
+                "number_of_fragments": 0,
                 "fields" : {
-                    "content" : {}
+                    "text" : {}
                 }
             }
         }
-        
-        query_hits = self.es_handler.advanced_search(query_body)["hits"]["hits"]
+        return query_body
+
+    def _to_results(self, resp):
+        if resp is None:
+            return []
         result = []
-        for hit in query_hits:
+        for hit in resp["hits"]["hits"]:
             doc = Document.from_dict(hit["_source"])
+            doc.id = hit["_id"]
+            if "paper_id" in hit["_source"]:
+                # Passage hit, shown as its paper
+                doc.id = hit["_source"]["paper_id"]
+                doc.content = {"passage": hit["_source"].get("text", "")}
+            if "highlight" in hit:
+                fragments = [fragment for field in hit["highlight"].values()
+                    for fragment in field]
+                doc.content["highlight"] = " ... ".join(fragments)
             score = hit["_score"]
             result.append((doc, score))
         return result
 
+    async def _search(self, query, concepts, size, from_, timeout):
+        with span("build"):
+            query_body = self._build_query(query, concepts)
+        with span("es_search", concepts=len(concepts)):
+            return await self.async_handler.advanced_search(
+                query_body, size=size, from_=from_, timeout=timeout,
+                index=self.search_index)
+
+    async def query_async(self, query, page=1, size=100):
+        """
+        Run concept extraction and a plain text search concurrently.
+
+        When concepts arrive within MM_DEADLINE, the concept-expanded search is
+        issued and its results are returned. Otherwise, or if the expanded
+        search misses ES_DEADLINE, the plain text results are returned.
+        Returns:
+            (results, complete) where complete is False if the plain text
+            results were returned because MetaMap or the expanded search failed
+        """
+        deadline = time.monotonic() + CONFIG["ES_DEADLINE"]
+        from_ = (page - 1) * size
+        plain = asyncio.ensure_future(self._search(
+            query, [], size, from_, CONFIG["ES_DEADLINE"]))
+        with span("concepts"):
+            concepts = await self.metamap.extract_async(query, CONFIG["MM_DEADLINE"])
+
+        if concepts:
+            remaining = max(deadline - time.monotonic(), 0.001)
+            try:
+                resp = await self._search(query, concepts, size, from_, remaining)
+                plain.cancel()
+                with span("hydrate", docs=len(resp["hits"]["hits"])):
+                    return self._to_results(resp), True
+            except Exception as err:
+                print("Concept search failed, using plain text results:", repr(err))
+        # A query for which MetaMap found nothing is not degraded
+        complete = concepts is not None and not concepts
+
+        remaining = max(deadline - time.monotonic(), 0.001)
+        try:
+            resp = await asyncio.wait_for(plain, remaining)
+        except asyncio.TimeoutError:
+            # The search was cancelled before its own timeout, so count it here
+            self.async_handler.breaker.record_failure()
+            raise
+        with span("hydrate", docs=len(resp["hits"]["hits"]) if resp else 0):
+            return self._to_results(resp), complete
+
+    def warm_up(self):
+        """ Check that Elastic Search answers, open the async pool and start MetaMap """
+        if not self.es_handler.client.ping():
+            raise ConnectionError("Elastic Search is not reachable at " + CONFIG["ES_HOST"])
+        self.loop.run(self.async_handler.client.ping(), timeout=CONFIG["ES_DEADLINE"])
+        try:
+            self.metamap.pool.warm_up()
+        except Exception as err:
+            # Queries still work without concepts, so this does not block readiness
+            print("MetaMap warm-up failed:", repr(err))
+
     def save(self, query):
         self.es_handler.save()
 
@@ -88,45 +410,176 @@ class GensimIndex(Index):
     """
     Attributes:
         documents (set[str]) : set of document ids
+        doc_ids (list[str]) : id of the document at every row of the index
+        removed (numpy.ndarray) : bool mask of rows whose documents were
+            withdrawn from Elastic Search since the last training
         model_type (str) : name of gensim model
         dictionary (corpora.Dictionary) : dictionary
         model (models.<Name of Model>) : gensim model trained from corpus
-        index (similarities.Similarity) : index for lookup
+        index (ShardedIndex, DenseVectorIndex or InvertedIndex) : index for lookup
+        docstore (DocStore) : local copy of the indexed documents
     """
     SAVE_PATH = CONFIG["SAVE_DIR"] + "/index/gensim"
+    # Models whose document vectors are dense and searched with DenseVectorIndex
+    DENSE_MODELS = ["lsi", "lda"]
+    # TF-IDF searched with InvertedIndex instead of similarities.Similarity
+    SPARSE_MODELS = ["inverted"]
+    TOKEN_CACHE_PATH = CONFIG["SAVE_DIR"] + "/tokens/tokens.sqlite"
+    # Progress of an index build in SAVE_PATH, removed when the build finishes
+    CHECKPOINT_NAME = "build.checkpoint"
 
     def __init__(self, tokenizer):
 
         self.tokenizer = tokenizer
         if not os.path.exists(GensimIndex.SAVE_PATH):
             os.makedirs(GensimIndex.SAVE_PATH)
-        self.es_handler = ESHandler()
+        self._es_handler = None
 
         self.doc_ids = []
+        self.removed = np.zeros(0, dtype=bool)
         self.model_type = None
         self.dictionary = None
         self.corpus = None
         self.model = None
         self.index = None
-        
-    def init(self, model="tfidf"):
+        self.docstore = None
+        # Tokens of documents added by update since the last training
+        self.added_tokens = 0
+        self.unknown_tokens = 0
+
+    @property
+    def es_handler(self):
+        # Only connect to Elastic Search when documents are fetched from it,
+        # so an index with a local docstore can be served without ES
+        if self._es_handler is None:
+            self._es_handler = ESHandler()
+        return self._es_handler
+
+    @staticmethod
+    def _checkpoint_path():
+        return GensimIndex.SAVE_PATH + "/" + GensimIndex.CHECKPOINT_NAME
+
+    def _read_checkpoint(self, model):
+        """ Return checkpoint of an interrupted build of model on the current corpus, or None """
+        try:
+            with open(GensimIndex._checkpoint_path(), "r") as fp:
+                checkpoint = json.load(fp)
+        except FileNotFoundError:
+            return None
+        if checkpoint["model"] != model \
+                or checkpoint["generation"] != self.es_handler.generation():
+            return None
+        return checkpoint
+
+    def _write_checkpoint(self, checkpoint):
+        tmp_path = GensimIndex._checkpoint_path() + ".tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(checkpoint, fp)
+        os.replace(tmp_path, GensimIndex._checkpoint_path())
+
+    def _scan(self, token_cache, dictionary):
+        """
+        Stream every document from Elastic Search into the token cache, the
+        dictionary and the docstore, GENSIM_BUILD_BATCH documents at a time.
+        Documents already in the docstore were handled by an interrupted run,
+        so only their cached tokens are added to the dictionary.
+        """
+        batch_size = CONFIG["GENSIM_BUILD_BATCH"]
+        done = set(self.docstore.ids)
+        if done:
+            print("Resuming after {} documents...".format(len(done)))
+            for start in range(0, len(self.docstore.ids), batch_size):
+                dictionary.add_documents(list(token_cache.iter_tokens(
+                    self.docstore.ids[start:start + batch_size])))
+
+        start = time.time()
+        count = 0
+        documents = (doc for doc in self.es_handler.iter_docs(page_size=CONFIG["ES_SCAN_SIZE"])
+            if doc.id not in done)
+        while True:
+            batch = list(islice(documents, batch_size))
+            if not batch:
+                break
+            tokenized = list(token_cache.tokenize(batch, self.tokenizer, 8, len(batch)))
+            dictionary.add_documents(tokenized)
+            # Appending to the docstore marks the batch as done, so tokens are cached first
+            self.docstore.append(batch)
+            count += len(batch)
+            elapsed = time.time() - start
+            print("Tokenized {} documents ({:.1f} docs/sec)".format(
+                len(self.docstore), count / elapsed if elapsed > 0 else 0.0))
+
+    def init(self, model="tfidf", resume=True):
+        """
+        Build the index from every document in Elastic Search.
+
+        The corpus is streamed, so memory use depends on GENSIM_BUILD_BATCH
+        and the vocabulary rather than on the number of documents. The first
+        pass goes from an ES scan through the tokenizer into the dictionary
+        and the docstore. The second pass writes the MmCorpus from the token
+        cache. Models and indexes are trained from the MmCorpus on disk.
+
+        Progress is checkpointed, so an interrupted build of the same model
+        resumes where it stopped if resume is True and the corpus did not
+        change in the meantime.
+        """
+        # gensim is imported where it is used, so serving Elastic Search alone does not load it
+        from gensim import corpora, models, similarities
         print("Building Gensim Index...")
+        start = time.time()
+        checkpoint = self._read_checkpoint(model) if resume else None
+        if checkpoint is None:
+            checkpoint = {
+                "model": model,
+                "timestamp": str(int(time.time())),
+                "generation": self.es_handler.generation(),
+                "stage": "scan"
+            }
+            self._write_checkpoint(checkpoint)
+            self.docstore = DocStore.create(
+                GensimIndex.SAVE_PATH + "/" + checkpoint["timestamp"] + ".docstore")
+        else:
+            print("Resuming build from stage:", checkpoint["stage"])
+            self.docstore = DocStore(
+                GensimIndex.SAVE_PATH + "/" + checkpoint["timestamp"] + ".docstore")
         self.model_type = model
-        documents = self.es_handler.get_all_docs()
-        self.doc_ids = [doc.id for doc in documents]
-        print("Tokenizing documents...")
-        print("Total:", len(documents))
-        tokenized_docs = self.tokenizer.tokenize_doc_parallel(documents, 8)
-
-        print("Build dictionary...")
-        self.dictionary = corpora.Dictionary(tokenized_docs)
-        self.corpus = [self.dictionary.doc2bow(doc) for doc in tokenized_docs]
+        self.timestamp = checkpoint["timestamp"]
+        dict_path = GensimIndex.SAVE_PATH + "/" + self.timestamp + ".dict"
         corpus_path = GensimIndex.SAVE_PATH + "/mmcorpus"
-        corpora.MmCorpus.serialize(corpus_path, self.corpus)
+        token_cache = TokenCache(GensimIndex.TOKEN_CACHE_PATH)
+
+        if checkpoint["stage"] == "scan":
+            print("Tokenizing documents and building dictionary...")
+            self.dictionary = corpora.Dictionary()
+            self._scan(token_cache, self.dictionary)
+            self.tokenizer.close()
+            self.dictionary.save(dict_path)
+            checkpoint["stage"] = "corpus"
+            self._write_checkpoint(checkpoint)
+        else:
+            self.dictionary = corpora.Dictionary.load(dict_path)
+        self.doc_ids = list(self.docstore.ids)
+        self.removed = np.zeros(len(self.doc_ids), dtype=bool)
+        self.added_tokens = 0
+        self.unknown_tokens = 0
+        self.corpus = None
+        print("Total:", len(self.doc_ids))
+
+        if checkpoint["stage"] == "corpus":
+            print("Writing corpus...")
+            corpora.MmCorpus.serialize(
+                corpus_path,
+                (self.dictionary.doc2bow(tokens) for tokens
+                    in token_cache.iter_tokens(self.doc_ids, CONFIG["GENSIM_BUILD_BATCH"])),
+                id2word=self.dictionary
+            )
+            checkpoint["stage"] = "model"
+            self._write_checkpoint(checkpoint)
+        token_cache.close()
         mmcorpus = corpora.MmCorpus(corpus_path)
 
         self.model_type = model
-        if model == "tfidf":
+        if model == "tfidf" or model in GensimIndex.SPARSE_MODELS:
             self.model = models.TfidfModel(mmcorpus)
         elif model == "lsi":
             self.model = models.LsiModel(mmcorpus)
@@ -135,65 +588,173 @@ class GensimIndex(Index):
         else:
             raise ValueError("Unknown model type:", model)
 
-        index_path = GensimIndex.SAVE_PATH + "/index"
         print("Building index...")
-        self.index = similarities.Similarity(
-            index_path,
-            self.model[mmcorpus],
-            len(self.dictionary)
-        )
-        self.timestamp = str(int(time.time()))
+        if model in GensimIndex.DENSE_MODELS:
+            index_path = GensimIndex.SAVE_PATH + "/" + self.timestamp + ".dense"
+            self.index = DenseVectorIndex.build(
+                index_path,
+                self.model[mmcorpus],
+                self.model.num_topics,
+                quantize=CONFIG["DENSE_QUANTIZE"],
+                num_lists=CONFIG["DENSE_IVF_LISTS"],
+                probes=CONFIG["DENSE_IVF_PROBES"]
+            )
+        elif model in GensimIndex.SPARSE_MODELS:
+            index_path = GensimIndex.SAVE_PATH + "/" + self.timestamp + ".inverted"
+            self.index = InvertedIndex.build(
+                index_path,
+                self.model[mmcorpus],
+                len(self.dictionary)
+            )
+        else:
+            index_path = GensimIndex.SAVE_PATH + "/index"
+            self.index = ShardedIndex(
+                similarities.Similarity(
+                    index_path,
+                    self.model[mmcorpus],
+                    len(self.dictionary),
+                    shardsize=CONFIG["GENSIM_SHARD_SIZE"]
+                ),
+                workers=CONFIG["GENSIM_SHARD_WORKERS"]
+            )
         self.save()
+        os.remove(GensimIndex._checkpoint_path())
+        INDEX_BUILD_SECONDS.observe(time.time() - start, model=model)
+        INDEXED_DOCS.inc(len(self.doc_ids), operation="init")
         print("Finished!")
 
     def update(self):
-        new_doc_ids = self.es_handler.get_all_ids()
-        difference = list(set(self.doc_ids).difference(set(new_doc_ids)))
-        if not difference:
-            return 
+        """
+        Add documents that are in Elastic Search but not in the index yet,
+        and remove documents that are no longer in Elastic Search.
+
+        New documents are vectorized with the current dictionary and model and
+        appended to the similarity index as new shards. The whole index is only
+        retrained when the share of tokens unknown to the dictionary among
+        documents added since the last training exceeds GENSIM_RETRAIN_DRIFT.
+        Removed documents are only marked in the removed mask and left out of
+        query results; their rows are dropped by the next training.
+        """
+        all_ids = self.es_handler.get_all_ids()
+        live_ids = set(all_ids)
+        removed = [pos for pos, id in enumerate(self.doc_ids)
+            if not self.removed[pos] and id not in live_ids]
+        self.removed[removed] = True
+        indexed = set(id for pos, id in enumerate(self.doc_ids) if not self.removed[pos])
+        new_doc_ids = [id for id in all_ids if id not in indexed]
+        if not new_doc_ids and not removed:
+            return
 
         print("Updating Gensim Index...")
-        self.doc_ids += new_doc_ids
-        new_docs = self.es_handler.get_many(difference)
-        tokenized_docs = self.tokenizer.tokenize_doc_parallel(new_docs, 2)
-        self.dictionary.add_documents(tokenized_docs)
-        new_corpus = [dictionary.doc2bow(doc) for doc in tokenized_docs]
-        self.corpus += new_corpus
-        corpus_path = GensimIndex.SAVE_PATH + "/mmcorpus"
-        corpora.MmCorpus.serialize(corpus_path, self.corpus)
-        mmcorpus = corpora.MmCorpus(corpus_path)
+        print("Removed documents:", len(removed))
+        print("New documents:", len(new_doc_ids))
+        if new_doc_ids and not self._add(new_doc_ids):
+            return
 
-        model_name = "models." + self.model.__class__.name__
-        self.model = eval(model_name) + "(mmcorpus)"
-
-        index_path = GensimIndex.SAVE_PATH + "/index"
-        self.index = similarities.Similarity(
-            index_path,
-            self.model[mmcorpus],
-            len(self.dictionary)
-        )
         self.timestamp = str(int(time.time()))
         self.save()
         print("Finished!")
 
-    def query(self, query):
-        query = self.tokenizer(query)
-        bow_rep = self.dictionary.doc2bow(query)
-        model_rep = self.model[bow_rep]
-        results = self.index[model_rep]
-        #Take top 100 results according to similarity score
-        top_results = heapq.nlargest(100, enumerate(results), key=lambda item: item[1])
-        
-        final_results = []
-
-        for result in top_results:
-            doc = self.es_handler.get(self.doc_ids[result[0]])
-            if doc.title and doc.title != "":
-                # Some documents don't have titles, so filter them
-                score = float(result[1])
-                final_results.append((doc, score))
-
-        return final_results
+    def _add(self, new_doc_ids):
+        """
+        Append documents to the index, or retrain it if the vocabulary drifted.
+        Returns:
+            False if the index was retrained and saved, True otherwise
+        """
+        new_docs = [doc for doc in self.es_handler.get_many(new_doc_ids, maintenance=True)
+            if doc is not None]
+        token_cache = TokenCache(GensimIndex.TOKEN_CACHE_PATH)
+        tokenized_docs = list(token_cache.tokenize(new_docs, self.tokenizer, 2))
+        token_cache.close()
+        self.tokenizer.close()
+
+        for doc in tokenized_docs:
+            self.added_tokens += len(doc)
+            self.unknown_tokens += sum(1 for token in doc
+                if token not in self.dictionary.token2id)
+        drift = self.unknown_tokens / self.added_tokens if self.added_tokens else 0.0
+        if drift > CONFIG["GENSIM_RETRAIN_DRIFT"]:
+            print("Vocabulary drift {:.3f}, retraining...".format(drift))
+            self.init(self.model_type)
+            return False
+
+        # The dictionary stays fixed between trainings so term ids match the model
+        new_corpus = [self.dictionary.doc2bow(doc) for doc in tokenized_docs]
+        self.index.add_documents(self.model[new_corpus])
+        if self.docstore is not None:
+            self.docstore.append(new_docs)
+        self.doc_ids += [doc.id for doc in new_docs]
+        self.removed = np.concatenate([self.removed, np.zeros(len(new_docs), dtype=bool)])
+        INDEXED_DOCS.inc(len(new_docs), operation="update")
+        return True
+
+    def _top_k(self, top_k):
+        """ Number of results to search for so top_k remain once removed rows are dropped """
+        return top_k + int(np.count_nonzero(self.removed))
+
+    def _live(self, top_results, top_k):
+        """
+        Drop rows appended after this snapshot was saved and rows of
+        removed documents from top_results
+        """
+        count = len(self.doc_ids)
+        return [item for item in top_results
+            if item[0] < count and not self.removed[item[0]]][:top_k]
+
+    def query(self, query, page=1, size=100):
+        from gensim import matutils
+        top_k = page * size
+        with span("tokenize"):
+            query = self.tokenizer(query)
+        with span("vectorize", model=self.model_type):
+            bow_rep = self.dictionary.doc2bow(query)
+            model_rep = self.model[bow_rep]
+        with span("search", model=self.model_type, top_k=top_k):
+            if isinstance(self.index, DenseVectorIndex):
+                query_vec = matutils.sparse2full(model_rep, self.index.num_features)
+                top_results = self.index.topk(query_vec, self._top_k(top_k))
+            else:
+                top_results = self.index.topk(model_rep, self._top_k(top_k))
+            top_results = self._live(top_results, top_k)
+        hits = [(self.doc_ids[pos], score) for pos, score in top_results[top_k - size:]]
+
+        return LazyResults(hits, self._fetch, page_size=size)
+
+    def query_many(self, queries, page=1, size=100):
+        """
+        Score every query in one pass over the index: the query vectors are
+        stacked into a matrix and multiplied with the document vectors.
+        """
+        from gensim import matutils
+        top_k = page * size
+        with span("tokenize", queries=len(queries)):
+            tokens = self.tokenizer.tokenize_texts(queries)
+        with span("vectorize", model=self.model_type):
+            model_reps = [self.model[self.dictionary.doc2bow(query)] for query in tokens]
+        with span("search", model=self.model_type, top_k=top_k, queries=len(queries)):
+            if isinstance(self.index, DenseVectorIndex):
+                query_vecs = np.array([matutils.sparse2full(rep, self.index.num_features)
+                    for rep in model_reps]).reshape(len(queries), self.index.num_features)
+                top_results = self.index.topk_many(query_vecs, self._top_k(top_k))
+            else:
+                top_results = self.index.topk_many(model_reps, self._top_k(top_k))
+            top_results = [self._live(items, top_k) for items in top_results]
+
+        results = []
+        for items in top_results:
+            hits = [(self.doc_ids[pos], score) for pos, score in items[top_k - size:]]
+            results.append(LazyResults(hits, self._fetch, page_size=size))
+        return results
+
+    def warm_up(self):
+        # Page in the model and the memory-mapped index
+        self.query("covid", size=1)
+
+    def _fetch(self, ids):
+        """ Hydrate result documents with the fields needed for display """
+        if self.docstore is not None:
+            return self.docstore.get_many(ids)
+        return self.es_handler.get_many(ids, fields=RESULT_FIELDS)
 
     def save(self):
         """
@@ -203,14 +764,19 @@ class GensimIndex(Index):
         self.dictionary.save(dict_path)
         model_path = GensimIndex.SAVE_PATH + "/" + self.timestamp + ".model"
         self.model.save(model_path)
-        index_path = GensimIndex.SAVE_PATH + "/" + self.timestamp + ".index"
-        self.index.save(index_path)
+        if isinstance(self.index, (DenseVectorIndex, InvertedIndex)):
+            # These indexes are written to disk as they are built or extended
+            index_path = self.index.path
+        else:
+            index_path = GensimIndex.SAVE_PATH + "/" + self.timestamp + ".index"
+            self.index.save(index_path)
 
         state = self.__dict__.copy()
         state["dictionary"] = dict_path
         state["model"] = model_path
         state["index"] = index_path
-        state["es_handler"] = None
+        state["_es_handler"] = None
+        state["docstore"] = self.docstore.path if self.docstore else None
 
         object_path = GensimIndex.SAVE_PATH + "/" + self.timestamp + ".gensimindex"
         with open(object_path, "wb") as fp:
@@ -218,23 +784,41 @@ class GensimIndex(Index):
 
     @staticmethod
     def load(timestamp):
+        from gensim import corpora, models, similarities
         index = object.__new__(GensimIndex)
         object_path = GensimIndex.SAVE_PATH + "/" + timestamp + ".gensimindex"
         with open(object_path, "rb") as fp:
             state = pickle.load(fp)
 
         state["dictionary"] = corpora.Dictionary.load(state["dictionary"])
-        if state["model_type"] == "tfidf":
+        state.setdefault("added_tokens", 0)
+        state.setdefault("unknown_tokens", 0)
+        state.setdefault("removed", np.zeros(len(state["doc_ids"]), dtype=bool))
+        if state["model_type"] == "tfidf" or state["model_type"] in GensimIndex.SPARSE_MODELS:
             state["model"] = models.TfidfModel.load(state["model"])
         elif state["model_type"] == "lsi":
             state["model"] = models.LsiModel.load(state["model"])
         elif state["model_type"] == "lda":
             state["model"] = models.LdaModel.load(state["model"])
         else:
-            raise ValueError("Unknown model type:", state[model_type])
+            raise ValueError("Unknown model type:", state["model_type"])
 
-        state["index"] = similarities.MatrixSimilarity.load(state["index"])
-        state["es_handler"] = ESHandler()
+        if state["model_type"] in GensimIndex.SPARSE_MODELS:
+            state["index"] = InvertedIndex(state["index"])
+        elif os.path.isdir(state["index"]):
+            state["index"] = DenseVectorIndex(state["index"])
+        else:
+            # Shards are memory-mapped when they are first searched
+            state["index"] = ShardedIndex(
+                similarities.Similarity.load(state["index"], mmap="r"),
+                workers=CONFIG["GENSIM_SHARD_WORKERS"]
+            )
+        state.pop("es_handler", None)
+        state["_es_handler"] = None
+        if state.get("docstore"):
+            state["docstore"] = DocStore(state["docstore"])
+        else:
+            state["docstore"] = None
 
         index.__dict__ = state
         return index
@@ -249,3 +833,113 @@ class GensimIndex(Index):
         latest_timestamp = max(files).replace(".gensimindex", "")
         return GensimIndex.load(latest_timestamp)
 
+class HybridIndex(Index):
+    """
+    Index that queries ElasticSearchIndex and GensimIndex in parallel and
+    merges their rankings with reciprocal-rank fusion.
+
+    Both backends share one time budget. A backend that misses it or fails
+    is left out, so the other one's results are still returned. Documents
+    already returned by Elastic Search are reused; the rest are hydrated
+    lazily through the GensimIndex.
+
+    Attributes:
+        indexes (dict[str, Index]) : backends by name
+        budget (float) : seconds to wait for the backends
+    """
+    RRF_K = 60
+
+    def __init__(self, es_index, gensim_index, budget=None):
+        self.es_index = es_index
+        self.gensim_index = gensim_index
+        self.indexes = {"elasticsearch": es_index, "gensim": gensim_index}
+        self.budget = budget or CONFIG["HYBRID_BUDGET"]
+        self.executor = ThreadPoolExecutor(max_workers=CONFIG["HYBRID_WORKERS"])
+
+    def init(self, model="tfidf"):
+        self.es_index.init()
+        self.gensim_index.init(model)
+
+    def update(self):
+        self.es_index.update()
+        self.gensim_index.update()
+
+    def warm_up(self):
+        self.es_index.warm_up()
+        self.gensim_index.warm_up()
+
+    def _ranking(self, results):
+        """ Return ranked (id, document or None) pairs without hydrating lazy results """
+        if isinstance(results, LazyResults):
+            return [(id, None) for id, _ in results.hits]
+        return [(doc.id, doc) for doc, _ in results]
+
+    def _run(self, method, *args, budget=None):
+        """
+        Call method on every backend in parallel within budget seconds,
+        the time budget of a single query if None.
+        Returns:
+            dict of backend name to its return value. Backends that failed or
+            missed the budget are left out.
+        """
+        futures = {self.executor.submit(getattr(index, method), *args): name
+            for name, index in self.indexes.items()}
+        done, not_done = wait(futures, timeout=budget or self.budget)
+        for future in not_done:
+            print("Missed time budget:", futures[future])
+
+        # Collected in backend order so that ties are fused the same way every time
+        returned = {}
+        for future, name in futures.items():
+            if future not in done:
+                continue
+            try:
+                returned[name] = future.result()
+            except Exception as err:
+                print("Query failed on {}: {!r}".format(name, err))
+        return returned
+
+    def _fuse(self, results, page, size):
+        """ Merge the results of each backend for one query with reciprocal-rank fusion """
+        scores = {}
+        docs = {}
+        for ranking in map(self._ranking, results):
+            for rank, (id, doc) in enumerate(ranking):
+                scores[id] = scores.get(id, 0.0) + 1.0 / (HybridIndex.RRF_K + rank + 1)
+                if doc is not None:
+                    docs[id] = doc
+
+        hits = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        hits = hits[(page - 1) * size:page * size]
+        return LazyResults(hits, lambda ids: self._fetch(ids, docs), page_size=size)
+
+    def query(self, query, page=1, size=100):
+        # Fusion needs every backend's ranking down to the last requested result
+        returned = self._run("query", query, 1, page * size)
+        with span("fusion", backends=len(returned)):
+            return self._fuse(returned.values(), page, size)
+
+    def query_many(self, queries, page=1, size=100):
+        # A batch gets as long as a multi search may take instead of the budget of one query
+        returned = self._run("query_many", queries, 1, page * size,
+            budget=CONFIG["ES_MSEARCH_TIMEOUT"])
+        with span("fusion", backends=len(returned), queries=len(queries)):
+            return [self._fuse([results[i] for results in returned.values()], page, size)
+                for i in range(len(queries))]
+
+    def _fetch(self, ids, docs):
+        """ Hydrate ids that Elastic Search did not return in a single call """
+        missing = [id for id in ids if id not in docs]
+        fetched = dict(zip(missing, self.gensim_index._fetch(missing)))
+        return [docs[id] if id in docs else fetched[id] for id in ids]
+
+    def save(self):
+        self.es_index.es_handler.save()
+        self.gensim_index.save()
+
+    @staticmethod
+    def load_latest():
+        return HybridIndex(
+            ElasticSearchIndex.load_latest(),
+            GensimIndex.load_latest()
+        )
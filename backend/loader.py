@@ -0,0 +1,108 @@
+import time
+import threading
+
+def create_index(name):
+    """
+    Load the latest saved index of the given backend, or build a new one if
+    nothing was saved yet. Backend modules are imported here, so only the
+    chosen backend's dependencies are loaded.
+    Args:
+        name (str) : "elasticsearch", "gensim" or "hybrid"
+    """
+    from .index import ElasticSearchIndex, GensimIndex, HybridIndex
+    if name == "gensim":
+        index_class = GensimIndex
+    elif name == "hybrid":
+        index_class = HybridIndex
+    else:
+        index_class = ElasticSearchIndex
+
+    try:
+        print("Loading index...")
+        return index_class.load_latest()
+    except FileNotFoundError:
+        pass
+
+    if index_class is ElasticSearchIndex:
+        index = ElasticSearchIndex()
+    else:
+        from .tokenizer import SciSpacyTokenizer
+        if index_class is GensimIndex:
+            index = GensimIndex(SciSpacyTokenizer())
+        else:
+            index = HybridIndex(ElasticSearchIndex(), GensimIndex(SciSpacyTokenizer()))
+    index.init()
+    return index
+
+class IndexLoader():
+    """
+    Creates and warms up an index in a background thread, so a web server can
+    start accepting requests before the index is ready.
+
+    Warm-up is retried every retry_interval seconds until it succeeds, e.g.
+    while Elastic Search is still starting.
+
+    Attributes:
+        name (str) : backend passed to create_index
+        state (str) : "starting", "loading", "warming up" or "ready"
+        error (str) : last error, or None
+    """
+    def __init__(self, name, retry_interval=5.0):
+        self.name = name
+        self.retry_interval = retry_interval
+        self.state = "starting"
+        self.error = None
+        self.started = time.time()
+        self.ready_after = None
+        self._index = None
+        self._ready = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                if self._index is None:
+                    self.state = "loading"
+                    self._index = create_index(self.name)
+                self.state = "warming up"
+                self._index.warm_up()
+            except Exception as err:
+                self.error = repr(err)
+                print("Index not ready, retrying in {}s: {}".format(
+                    self.retry_interval, self.error))
+                time.sleep(self.retry_interval)
+                continue
+            break
+        self.error = None
+        self.state = "ready"
+        self.ready_after = time.time() - self.started
+        print("Index ready after {:.1f}s".format(self.ready_after))
+        self._ready.set()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def get(self, timeout=None):
+        """
+        Returns:
+            the index once it is ready, or None if it is not ready within timeout seconds
+        """
+        if self._ready.wait(timeout):
+            return self._index
+        return None
+
+    def status(self):
+        return {
+            "backend": self.name,
+            "state": self.state,
+            "ready": self.ready,
+            "error": self.error,
+            "ready_after": self.ready_after
+        }
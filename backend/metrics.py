@@ -0,0 +1,200 @@
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Structured span records, one JSON object per line
+logger = logging.getLogger("covidqa.trace")
+
+# Seconds, from sub-millisecond cache hits up to requests that hit every deadline
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+        .replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class Counter():
+    """
+    Monotonically increasing value, one per combination of label values.
+    """
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels[name]) for name in self.labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name + "_total", _format_labels(self.labels, key), value
+
+class Histogram():
+    """
+    Distribution of observed values over fixed buckets, one per combination
+    of label values. Quantiles such as p99 are computed by Prometheus from
+    the bucket counts.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> [bucket counts..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        pos = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            if pos < len(self.buckets):
+                state[pos] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(state)) for key, state in self._values.items())
+        for key, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                yield (self.name + "_bucket",
+                    _format_labels(self.labels, key, [("le", _format_value(bound))]),
+                    cumulative)
+            yield (self.name + "_bucket",
+                _format_labels(self.labels, key, [("le", "+Inf")]), state[-1])
+            yield self.name + "_sum", _format_labels(self.labels, key), state[-2]
+            yield self.name + "_count", _format_labels(self.labels, key), state[-1]
+
+class Registry():
+    """
+    Collection of metrics of this process, rendered in the Prometheus text
+    format. Each process has its own values, so run one web server process
+    per scrape target or sum across processes in Prometheus.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("Metric {} already registered as {}".format(name, metric.kind))
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get_or_create(Counter, name, help, labels=labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help, labels=labels, buckets=buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, labels, _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_metrics(port, host="0.0.0.0"):
+    """
+    Serve REGISTRY on every path from a daemon thread, for processes such as
+    the crawler that do not run the Flask app.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+QUERY_STAGE_SECONDS = REGISTRY.histogram(
+    "covidqa_query_stage_seconds",
+    "Time spent in each stage of answering a query",
+    labels=("stage",)
+)
+QUERY_STAGE_ERRORS = REGISTRY.counter(
+    "covidqa_query_stage_errors",
+    "Query stages that raised an exception or were cancelled",
+    labels=("stage",)
+)
+
+@contextmanager
+def span(stage, **fields):
+    """
+    Time a stage of a query. The duration is added to QUERY_STAGE_SECONDS
+    and logged as a JSON line together with fields.
+
+    Example:
+        with span("es_search", backend="elasticsearch"):
+            resp = es.search(...)
+    """
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as err:
+        error = err
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        QUERY_STAGE_SECONDS.observe(elapsed, stage=stage)
+        if error is not None:
+            QUERY_STAGE_ERRORS.inc(stage=stage)
+        if logger.isEnabledFor(logging.INFO):
+            record = {"span": stage, "ms": round(elapsed * 1000, 3)}
+            record.update(fields)
+            if error is not None:
+                record["error"] = type(error).__name__
+            logger.info(json.dumps(record, default=str))
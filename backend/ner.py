@@ -1,18 +1,415 @@
-from pymetamap import MetaMap, Concept
+from pymetamap import Concept
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from .utils import CONFIG
 import os
+import json
+import sqlite3
+import asyncio
+import select
+import threading
+import subprocess
 
 class NERPipeline():
     def __call__(self, text):
         """Run text through pipeline"""
         raise NotImplementedError
 
+class MetamapProcess():
+    """
+    MetaMap kept running in interactive mode and fed over its stdin.
+
+    pymetamap starts a new MetaMap for every extract_concepts call, which
+    loads the program and its data files again each time. This keeps a
+    single process and only pays for that once. Inputs are sent one per line
+    as "id|text" (--sldiID), so every line is a citation of its own, and
+    answered with fielded MMI lines (-N). With --indicate_citation_end the
+    output of every citation ends with an END_MARKER line, whether or not
+    concepts were found, so a request is complete once one marker per input
+    has been read.
+
+    If MetaMap exits, or prints nothing for read_timeout seconds, it is
+    killed, the request fails and the next one starts a new process.
+
+    Attributes:
+        mm_path (str) : path to the metamap executable
+        read_timeout (float) : max seconds to wait for the next line of output
+        options (list[str]) : command line options of MetaMap
+    """
+    END_MARKER = "'EOT'."
+
+    def __init__(self, mm_path, read_timeout=60.0,
+            options=("-N", "--sldiID", "--indicate_citation_end", "--silent")):
+        self.mm_path = mm_path
+        self.read_timeout = read_timeout
+        self.options = list(options)
+        self._process = None
+        self._buffer = b""
+
+    def _start(self):
+        if self._process is None or self._process.poll() is not None:
+            self.close()
+            self._process = subprocess.Popen([self.mm_path] + self.options,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL)
+        return self._process
+
+    @staticmethod
+    def _clean(text):
+        # MetaMap only accepts ASCII, and line breaks and "|" would split the input
+        text = text.encode("ascii", "ignore").decode("ascii")
+        return " ".join(text.replace("|", " ").split())
+
+    def _write(self, process, data):
+        # Runs in its own thread: MetaMap answers while it reads, so writing
+        # a large request before reading could fill both pipes and deadlock
+        try:
+            process.stdin.write(data)
+            process.stdin.flush()
+        except (OSError, ValueError):
+            # The process was killed, which the reader reports
+            pass
+
+    def _readline(self, process):
+        """ Return the next line of output, waiting at most read_timeout seconds for it """
+        fd = process.stdout.fileno()
+        while b"\n" not in self._buffer:
+            if not select.select([fd], [], [], self.read_timeout)[0]:
+                raise TimeoutError("MetaMap printed nothing for {}s".format(self.read_timeout))
+            data = os.read(fd, 65536)
+            if not data:
+                raise RuntimeError("MetaMap exited with status {}".format(process.wait()))
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return line.decode("ascii", "replace")
+
+    def extract_concepts(self, sentences, ids=None):
+        """
+        Same interface as pymetamap's MetaMap.extract_concepts.
+        Returns:
+            (list of ConceptMMI, error) where error is always None
+        Raises:
+            RuntimeError if MetaMap exited before answering
+            TimeoutError if MetaMap stopped answering
+        """
+        if not sentences:
+            return [], None
+        ids = [str(i) for i in ids] if ids is not None else \
+            [str(i) for i in range(len(sentences))]
+        process = self._start()
+        data = "".join("{}|{}\n".format(i, self._clean(text))
+            for i, text in zip(ids, sentences)).encode("ascii")
+        writer = threading.Thread(target=self._write, args=(process, data), daemon=True)
+        writer.start()
+        concepts = []
+        remaining = len(sentences)
+        try:
+            while remaining:
+                line = self._readline(process)
+                if line.strip() == MetamapProcess.END_MARKER:
+                    remaining -= 1
+                    continue
+                fields = line.split("|")
+                if len(fields) > 4 and fields[1] == "MMI":
+                    concepts.append(Concept.ConceptMMI.from_mmi(line))
+        except (OSError, RuntimeError, TimeoutError):
+            # Unread output of this request would be taken for the next one's
+            self.close()
+            raise
+        finally:
+            writer.join()
+        return concepts, None
+
+    def close(self):
+        if self._process is not None:
+            if self._process.poll() is None:
+                self._process.kill()
+            self._process.wait()
+            for pipe in (self._process.stdin, self._process.stdout):
+                try:
+                    pipe.close()
+                except OSError:
+                    # Buffered input cannot be flushed to an exited process
+                    pass
+            self._process = None
+        self._buffer = b""
+
+# MetaMap process owned by each worker process of MetamapPool and MetamapAnnotator
+_worker_mm = None
+
+def _init_worker(mm_path):
+    global _worker_mm
+    _worker_mm = MetamapProcess(mm_path, CONFIG["MM_READ_TIMEOUT"])
+
+def _extract_concepts(texts, ids=None):
+    """ Run texts through the worker's MetaMap, leaving out abbreviation entries (ConceptAA) which have no CUI """
+    concepts, _ = _worker_mm.extract_concepts(texts, ids)
+    return [c for c in concepts if hasattr(c, "cui")]
+
+def _extract_cuis(text):
+    return [c.cui for c in _extract_concepts([text])]
+
+def _extract_cuis_many(texts):
+    # One MetaMap run for all texts; concepts carry the id of their text
+    cuis = [[] for _ in texts]
+    for c in _extract_concepts(texts, ids=list(range(len(texts)))):
+        cuis[int(c.index)].append(c.cui)
+    return cuis
+
+class MetamapCache():
+    """
+    Disk-backed cache from normalized text to list of CUIs, stored in sqlite
+    so it survives restarts and is shared by every process on the machine.
+    """
+    def __init__(self, path):
+        dir_path = os.path.dirname(path)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS concepts (text TEXT PRIMARY KEY, cuis TEXT)"
+            )
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.lower().split())
+
+    def get(self, text):
+        """ Return cached CUIs for normalized text or None if not cached """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT cuis FROM concepts WHERE text = ?", (text,)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, text, cuis):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO concepts (text, cuis) VALUES (?, ?)",
+                (text, json.dumps(cuis))
+            )
+
+class MetamapPool():
+    """
+    Pool of long-lived worker processes that each hold a MetaMap instance.
+
+    At most queue_size requests can be pending at once. Requests beyond that,
+    and requests that take longer than timeout seconds, return None so the
+    caller can fall back instead of blocking. When a worker dies the pool
+    breaks, and it is replaced by a new one on the next request.
+    """
+    def __init__(self, mm_path, workers=4, queue_size=32, timeout=2.0):
+        self.mm_path = mm_path
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Start workers on first use so that importing or forking stays cheap
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    initializer=_init_worker,
+                    initargs=(self.mm_path,)
+                )
+            return self._executor
+
+    def _discard(self, executor):
+        """ Drop a broken executor, unless it was already replaced """
+        with self._lock:
+            if self._executor is executor:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def _submit(self, fn, arg, callback):
+        if not self._slots.acquire(blocking=False):
+            return None
+        try:
+            try:
+                executor = self._get_executor()
+                future = executor.submit(fn, arg)
+            except BrokenProcessPool:
+                # A worker died since the last request, so start a new pool
+                self._discard(executor)
+                executor = self._get_executor()
+                future = executor.submit(fn, arg)
+        except Exception:
+            self._slots.release()
+            raise
+
+        def done(future):
+            self._slots.release()
+            if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+                self._discard(executor)
+        future.add_done_callback(done)
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def submit(self, text, callback=None):
+        """
+        Queue text for concept extraction.
+        Returns:
+            Future of list of CUIs, or None if the queue is full
+        """
+        return self._submit(_extract_cuis, text, callback)
+
+    def submit_many(self, texts, callback=None):
+        """
+        Queue texts for concept extraction in a single MetaMap run.
+        Returns:
+            Future of list of CUI lists in the order of texts, or None if the queue is full
+        """
+        return self._submit(_extract_cuis_many, texts, callback)
+
+    def __call__(self, text, timeout=None):
+        """
+        Returns:
+            list of CUIs, or None if MetaMap could not answer in time or failed
+        """
+        try:
+            future = self.submit(text)
+            if future is None:
+                return None
+            return future.result(timeout=timeout or self.timeout)
+        except TimeoutError:
+            return None
+        except Exception as err:
+            print("MetaMap failed:", repr(err))
+            return None
+
+    def warm_up(self, timeout=None):
+        """
+        Start the workers and wait until each has loaded MetaMap, so the
+        first queries do not pay for it.
+        """
+        executor = self._get_executor()
+        futures = [executor.submit(_extract_cuis, "covid") for _ in range(self.workers)]
+        for future in futures:
+            try:
+                future.result(timeout=timeout)
+            except TimeoutError:
+                return
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
 class Metamap(NERPipeline):
-    
+
     def __init__(self):
-        self.mm = MetaMap.get_instance(os.path.abspath(CONFIG["MM_PATH"]))
-    
+        self.cache = MetamapCache(CONFIG["SAVE_DIR"] + "/metamap/concepts.sqlite")
+        self.pool = MetamapPool(
+            os.path.abspath(CONFIG["MM_PATH"]),
+            workers=CONFIG["MM_WORKERS"],
+            queue_size=CONFIG["MM_QUEUE_SIZE"],
+            timeout=CONFIG["MM_TIMEOUT"]
+        )
+
+    def _submit(self, text):
+        """
+        Returns:
+            (cached CUIs, None) on a cache hit, otherwise (None, future of CUIs),
+            where the future is None if the pool is busy or could not be started
+        """
+        key = MetamapCache.normalize(text)
+        cuis = self.cache.get(key)
+        if cuis is not None:
+            return cuis, None
+
+        def store(future):
+            # Cache late answers too, so the next identical query is a hit
+            if not future.cancelled() and future.exception() is None:
+                self.cache.put(key, future.result())
+
+        try:
+            return None, self.pool.submit(text, callback=store)
+        except Exception as err:
+            print("MetaMap failed:", repr(err))
+            return None, None
+
     def __call__(self, text):
-        concepts, _ = self.mm.extract_concepts([text])
-        return [c.cui for c in concepts]
+        """
+        Returns:
+            list of CUIs found in text. Empty if MetaMap is too slow, busy or
+            failed, so the query degrades to plain text search.
+        """
+        cuis, future = self._submit(text)
+        if cuis is not None:
+            return cuis
+        if future is None:
+            return []
+        try:
+            return future.result(timeout=self.pool.timeout)
+        except TimeoutError:
+            return []
+        except Exception as err:
+            print("MetaMap failed:", repr(err))
+            return []
+
+    def extract_many(self, texts, timeout=None):
+        """
+        Batch version of __call__ that runs every uncached text through
+        MetaMap at once.
+        Returns:
+            list of CUI lists in the order of texts, with None for texts
+            MetaMap could not answer within timeout seconds or failed on
+        """
+        keys = [MetamapCache.normalize(text) for text in texts]
+        results = [self.cache.get(key) for key in keys]
+        misses = [i for i, cuis in enumerate(results) if cuis is None]
+        if not misses:
+            return results
+
+        def store(future):
+            if not future.cancelled() and future.exception() is None:
+                for i, cuis in zip(misses, future.result()):
+                    self.cache.put(keys[i], cuis)
+
+        extracted = None
+        try:
+            future = self.pool.submit_many([texts[i] for i in misses], callback=store)
+            if future is not None:
+                extracted = future.result(timeout=timeout or self.pool.timeout)
+        except TimeoutError:
+            pass
+        except Exception as err:
+            print("MetaMap failed:", repr(err))
+        for n, i in enumerate(misses):
+            results[i] = extracted[n] if extracted is not None else None
+        return results
 
+    async def extract_async(self, text, timeout=None):
+        """
+        Coroutine version of __call__ that waits at most timeout seconds
+        without blocking the event loop.
+        Returns:
+            list of CUIs, or None if MetaMap is too slow, busy or failed, so
+            callers can tell a degraded answer from a text without concepts
+        """
+        cuis, future = self._submit(text)
+        if cuis is not None:
+            return cuis
+        if future is None:
+            return None
+        try:
+            # Shield the request so that it still finishes and gets cached
+            return await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(future)),
+                timeout or self.pool.timeout
+            )
+        except asyncio.TimeoutError:
+            return None
+        except Exception as err:
+            print("MetaMap failed:", repr(err))
+            return None
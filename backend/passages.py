@@ -0,0 +1,68 @@
+def _windows(words, max_words, overlap):
+    """ Split a list of words into windows of max_words that overlap by overlap words """
+    step = max(max_words - overlap, 1)
+    return [words[start:start + max_words]
+        for start in range(0, max(len(words) - overlap, 1), step)]
+
+def split_passages(doc, max_words=200, overlap=50):
+    """
+    Split the content of a document into passages along paragraph boundaries.
+
+    Short paragraphs of the same field are merged up to max_words, and
+    paragraphs longer than that are cut into windows of max_words that
+    overlap by overlap words, so a sentence on a boundary is whole in one
+    of them.
+    Args:
+        doc (Document) : document to split
+        max_words (int) : max number of words per passage
+        overlap (int) : words shared by consecutive windows of a long paragraph
+    Returns:
+        list of (content field, passage text) in document order
+    """
+    passages = []
+    for field, text in doc.content.items():
+        # Skip derived fields such as the list of concepts
+        if type(text) is not str:
+            continue
+        current = []
+        for paragraph in text.split("\n"):
+            words = paragraph.split()
+            if not words:
+                continue
+            if current and len(current) + len(words) > max_words:
+                passages.append((field, " ".join(current)))
+                current = []
+            if len(words) > max_words:
+                for window in _windows(words, max_words, overlap):
+                    passages.append((field, " ".join(window)))
+                continue
+            current += words
+        if current:
+            passages.append((field, " ".join(current)))
+    return passages
+
+def passage_id(paper_id, position):
+    return "{}-{}".format(paper_id, position)
+
+def to_passages(doc, max_words=200, overlap=50):
+    """
+    Build the passage index entries of a document. Every passage carries
+    what is needed to display its paper as a result, so search results do
+    not need another round trip to the paper index.
+    Returns:
+        list of (passage id, source dict)
+    """
+    metadata = {key: doc.metadata[key] for key in ("authors", "url") if key in doc.metadata}
+    concepts = doc.content.get("concepts", [])
+    entries = []
+    for position, (field, text) in enumerate(split_passages(doc, max_words, overlap)):
+        entries.append((passage_id(doc.id, position), {
+            "paper_id": doc.id,
+            "position": position,
+            "field": field,
+            "text": text,
+            "title": doc.title,
+            "metadata": metadata,
+            "concepts": concepts
+        }))
+    return entries
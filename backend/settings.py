@@ -0,0 +1,14 @@
+import os
+import json
+from os.path import dirname as parent
+
+# Kept free of heavy imports so that reading the configuration is cheap,
+# e.g. for the web app before any backend is loaded
+project_path = parent(parent(os.path.realpath(__file__)))
+config_path = project_path + "/config.json"
+
+with open(config_path) as fp:
+    CONFIG = json.load(fp)
+
+CONFIG["DATA_DIR"] = project_path + "/" + CONFIG["DATA_DIR"]
+CONFIG["SAVE_DIR"] = project_path + "/" + CONFIG["SAVE_DIR"]
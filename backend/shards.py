@@ -0,0 +1,139 @@
+import os
+import threading
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# Shard indexes memory-mapped by this process, by path, with the file's
+# modification time so shards rewritten by an update are mapped again
+_shard_indexes = {}
+
+def _top_positions(scores, k):
+    """
+    Return positions of the k best scores, best first. Ties are broken by
+    position like heapq.nlargest, so merging per-shard top-k gives the same
+    result as a top-k over all scores.
+    """
+    if len(scores) > k:
+        threshold = -np.partition(-scores, k - 1)[k - 1]
+        above = np.flatnonzero(scores > threshold)
+        tied = np.flatnonzero(scores == threshold)[:k - len(above)]
+        positions = np.sort(np.concatenate([above, tied]))
+    else:
+        positions = np.arange(len(scores))
+    return positions[np.argsort(-scores[positions], kind="stable")]
+
+def _shard_index(shard):
+    path = shard.fullname()
+    mtime = os.stat(path).st_mtime_ns
+    cached = _shard_indexes.get(path)
+    if cached is None or cached[0] != mtime:
+        # Large arrays are stored next to the shard file and mapped read-only,
+        # so every process shares one copy of them in the page cache
+        cached = _shard_indexes[path] = (mtime, shard.cls.load(path, mmap="r"))
+    return cached[1]
+
+def _score_shard(shard, offset, queries, k, norm):
+    """
+    Returns:
+        (positions, scores) arrays of the k best documents of the shard for
+        every query, positions counted from the start of the whole index
+    """
+    index = _shard_index(shard)
+    index.num_best = None
+    index.normalize = norm
+    scores = np.atleast_2d(index[queries])
+    results = []
+    for row in scores:
+        positions = _top_positions(row, k)
+        results.append((positions + offset, row[positions]))
+    return results
+
+class ShardedIndex():
+    """
+    Top-k search over the shards of a gensim similarities.Similarity, with
+    the shards scored in parallel by a pool of worker processes.
+
+    Each worker maps the shard files read-only on first use, so they are
+    loaded once per machine through the page cache rather than once per
+    process. Every shard returns its own top-k and only those are merged,
+    so little data crosses process boundaries. Indexes with a single shard,
+    or machines with a single core, are scored in the calling process.
+
+    Attributes:
+        similarity (similarities.Similarity) : index whose shards are searched
+        workers (int) : number of worker processes
+    """
+    def __init__(self, similarity, workers=4):
+        self.similarity = similarity
+        # More workers than cores only adds inter-process overhead
+        self.workers = min(workers, os.cpu_count() or 1)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.similarity)
+
+    def _get_executor(self):
+        # Started on first use, and again in a forked child whose copy of the
+        # executor refers to the parent's workers
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _search(self, queries, k):
+        """ Returns per-query lists of (position, score), best first """
+        # Documents added since the last save are only searchable once in a shard
+        self.similarity.close_shard()
+        shards = self.similarity.shards
+        offsets = np.cumsum([0] + [len(shard) for shard in shards[:-1]])
+        tasks = [(shard, int(offset), queries, k, self.similarity.norm)
+            for shard, offset in zip(shards, offsets)]
+        if self.workers > 1 and len(shards) > 1:
+            executor = self._get_executor()
+            futures = [executor.submit(_score_shard, *task) for task in tasks]
+            shard_results = [future.result() for future in futures]
+        else:
+            shard_results = [_score_shard(*task) for task in tasks]
+
+        results = []
+        for i in range(len(queries)):
+            # Shards are in index order, so ties still go to the lower position
+            positions = np.concatenate([shard[i][0] for shard in shard_results]
+                or [np.zeros(0, dtype=np.int64)])
+            scores = np.concatenate([shard[i][1] for shard in shard_results]
+                or [np.zeros(0, dtype=np.float32)])
+            best = _top_positions(scores, k)
+            results.append(list(zip(positions[best].tolist(), scores[best].tolist())))
+        return results
+
+    def topk(self, query, k=100):
+        """
+        Args:
+            query (list[tuple[int, float]]) : sparse query vector
+            k (int) : number of results
+        Returns:
+            list of (row number, similarity), best first
+        """
+        return self._search([query], k)[0]
+
+    def topk_many(self, queries, k=100):
+        """ Top-k of many queries with one task per shard for the whole batch """
+        if not queries:
+            return []
+        return self._search(queries, k)
+
+    def add_documents(self, vectors):
+        self.similarity.add_documents(vectors)
+
+    def save(self, path):
+        self.similarity.save(path)
+
+    def close(self):
+        """ Stop the worker processes """
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,253 @@
+import os
+import json
+import shutil
+import numpy as np
+import scipy.sparse as sp
+
+class _Segment():
+    """
+    CSR postings of a range of documents, memory-mapped from path.
+
+    Files:
+        indptr.npy : start of the postings of every term in docs/weights
+        docs.npy : document row numbers, sorted within each term
+        weights.npy : weight of the term in each document
+        max_weights.npy : largest weight of every term in this segment
+    """
+    def __init__(self, path):
+        self.path = path
+        self.indptr = np.load(path + "/indptr.npy", mmap_mode="r")
+        self.docs = np.load(path + "/docs.npy", mmap_mode="r")
+        self.weights = np.load(path + "/weights.npy", mmap_mode="r")
+        self.max_weights = np.load(path + "/max_weights.npy")
+
+    def postings(self, term):
+        start, end = self.indptr[term], self.indptr[term + 1]
+        return self.docs[start:end], self.weights[start:end]
+
+    @staticmethod
+    def build(path, vectors, num_terms, first_row):
+        """
+        Write postings of vectors, numbering documents from first_row.
+        Vectors are read twice, so they must be re-iterable, e.g. a gensim
+        TransformedCorpus over an MmCorpus.
+        Returns:
+            number of documents written
+        """
+        os.makedirs(path)
+
+        # First pass: document frequency of every term
+        df = np.zeros(num_terms, dtype=np.int64)
+        count = 0
+        for vec in vectors:
+            if vec:
+                terms = np.fromiter((term for term, _ in vec), dtype=np.int64, count=len(vec))
+                df[terms] += 1
+            count += 1
+
+        indptr = np.zeros(num_terms + 1, dtype=np.int64)
+        np.cumsum(df, out=indptr[1:])
+        nnz = int(indptr[-1])
+        max_weights = np.zeros(num_terms, dtype=np.float32)
+        np.save(path + "/indptr.npy", indptr)
+        if nnz == 0:
+            # Empty files cannot be memory-mapped for writing
+            np.save(path + "/docs.npy", np.zeros(0, dtype=np.int32))
+            np.save(path + "/weights.npy", np.zeros(0, dtype=np.float32))
+            np.save(path + "/max_weights.npy", max_weights)
+            return count
+        docs = np.lib.format.open_memmap(path + "/docs.npy", mode="w+",
+            dtype=np.int32, shape=(nnz,))
+        weights = np.lib.format.open_memmap(path + "/weights.npy", mode="w+",
+            dtype=np.float32, shape=(nnz,))
+
+        # Second pass: documents arrive in row order, so postings stay sorted
+        cursor = indptr[:-1].copy()
+        for row, vec in enumerate(vectors, first_row):
+            if not vec:
+                continue
+            terms = np.fromiter((term for term, _ in vec), dtype=np.int64, count=len(vec))
+            values = np.fromiter((value for _, value in vec), dtype=np.float32, count=len(vec))
+            positions = cursor[terms]
+            docs[positions] = row
+            weights[positions] = values
+            cursor[terms] += 1
+            np.maximum.at(max_weights, terms, values)
+
+        docs.flush()
+        weights.flush()
+        del docs, weights
+        np.save(path + "/max_weights.npy", max_weights)
+        return count
+
+class InvertedIndex():
+    """
+    Inverted index over TF-IDF vectors with MaxScore top-k retrieval.
+
+    Postings are stored per term in CSR form together with the largest
+    weight of each term. Query terms are processed from the highest upper
+    bound down. Once the k-th best score is at least the sum of the bounds of
+    the remaining terms, no unseen document can enter the top k, so the
+    remaining postings are only probed for the current candidates. Query cost
+    therefore depends on the postings touched, not on the corpus size.
+
+    Documents added after the build go to new segments, one per call to
+    add_documents.
+
+    Attributes:
+        path (str) : directory holding meta.json and one directory per segment
+        num_terms (int) : size of the vocabulary
+        count (int) : number of documents
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path + "/meta.json", "r") as fp:
+            self.meta = json.load(fp)
+        self.num_terms = self.meta["num_terms"]
+        self.count = self.meta["count"]
+        self.segments = [_Segment(path + "/" + name) for name in self.meta["segments"]]
+        self.max_weights = np.zeros(self.num_terms, dtype=np.float32)
+        for segment in self.segments:
+            np.maximum(self.max_weights, segment.max_weights, out=self.max_weights)
+
+    def __len__(self):
+        return self.count
+
+    def _write_meta(self):
+        tmp_path = self.path + "/meta.json.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(self.meta, fp)
+        os.replace(tmp_path, self.path + "/meta.json")
+
+    def add_documents(self, vectors):
+        """ Add TF-IDF vectors of new documents as a new segment """
+        vectors = list(vectors)
+        name = "segment-" + str(len(self.meta["segments"]))
+        count = _Segment.build(self.path + "/" + name, vectors, self.num_terms, self.count)
+        self.meta["segments"].append(name)
+        self.meta["count"] += count
+        self._write_meta()
+        self.__init__(self.path)
+
+    def postings(self, term):
+        """ Return document rows and weights of term across all segments """
+        if len(self.segments) == 1:
+            return self.segments[0].postings(term)
+        docs, weights = zip(*[segment.postings(term) for segment in self.segments])
+        return np.concatenate(docs), np.concatenate(weights)
+
+    def topk(self, query, k=100):
+        """
+        Args:
+            query (list[tuple[int, float]]) : TF-IDF vector of the query
+            k (int) : number of results
+        Returns:
+            list of (row number, score), best first
+        """
+        terms = [(term, weight, weight * float(self.max_weights[term]))
+            for term, weight in query if term < self.num_terms]
+        terms = [term for term in terms if term[2] > 0]
+        terms.sort(key=lambda term: term[2], reverse=True)
+
+        # remaining[i] bounds the score a document can still gain from terms i onwards
+        remaining = np.cumsum([bound for _, _, bound in terms][::-1])[::-1].tolist() + [0.0]
+
+        cand_docs = np.zeros(0, dtype=np.int64)
+        cand_scores = np.zeros(0, dtype=np.float32)
+        for i, (term, weight, _) in enumerate(terms):
+            docs, weights = self.postings(term)
+            threshold = None
+            if len(cand_scores) >= k:
+                threshold = np.partition(cand_scores, len(cand_scores) - k)[len(cand_scores) - k]
+
+            if threshold is not None and threshold >= remaining[i]:
+                # Drop candidates that cannot reach the top k any more, then
+                # only probe this term's postings for the ones that are left
+                keep = cand_scores + remaining[i] >= threshold
+                cand_docs, cand_scores = cand_docs[keep], cand_scores[keep]
+                if len(docs) == 0:
+                    continue
+                positions = np.searchsorted(docs, cand_docs)
+                positions[positions == len(docs)] = 0
+                match = docs[positions] == cand_docs
+                cand_scores[match] += weight * weights[positions[match]]
+            else:
+                all_docs = np.concatenate([cand_docs, docs])
+                all_scores = np.concatenate([cand_scores, weight * weights])
+                cand_docs, inverse = np.unique(all_docs, return_inverse=True)
+                cand_scores = np.bincount(inverse, weights=all_scores).astype(np.float32)
+
+        if len(cand_scores) > k:
+            best = np.argpartition(-cand_scores, k - 1)[:k]
+            cand_docs, cand_scores = cand_docs[best], cand_scores[best]
+        order = np.argsort(-cand_scores)
+        return list(zip(cand_docs[order].tolist(), cand_scores[order].tolist()))
+
+    def topk_many(self, queries, k=100):
+        """
+        Exact top-k of many queries with one sparse matrix product between
+        the queries and the postings of the terms they use.
+        Args:
+            queries (list[list[tuple[int, float]]]) : TF-IDF vectors of the queries
+            k (int) : number of results per query
+        Returns:
+            list of topk results in the order of queries
+        """
+        terms = sorted(set(term for query in queries for term, _ in query
+            if term < self.num_terms))
+        columns = {term: i for i, term in enumerate(terms)}
+
+        # Queries as rows over the used terms
+        rows, cols, values = [], [], []
+        for row, query in enumerate(queries):
+            for term, weight in query:
+                if term in columns:
+                    rows.append(row)
+                    cols.append(columns[term])
+                    values.append(weight)
+        query_matrix = sp.csr_matrix((values, (rows, cols)),
+            shape=(len(queries), len(terms)), dtype=np.float32)
+
+        # Postings of the used terms as rows over documents
+        indptr = [0]
+        docs = []
+        weights = []
+        for term in terms:
+            term_docs, term_weights = self.postings(term)
+            docs.append(term_docs)
+            weights.append(term_weights)
+            indptr.append(indptr[-1] + len(term_docs))
+        postings = sp.csr_matrix((
+            np.concatenate(weights) if weights else np.zeros(0, dtype=np.float32),
+            np.concatenate(docs) if docs else np.zeros(0, dtype=np.int32),
+            np.array(indptr, dtype=np.int64)
+        ), shape=(len(terms), max(len(self), 1)))
+
+        scores = (query_matrix @ postings).tocsr()
+        results = []
+        for row in range(len(queries)):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            row_docs = scores.indices[start:end]
+            row_scores = scores.data[start:end]
+            keep = row_scores > 0
+            row_docs, row_scores = row_docs[keep], row_scores[keep]
+            if len(row_scores) > k:
+                best = np.argpartition(-row_scores, k - 1)[:k]
+                row_docs, row_scores = row_docs[best], row_scores[best]
+            order = np.argsort(-row_scores)
+            results.append(list(zip(row_docs[order].tolist(), row_scores[order].tolist())))
+        return results
+
+    @staticmethod
+    def build(path, vectors, num_terms):
+        """
+        Build an index at path from re-iterable TF-IDF vectors, removing any existing one
+        """
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        count = _Segment.build(path + "/segment-0", vectors, num_terms, 0)
+        with open(path + "/meta.json", "w") as fp:
+            json.dump({"num_terms": num_terms, "count": count,
+                "segments": ["segment-0"]}, fp)
+        return InvertedIndex(path)
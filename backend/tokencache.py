@@ -0,0 +1,206 @@
+import os
+import time
+import sqlite3
+import hashlib
+from array import array
+from itertools import islice
+from .metrics import REGISTRY
+
+TOKENIZED_DOCS = REGISTRY.counter(
+    "covidqa_tokenized_docs",
+    "Documents tokenized for the Gensim index, by token cache result",
+    labels=("cache",)
+)
+TOKENIZE_SECONDS = REGISTRY.counter(
+    "covidqa_tokenize_seconds",
+    "Time spent running cache misses through the tokenizer"
+)
+
+class TokenCache():
+    """
+    Persistent cache of tokenized documents.
+
+    Each document is stored under its id together with a hash of the text it
+    was tokenized from, so edited documents are tokenized again. Tokens are
+    kept as arrays of uint32 ids into a vocabulary table instead of lists of
+    strings.
+
+    Attributes:
+        path (str) : path of the sqlite database
+        token2id (dict[str, int]) : vocabulary of the cache
+        id2token (list[str]) : inverse of token2id
+    """
+    def __init__(self, path):
+        self.path = path
+        dir_path = os.path.dirname(path)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS vocab (id INTEGER PRIMARY KEY, token TEXT UNIQUE)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, hash TEXT, tokens BLOB)"
+            )
+        self.id2token = []
+        self.token2id = {}
+        self._load_vocab()
+
+    @staticmethod
+    def content_hash(doc):
+        return hashlib.sha1(doc.text.encode("utf-8")).hexdigest()
+
+    def _load_vocab(self):
+        """
+        Read vocabulary entries added since the last load, including those
+        added by other processes sharing the database.
+        """
+        rows = self._conn.execute(
+            "SELECT id, token FROM vocab WHERE id >= ? ORDER BY id", (len(self.id2token),))
+        for token_id, token in rows:
+            self.token2id[token] = token_id
+            self.id2token.append(token)
+
+    def _encode(self, tokens, new_ids):
+        ids = array("I")
+        for token in tokens:
+            token_id = self.token2id.get(token)
+            if token_id is None:
+                token_id = new_ids[token]
+            ids.append(token_id)
+        return ids.tobytes()
+
+    def _decode(self, blob):
+        ids = array("I")
+        ids.frombytes(blob)
+        if ids and max(ids) >= len(self.id2token):
+            # Written by another process with tokens this one has not loaded
+            self._load_vocab()
+        return [self.id2token[i] for i in ids]
+
+    def get_many(self, keys):
+        """
+        Args:
+            keys (list[tuple[str, str]]) : document ids and content hashes
+        Returns:
+            list of token lists in the order of keys, None where not cached or stale
+        """
+        found = {}
+        ids = [id for id, _ in keys]
+        # Stay under sqlite's limit on query parameters
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            rows = self._conn.execute(
+                "SELECT id, hash, tokens FROM docs WHERE id IN ({})".format(
+                    ",".join("?" * len(batch))),
+                batch
+            )
+            for id, content_hash, blob in rows:
+                found[id] = (content_hash, blob)
+
+        results = []
+        for id, content_hash in keys:
+            entry = found.get(id)
+            if entry is None or entry[0] != content_hash:
+                results.append(None)
+            else:
+                results.append(self._decode(entry[1]))
+        return results
+
+    def iter_tokens(self, ids, batch_size=1000):
+        """
+        Yield cached token lists of ids in order, regardless of content hash,
+        reading batch_size documents at a time.
+        Raises:
+            KeyError if an id is not cached
+        """
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            found = {}
+            # Stay under sqlite's limit on query parameters
+            for sub_start in range(0, len(batch), 500):
+                sub_batch = batch[sub_start:sub_start + 500]
+                rows = self._conn.execute(
+                    "SELECT id, tokens FROM docs WHERE id IN ({})".format(
+                        ",".join("?" * len(sub_batch))),
+                    sub_batch
+                )
+                for id, blob in rows:
+                    found[id] = blob
+            for id in batch:
+                yield self._decode(found[id])
+
+    def put_many(self, items):
+        """
+        Args:
+            items (list[tuple[str, str, list[str]]]) : document ids, content hashes and tokens
+        """
+        new_tokens = list(dict.fromkeys(token for _, _, tokens in items
+            for token in tokens if token not in self.token2id))
+        new_ids = {}
+        with self._conn:
+            # Ids are assigned by sqlite under the write lock, so processes
+            # sharing the database never hand out the same id twice
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO vocab (id, token) "
+                "SELECT COALESCE(MAX(id) + 1, 0), ? FROM vocab",
+                [(token,) for token in new_tokens]
+            )
+            # Stay under sqlite's limit on query parameters
+            for start in range(0, len(new_tokens), 500):
+                batch = new_tokens[start:start + 500]
+                rows = self._conn.execute(
+                    "SELECT id, token FROM vocab WHERE token IN ({})".format(
+                        ",".join("?" * len(batch))),
+                    batch
+                )
+                for token_id, token in rows:
+                    new_ids[token] = token_id
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO docs (id, hash, tokens) VALUES (?, ?, ?)",
+                [(id, content_hash, self._encode(tokens, new_ids))
+                    for id, content_hash, tokens in items]
+            )
+        # Only now that the ids are committed
+        self._load_vocab()
+
+    def tokenize(self, documents, tokenizer, workers=4, batch_size=10000):
+        """
+        Yield token lists of documents in input order, running only
+        documents that are not cached through the tokenizer.
+        Args:
+            documents (iterable[Document]) : documents to tokenize, may be a generator
+            tokenizer (SciSpacyTokenizer) : tokenizer used for cache misses
+            workers (int) : number of tokenizer worker processes
+            batch_size (int) : number of documents looked up in the cache at once
+        """
+        iterator = iter(documents)
+        while True:
+            batch = list(islice(iterator, batch_size))
+            if not batch:
+                return
+            keys = [(doc.id, TokenCache.content_hash(doc)) for doc in batch]
+            tokenized = self.get_many(keys)
+
+            misses = [i for i, tokens in enumerate(tokenized) if tokens is None]
+            TOKENIZED_DOCS.inc(len(batch) - len(misses), cache="hit")
+            if misses:
+                start = time.perf_counter()
+                miss_docs = [batch[i] for i in misses]
+                # Starting worker processes is not worth it for a handful of documents
+                new_tokens = tokenizer.tokenize_stream(
+                    miss_docs, workers if len(miss_docs) > 100 else 1)
+                items = []
+                for i, tokens in zip(misses, new_tokens):
+                    tokenized[i] = tokens
+                    items.append((keys[i][0], keys[i][1], tokens))
+                self.put_many(items)
+                TOKENIZED_DOCS.inc(len(misses), cache="miss")
+                TOKENIZE_SECONDS.inc(time.perf_counter() - start)
+
+            for tokens in tokenized:
+                yield tokens
+
+    def close(self):
+        self._conn.close()
@@ -1,83 +1,156 @@
 import scispacy
 import spacy
 from .utils import pip_install
-from itertools import chain 
+from itertools import islice
+from collections import deque
 import multiprocessing as mp
 
 class Tokenizer():
 
     def __call__(self, text):
         raise NotImplementedError()
-        
+
+    def tokenize_texts(self, texts):
+        """ Tokenize a batch of texts, returning one list of tokens per text """
+        return [self(text) for text in texts]
+
+    def close(self):
+        """ Release resources such as worker processes """
+        pass
+
+# Tokenizer owned by each worker process of SciSpacyTokenizer.tokenize_stream.
+# It is created once by the pool initializer, so the model is loaded once per worker.
+_worker_tokenizer = None
+
+def _init_worker(batch_size):
+    global _worker_tokenizer
+    _worker_tokenizer = SciSpacyTokenizer(batch_size)
+
+def _tokenize_chunk(texts):
+    return _worker_tokenizer.tokenize_texts(texts)
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
 class SciSpacyTokenizer(Tokenizer):
     MODEL_NAME = "en_core_sci_md"
     MODEL_URL = "https://s3-us-west-2.amazonaws.com/ai2-s2-scispacy/releases/v0.2.4/en_core_sci_md-0.2.4.tar.gz"
     MAX_LENGTH = 2000000
-    
-    def __init__(self):
+    # Lemmas come from the tagger and stop words are lexical,
+    # so the parser and NER only cost time
+    DISABLE = ["parser", "ner"]
+
+    def __init__(self, batch_size=32):
+        """
+        Args:
+            batch_size (int) : number of texts spaCy processes together in nlp.pipe
+        """
+        self.batch_size = batch_size
         try:
-            self.model = spacy.load(SciSpacyTokenizer.MODEL_NAME)
+            self.model = spacy.load(SciSpacyTokenizer.MODEL_NAME,
+                disable=SciSpacyTokenizer.DISABLE)
         except OSError:
             pip_install(SciSpacyTokenizer.MODEL_URL)
-            self.model = spacy.load(SciSpacyTokenizer.MODEL_NAME)
+            self.model = spacy.load(SciSpacyTokenizer.MODEL_NAME,
+                disable=SciSpacyTokenizer.DISABLE)
 
         self.model.max_length = SciSpacyTokenizer.MAX_LENGTH
+        self._pool = None
+        self._pool_workers = 0
+
+    def _get_pool(self, workers):
+        # Every worker loads the model when it starts, so the pool is kept
+        # between calls until close, e.g. across the batches of an index build
+        if self._pool is None or self._pool_workers != workers:
+            self.close()
+            self._pool = mp.Pool(
+                processes=workers,
+                initializer=_init_worker,
+                initargs=(self.batch_size,)
+            )
+            self._pool_workers = workers
+        return self._pool
 
-    def __call__(self, text):
-        """
-        Args:
-            text (str) : text to preprocess
-        Returns:
-            Token list obtained using scispacy
-        """
-
-        doc = self.model(text)
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._pool_workers = 0
 
+    def _tokens(self, doc):
         tokens = []
         for token in doc:
             if token.is_stop:
                 continue
             tokens.append(token.lemma_)
-
         return tokens
 
+    def __call__(self, text):
+        """
+        Args:
+            text (str) : text to preprocess
+        Returns:
+            Token list obtained using scispacy
+        """
+        return self._tokens(self.model(text))
+
     def __getstate__(self):
-        return {}
+        # Only the settings are pickled. The model is loaded again on unpickling
+        # and the worker pool is not carried over, it is started on next use
+        return {"batch_size": self.batch_size}
 
     def __setstate__(self, state):
-        self.__init__()
+        self.__init__(**state)
+
+    def tokenize_texts(self, texts):
+        """ Tokenize a list of texts through nlp.pipe """
+        return [self._tokens(doc) for doc in
+            self.model.pipe(texts, batch_size=self.batch_size)]
 
     def tokenize_doc(self, doc):
         return self.__call__(doc.text)
 
     def tokenize_doc_batch(self, documents):
-        tokenized_docs = []
-        for doc in documents:
-            tokenized_docs.append(self.__call__(doc.text))
-        return tokenized_docs
+        return self.tokenize_texts([doc.text for doc in documents])
 
-    def tokenize_doc_parallel(self, documents, workers=4):
-
-        with mp.Pool(processes=workers) as pool:
-            batch_size = len(documents) // workers
-            start = 0
-            doc_batches = []
-            i = 0
-            for i in range(workers):
-                if i == workers - 1:
-                    batch_size += len(documents) % workers
-                
-                end = start + batch_size
-                doc_batches.append(documents[start:end])
-                start = end
-
-            tokenized_docs = pool.map(
-                self.tokenize_doc_batch,
-                doc_batches
-            )
-        # Flatten list
-        tokenized_docs = list(chain.from_iterable(tokenized_docs))
-        return tokenized_docs
+    def tokenize_stream(self, documents, workers=4, chunk_size=64, max_pending=None):
+        """
+        Tokenize documents in worker processes and yield token lists in input order.
 
-        
+        Only the text of each document is sent to the workers, chunk_size texts
+        at a time. At most max_pending chunks (2 per worker by default) are in
+        flight, so memory stays bounded however many documents are streamed.
+        Worker processes are kept for later calls until close is called.
+        Args:
+            documents (iterable[Document]) : documents to tokenize, may be a generator
+            workers (int) : number of worker processes, 1 to tokenize in this process
+            chunk_size (int) : number of texts sent to a worker at once
+            max_pending (int) : max number of chunks queued or being processed
+        """
+        texts = (doc.text for doc in documents)
+        if workers <= 1:
+            for chunk in _chunks(texts, chunk_size):
+                for tokens in self.tokenize_texts(chunk):
+                    yield tokens
+            return
+
+        max_pending = max_pending or 2 * workers
+        pool = self._get_pool(workers)
+        pending = deque()
+        for chunk in _chunks(texts, chunk_size):
+            pending.append(pool.apply_async(_tokenize_chunk, (chunk,)))
+            if len(pending) >= max_pending:
+                for tokens in pending.popleft().get():
+                    yield tokens
+        while pending:
+            for tokens in pending.popleft().get():
+                yield tokens
 
+    def tokenize_doc_parallel(self, documents, workers=4):
+        return list(self.tokenize_stream(documents, workers))
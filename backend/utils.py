@@ -1,41 +1,221 @@
 import os, sys
 import json
 import time
-from os.path import dirname as parent
-from elasticsearch import Elasticsearch
-from elasticsearch.exceptions import NotFoundError, RequestError
-from elasticsearch.helpers import scan
+import subprocess
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch import Elasticsearch, AsyncElasticsearch
+from elasticsearch.exceptions import NotFoundError, RequestError, TransportError, \
+    ConnectionError as ESConnectionError
+from elasticsearch.helpers import scan, streaming_bulk
 try:
     from document import Document
+    from metrics import REGISTRY
+    from settings import CONFIG
+    from breaker import CircuitBreaker, CircuitOpenError
+    from passages import to_passages
 except:
     from .document import Document
+    from .metrics import REGISTRY
+    from .settings import CONFIG
+    from .breaker import CircuitBreaker, CircuitOpenError
+    from .passages import to_passages
 
-project_path = parent(parent(os.path.realpath(__file__)))
-config_path = project_path + "/config.json"
+BULK_ACTIONS = REGISTRY.counter(
+    "covidqa_es_bulk_actions",
+    "Actions sent through the Elastic Search bulk API"
+)
+BULK_ERRORS = REGISTRY.counter(
+    "covidqa_es_bulk_errors",
+    "Bulk actions rejected by Elastic Search after retries"
+)
+BULK_SECONDS = REGISTRY.histogram(
+    "covidqa_es_bulk_seconds",
+    "Duration of bulk loads",
+    buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+)
 
-with open(config_path) as fp:
-    CONFIG = json.load(fp)
 
-CONFIG["DATA_DIR"] = project_path + "/" + CONFIG["DATA_DIR"]
-CONFIG["SAVE_DIR"] = project_path + "/" + CONFIG["SAVE_DIR"]
+# Elastic Search clients and circuit breakers shared by every handler of this process
+_clients = {}
+_breakers = {}
+_registry_pid = None
+_registry_lock = threading.Lock()
 
+def _check_pid():
+    # Pooled connections must not be shared with a forked child,
+    # so a child process starts with its own clients
+    global _registry_pid
+    if _registry_pid != os.getpid():
+        _clients.clear()
+        _breakers.clear()
+        _registry_pid = os.getpid()
+
+def get_client(host=None):
+    """
+    Return the Elasticsearch client of this process for host, ES_HOST if None.
+    Clients keep up to ES_POOL_SIZE persistent connections per node, so
+    requests reuse connections instead of opening new ones.
+    """
+    host = host or CONFIG["ES_HOST"]
+    with _registry_lock:
+        _check_pid()
+        client = _clients.get(host)
+        if client is None:
+            client = _clients[host] = Elasticsearch(
+                host,
+                maxsize=CONFIG["ES_POOL_SIZE"],
+                timeout=CONFIG["ES_TIMEOUT"],
+                http_compress=True
+            )
+        return client
+
+def get_breaker(host=None):
+    """ Return the circuit breaker of this process for host, ES_HOST if None """
+    host = host or CONFIG["ES_HOST"]
+    with _registry_lock:
+        _check_pid()
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(
+                "elasticsearch",
+                failure_threshold=CONFIG["ES_BREAKER_FAILURES"],
+                reset_timeout=CONFIG["ES_BREAKER_RESET"]
+            )
+        return breaker
+
+def is_unhealthy(err):
+    """ Whether an Elastic Search error means the cluster is down or overloaded """
+    if isinstance(err, (ESConnectionError, asyncio.TimeoutError)):
+        return True
+    if isinstance(err, TransportError):
+        return err.status_code in ("N/A", 429, 502, 503, 504)
+    return False
 
 def pip_install(url):
     # Used to download Spacy models
     subprocess.check_call([sys.executable, "-m", "pip", "install", url])
 
+class EventLoopThread():
+    """
+    asyncio event loop running forever in a daemon thread, so synchronous
+    code such as Flask views can run coroutines on one shared loop and share
+    its pooled connections.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coro, timeout=None):
+        """ Run coro on the loop and block until it returns """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return future.result(timeout)
+
+    def submit(self, coro):
+        """ Schedule coro on the loop and return a future awaitable from the calling loop """
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+class AsyncESHandler():
+    """
+    Async counterpart of ESHandler for the query path.
+    Connections are pooled by AsyncElasticsearch and reused across requests,
+    so the handler must only be used from a single event loop.
+    """
+    def __init__(self):
+        self.index = CONFIG["ES_INDEX"]
+        self.breaker = get_breaker()
+        self._client = None
+
+    @property
+    def client(self):
+        # aiohttp sessions belong to the loop they were created in,
+        # so create the client lazily from inside the loop
+        if self._client is None:
+            self._client = AsyncElasticsearch(
+                CONFIG["ES_HOST"],
+                maxsize=CONFIG["ES_ASYNC_POOL_SIZE"],
+                timeout=CONFIG["ES_TIMEOUT"]
+            )
+        return self._client
+
+    async def advanced_search(self, query_body, size=100, from_=0, timeout=None, index=None):
+        """
+        Args:
+            index (str) : index to search, ES_INDEX if None
+        Raises:
+            CircuitOpenError if Elastic Search failed repeatedly and is not retried yet
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError("elasticsearch is unavailable")
+        try:
+            resp = await self.client.search(
+                body=query_body,
+                index=index or self.index,
+                size=size,
+                from_=from_,
+                request_timeout=timeout or CONFIG["ES_SEARCH_TIMEOUT"]
+            )
+        except NotFoundError:
+            self.breaker.record_success()
+            return None
+        except Exception as err:
+            if is_unhealthy(err):
+                self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return resp
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
 class ESHandler():
     """
     Class used to handle communication with Elastic Search
     """
-    def __init__(self):
-        self.client = Elasticsearch(CONFIG["ES_HOST"])
+    # Passages are only searched by text, title and concepts; the rest is
+    # stored for display
+    PASSAGE_MAPPINGS = {
+        "properties": {
+            "paper_id": {"type": "keyword"},
+            "position": {"type": "integer"},
+            "field": {"type": "keyword"},
+            "text": {"type": "text"},
+            "title": {"type": "text"},
+            "metadata": {"type": "object", "enabled": False},
+            "concepts": {"type": "keyword"}
+        }
+    }
+
+    def __init__(self, client=None):
+        """
+        Args:
+            client (Elasticsearch) : client to use, the shared client of ES_HOST if None
+        """
+        self.client = client if client is not None else get_client()
+        self.breaker = get_breaker()
         self.index = CONFIG["ES_INDEX"]
+        self.passage_index = CONFIG["ES_PASSAGE_INDEX"]
         self.snapshot_path = CONFIG["SAVE_DIR"] + "/elasticsearch/" + self.index
+        self._generation = ""
+        self._repository_ready = False
+        self._passage_index_ready = False
 
+    def _ensure_repository(self):
+        """
+        Verify or create the snapshot repository. This is done on the first
+        save or restore rather than in __init__, so creating a handler does
+        not make any request to Elastic Search.
+        """
+        if self._repository_ready:
+            return
         try:
             self.client.snapshot.verify_repository(
-                repository=self.index
+                repository=self.index,
+                request_timeout=CONFIG["ES_SNAPSHOT_TIMEOUT"]
             )
         except NotFoundError:
             self.client.snapshot.create_repository(
@@ -44,8 +224,17 @@ class ESHandler():
                     "settings": {
                         "location": self.index
                     }
-                }
+                },
+                request_timeout=CONFIG["ES_SNAPSHOT_TIMEOUT"]
             )
+        self._repository_ready = True
+
+    def _call(self, fn, **kwargs):
+        """
+        Make a request on the query path through the circuit breaker, so
+        requests fail fast with CircuitOpenError while the cluster is unhealthy
+        """
+        return self.breaker.call(fn, is_failure=is_unhealthy, **kwargs)
 
     def search(self, query, size=100):
         try:
@@ -55,63 +244,140 @@ class ESHandler():
                     "fields" : ["title^3", "content.abstract^2", "content.body^1", "content.supplementary^1"]
                 }
             }}
-            resp = self.client.search(
+            resp = self._call(
+                self.client.search,
                 body=body,
                 index=self.index,
-                size=size
+                size=size,
+                request_timeout=CONFIG["ES_SEARCH_TIMEOUT"]
             )
             return resp
         except NotFoundError:
             return None
 
-    def advanced_search(self, query_body, size=100):
+    def advanced_search(self, query_body, size=100, from_=0):
         try:
-            resp = self.client.search(
+            resp = self._call(
+                self.client.search,
                 body=query_body,
                 index=self.index,
-                size=size
+                size=size,
+                from_=from_,
+                request_timeout=CONFIG["ES_SEARCH_TIMEOUT"]
             )
             return resp
         except NotFoundError:
             return None
 
+    def msearch(self, query_bodies, size=100, from_=0, index=None):
+        """
+        Run many searches in a single multi-search request.
+        Args:
+            query_bodies (list[dict]) : search bodies without size and from
+            index (str) : index to search, ES_INDEX if None
+        Returns:
+            list of responses in the order of query_bodies, None for searches that failed
+        """
+        if not query_bodies:
+            return []
+        index = index or self.index
+        body = []
+        for query_body in query_bodies:
+            body.append({"index": index})
+            body.append(dict(query_body, size=size, **{"from": from_}))
+        resp = self._call(
+            self.client.msearch,
+            body=body,
+            index=index,
+            request_timeout=CONFIG["ES_MSEARCH_TIMEOUT"]
+        )
+        results = []
+        for response in resp["responses"]:
+            if "error" in response:
+                print("Search in multi-search failed:", response["error"])
+                results.append(None)
+            else:
+                results.append(response)
+        return results
+
     def get(self, id):
         try:
-            resp = self.client.get(index=self.index, id=id)
+            resp = self._call(self.client.get, index=self.index, id=id,
+                request_timeout=CONFIG["ES_GET_TIMEOUT"])
             doc = resp["_source"]
             return Document.from_dict(doc)
         except NotFoundError:
             return None
 
-    def get_many(self, ids):
-        query = json.dumps({"docs": [{"_id": id} for id in ids]})
-        resp = self.client.mget(body=query, index=self.index)
-        results = resp["docs"]
+    def get_many(self, ids, fields=None, maintenance=False):
+        """
+        Fetch many documents with multi-gets of at most ES_MGET_CHUNK_SIZE ids.
+        Args:
+            ids (list[str]) : ids of documents
+            fields (list[str]) : _source fields to fetch, all fields if None
+            maintenance (bool) : request from an offline job such as an index
+                update, made with ES_MGET_TIMEOUT and outside the circuit
+                breaker, so its slow requests do not fail queries
+        Returns:
+            list of Document in the order of ids, None for ids that were not found
+        """
+        kwargs = {"index": self.index}
+        if fields is not None:
+            kwargs["_source_includes"] = fields
+        chunk_size = CONFIG["ES_MGET_CHUNK_SIZE"]
         documents = []
-        for result in results:
-            if result["found"]:
-                doc = result["_source"]
-                documents.append(Document.from_dict(doc))
+        for start in range(0, len(ids), chunk_size):
+            query = json.dumps({"docs": [{"_id": id} for id in ids[start:start + chunk_size]]})
+            if maintenance:
+                resp = self.client.mget(body=query,
+                    request_timeout=CONFIG["ES_MGET_TIMEOUT"], **kwargs)
             else:
-                documents.append(None)
+                resp = self._call(self.client.mget, body=query,
+                    request_timeout=CONFIG["ES_GET_TIMEOUT"], **kwargs)
+            for result in resp["docs"]:
+                if result["found"]:
+                    doc = Document.from_dict(result["_source"])
+                    doc.id = result["_id"]
+                    documents.append(doc)
+                else:
+                    documents.append(None)
         return documents
 
     def get_all_ids(self):
         response = scan(
             self.client,
             index=self.index,
-            query={"query": { "match_all" : {}}, "stored_fields": []}
+            query={"query": { "match_all" : {}}, "stored_fields": []},
+            request_timeout=CONFIG["ES_SCROLL_TIMEOUT"]
         )
         ids = [item["_id"] for item in response]
         return ids
 
-    def get_all_docs(self):
+    def iter_docs(self, fields=None, query=None, page_size=1000):
+        """
+        Stream documents out of the index without holding them all in memory.
+        Args:
+            fields (list[str]) : _source fields to fetch, all fields if None
+            query (dict) : query to select documents, all documents if None
+            page_size (int) : documents fetched per scroll request
+        """
+        body = {"query": query or { "match_all" : {}}}
+        if fields is not None:
+            body["_source"] = fields
         response = scan(
             self.client,
             index=self.index,
-            query={"query": { "match_all" : {}}}
+            query=body,
+            size=page_size,
+            request_timeout=CONFIG["ES_SCROLL_TIMEOUT"]
         )
-        documents = [Document.from_dict(item["_source"]) for item in response]
+        for item in response:
+            doc = Document.from_dict(item["_source"])
+            doc.id = item["_id"]
+            yield doc
+
+    def get_all_docs(self):
+        documents = list(self.iter_docs())
         return documents
 
     def insert(self, doc):
@@ -120,24 +386,301 @@ class ESHandler():
             resp = self.client.index(
                 index=self.index,
                 body=json_doc,
-                id=doc.id
+                id=doc.id,
+                request_timeout=CONFIG["ES_GET_TIMEOUT"]
             )
-        except elasticsearch.exceptions.RequestError as err:
+        except RequestError as err:
             print(err.info)
+            raise
 
         if resp["result"] != "created" and resp["result"] != "updated":
             raise Exception("Failed to insert document!")
 
-    def insert_many(self, documents):
-        for doc in documents:
-            self.insert(doc)
+    def _chunk_actions(self, actions, chunk_size, max_chunk_bytes):
+        """
+        Group (action, size) pairs into chunks bounded by count and bytes
+        """
+        chunk = []
+        chunk_bytes = 0
+        for action, size in actions:
+            if chunk and (len(chunk) >= chunk_size
+                    or chunk_bytes + size > max_chunk_bytes):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(action)
+            chunk_bytes += size
+        if chunk:
+            yield chunk
+
+    def _send_chunk(self, chunk, max_chunk_bytes, max_retries):
+        """
+        Send one chunk through the bulk API.
+        Items rejected with 429 are retried with exponential backoff by
+        streaming_bulk; other failures are returned.
+        """
+        errors = []
+        for ok, item in streaming_bulk(
+                self.client,
+                chunk,
+                chunk_size=len(chunk),
+                max_chunk_bytes=max_chunk_bytes,
+                max_retries=max_retries,
+                initial_backoff=2,
+                max_backoff=600,
+                raise_on_error=False,
+                raise_on_exception=False,
+                yield_ok=False,
+                request_timeout=CONFIG["ES_BULK_TIMEOUT"]):
+            errors.append(item)
+        return len(chunk), errors
+
+    def bulk(self, actions, chunk_size=None, max_chunk_bytes=None,
+            workers=None, max_retries=None, disable_refresh=False, index=None):
+        """
+        Send actions through the bulk API using several concurrent workers.
+        Args:
+            actions (iterable[tuple[dict, int]]) : bulk actions with their approximate size in bytes
+            chunk_size (int) : max number of actions per bulk request
+            max_chunk_bytes (int) : max size of a bulk request in bytes
+            workers (int) : number of concurrent bulk requests
+            max_retries (int) : retries for items rejected with 429
+            disable_refresh (bool) : turn index refresh off during the load
+            index (str) : index whose refresh is turned off, ES_INDEX if None
+        Returns:
+            dict with number of actions sent, per-item errors, elapsed seconds and docs/sec
+        """
+        chunk_size = chunk_size or CONFIG["ES_BULK_CHUNK_SIZE"]
+        max_chunk_bytes = max_chunk_bytes or CONFIG["ES_BULK_MAX_BYTES"]
+        workers = workers or CONFIG["ES_BULK_WORKERS"]
+        if max_retries is None:
+            max_retries = CONFIG["ES_BULK_MAX_RETRIES"]
+        index = index or self.index
+
+        # A missing index is created by the first bulk request with default
+        # settings, so there is no refresh interval to restore
+        disable_refresh = disable_refresh and self.client.indices.exists(index=index)
+        if disable_refresh:
+            settings = self.client.indices.get_settings(
+                index=index,
+                name="index.refresh_interval"
+            )
+            refresh_interval = settings.get(index, {}).get("settings", {}) \
+                .get("index", {}).get("refresh_interval", None)
+            self.client.indices.put_settings(
+                index=index,
+                body={"index": {"refresh_interval": "-1"}}
+            )
+
+        start = time.time()
+        total = 0
+        errors = []
+        # Bound the number of chunks held in memory to what the workers are sending
+        slots = threading.BoundedSemaphore(workers * 2)
+        futures = []
+
+        def release(future):
+            slots.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for chunk in self._chunk_actions(actions, chunk_size, max_chunk_bytes):
+                    slots.acquire()
+                    future = executor.submit(
+                        self._send_chunk, chunk, max_chunk_bytes, max_retries
+                    )
+                    future.add_done_callback(release)
+                    futures.append(future)
+
+                    # Collect finished chunks so the futures list stays small
+                    while futures and futures[0].done():
+                        count, chunk_errors = futures.pop(0).result()
+                        total += count
+                        errors += chunk_errors
+
+                for future in futures:
+                    count, chunk_errors = future.result()
+                    total += count
+                    errors += chunk_errors
+        finally:
+            if disable_refresh:
+                self.client.indices.put_settings(
+                    index=index,
+                    body={"index": {"refresh_interval": refresh_interval}}
+                )
+                self.client.indices.refresh(index=index)
+
+        elapsed = time.time() - start
+        if total > len(errors):
+            self._write_generation(str(time.time_ns()))
+        BULK_ACTIONS.inc(total)
+        BULK_ERRORS.inc(len(errors))
+        BULK_SECONDS.observe(elapsed)
+        stats = {
+            "total": total,
+            "errors": errors,
+            "elapsed": elapsed,
+            "docs_per_sec": total / elapsed if elapsed > 0 else 0.0
+        }
+        return stats
+
+    def insert_many(self, documents, **kwargs):
+        """
+        Index documents through the bulk API. See bulk for keyword arguments.
+        Returns:
+            dict with number of documents sent, per-item errors, elapsed seconds and docs/sec
+        """
+        def actions():
+            for doc in documents:
+                # Serialize once: the string is used both for sizing and as the body
+                json_doc = doc.to_json()
+                action = {
+                    "_op_type": "index",
+                    "_index": self.index,
+                    "_id": doc.id,
+                    "_source": json_doc
+                }
+                yield action, len(json_doc.encode("utf-8"))
+
+        return self.bulk(actions(), **kwargs)
+
+    def update_many(self, updates, **kwargs):
+        """
+        Apply partial updates through the bulk API.
+        Args:
+            updates (iterable[tuple[str, dict]]) : document id and the fields to merge into it
+        Returns:
+            dict with number of updates sent, per-item errors, elapsed seconds and docs/sec
+        """
+        def actions():
+            for id, fields in updates:
+                # The bulk helpers read a string _source of an update as source
+                # filtering, so the partial document is passed as "doc"
+                action = {
+                    "_op_type": "update",
+                    "_index": self.index,
+                    "_id": id,
+                    "doc": fields
+                }
+                yield action, len(json.dumps(fields).encode("utf-8")) + 8
+
+        return self.bulk(actions(), **kwargs)
+
+    def delete_many(self, ids, **kwargs):
+        """
+        Delete documents through the bulk API. Ids that are already gone are not reported as errors.
+        Returns:
+            dict with number of deletions sent, per-item errors, elapsed seconds and docs/sec
+        """
+        def actions():
+            for id in ids:
+                action = {"_op_type": "delete", "_index": self.index, "_id": id}
+                yield action, len(id) + 64
+
+        stats = self.bulk(actions(), **kwargs)
+        stats["errors"] = [error for error in stats["errors"]
+            if error.get("delete", {}).get("status") != 404]
+        return stats
+
+    def _ensure_passage_index(self):
+        """ Create the passage index with its mappings on first use """
+        if self._passage_index_ready:
+            return
+        if not self.client.indices.exists(index=self.passage_index):
+            try:
+                self.client.indices.create(
+                    index=self.passage_index,
+                    body={"mappings": ESHandler.PASSAGE_MAPPINGS}
+                )
+            except RequestError as err:
+                # Another process created it in the meantime
+                if err.error != "resource_already_exists_exception":
+                    raise
+        self._passage_index_ready = True
+
+    def insert_passages(self, documents, **kwargs):
+        """
+        Split documents into passages and index them in the passage index,
+        replacing the passages they had before. See bulk for keyword arguments.
+        Returns:
+            dict with number of passages sent, per-item errors, elapsed seconds and docs/sec
+        """
+        documents = list(documents)
+        self._ensure_passage_index()
+        # A changed paper may be split into fewer passages than before
+        self.delete_passages([doc.id for doc in documents])
+
+        def actions():
+            for doc in documents:
+                for id, passage in to_passages(doc, CONFIG["PASSAGE_WORDS"],
+                        CONFIG["PASSAGE_OVERLAP"]):
+                    json_doc = json.dumps(passage)
+                    action = {
+                        "_op_type": "index",
+                        "_index": self.passage_index,
+                        "_id": id,
+                        "_source": json_doc
+                    }
+                    yield action, len(json_doc.encode("utf-8"))
+
+        return self.bulk(actions(), index=self.passage_index, **kwargs)
+
+    def delete_passages(self, paper_ids, chunk_size=1000):
+        """ Delete every passage of the given papers """
+        self._ensure_passage_index()
+        paper_ids = list(paper_ids)
+        for start in range(0, len(paper_ids), chunk_size):
+            self.client.delete_by_query(
+                index=self.passage_index,
+                body={"query": {"terms": {"paper_id": paper_ids[start:start + chunk_size]}}},
+                conflicts="proceed",
+                request_timeout=CONFIG["ES_BULK_TIMEOUT"]
+            )
 
     def save(self):
+        self._ensure_repository()
         self.t = str(int(time.time()))
         self.client.snapshot.create(
             repository=self.index,
-            snapshot=self.t
+            snapshot=self.t,
+            request_timeout=CONFIG["ES_SNAPSHOT_TIMEOUT"]
         )
+        self._write_generation(self.t)
+
+    def _write_generation(self, generation):
+        """
+        Record the corpus generation in the mapping metadata of the index, so
+        processes on every host can drop caches built from older data
+        """
+        try:
+            self.client.indices.put_mapping(
+                index=self.index,
+                body={"_meta": {"generation": generation}},
+                request_timeout=CONFIG["ES_GET_TIMEOUT"]
+            )
+        except NotFoundError:
+            # Only the passage index was written, nothing can be cached yet
+            pass
+
+    def generation(self):
+        """
+        Return the latest corpus generation written by save or a bulk load,
+        "" if none. While Elastic Search cannot be reached, the last
+        generation read is returned.
+        """
+        try:
+            resp = self._call(
+                self.client.indices.get_mapping,
+                index=self.index,
+                request_timeout=CONFIG["ES_GET_TIMEOUT"]
+            )
+        except NotFoundError:
+            return ""
+        except Exception:
+            return self._generation
+        self._generation = resp.get(self.index, {}).get("mappings", {}) \
+            .get("_meta", {}).get("generation", "")
+        return self._generation
 
     def restore(self):
         # Find latest snapshot name
@@ -152,8 +695,11 @@ class ESHandler():
         snapshots = [s["name"] for s in info["snapshots"]]
         latest = max(snapshots)
 
+        self._ensure_repository()
         self.client.snapshot.restore(
             repository=self.index,
-            snapshot=latest
+            snapshot=latest,
+            request_timeout=CONFIG["ES_SNAPSHOT_TIMEOUT"]
         )
+        self._write_generation(latest)
 
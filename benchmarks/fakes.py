@@ -0,0 +1,332 @@
+import copy
+import json
+import time
+import zlib
+import itertools
+from collections import namedtuple
+
+class _Serializer():
+    """ Stand-in for elasticsearch.serializer.JSONSerializer used by the bulk helpers """
+    mimetype = "application/json"
+
+    def dumps(self, data):
+        if isinstance(data, str):
+            return data
+        return json.dumps(data)
+
+    def loads(self, data):
+        return json.loads(data)
+
+class _Transport():
+    def __init__(self):
+        self.serializer = _Serializer()
+
+class _Namespace():
+    """ Accepts any call and returns an empty response, e.g. for snapshot """
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+
+    def __getattr__(self, name):
+        response = self.responses.get(name, {"acknowledged": True})
+        return lambda *args, **kwargs: response
+
+class _Indices():
+    """ Index management calls; an index exists once it was created or written to """
+    def __init__(self, client):
+        self.client = client
+        self.settings = {}
+        self.mappings = {}
+
+    def _check(self, index):
+        from elasticsearch.exceptions import NotFoundError
+        if index not in self.client.stores:
+            raise NotFoundError(404, "index_not_found_exception", {})
+
+    def exists(self, index, **kwargs):
+        return index in self.client.stores
+
+    def create(self, index, body=None, **kwargs):
+        from elasticsearch.exceptions import RequestError
+        if index in self.client.stores:
+            raise RequestError(400, "resource_already_exists_exception", {})
+        self.client.stores[index] = {}
+        return {"acknowledged": True, "index": index}
+
+    def get_settings(self, index, name=None, **kwargs):
+        self._check(index)
+        settings = self.settings.get(index, {})
+        return {index: {"settings": {"index": settings}}} if settings else {}
+
+    def put_settings(self, index, body, **kwargs):
+        self._check(index)
+        settings = self.settings.setdefault(index, {})
+        for key, value in body["index"].items():
+            if value is None:
+                settings.pop(key, None)
+            else:
+                settings[key] = value
+        return {"acknowledged": True}
+
+    def get_mapping(self, index, **kwargs):
+        self._check(index)
+        return {index: {"mappings": copy.deepcopy(self.mappings.get(index, {}))}}
+
+    def put_mapping(self, index, body, **kwargs):
+        self._check(index)
+        self.mappings.setdefault(index, {}).update(copy.deepcopy(body))
+        return {"acknowledged": True}
+
+    def refresh(self, index, **kwargs):
+        self._check(index)
+        return {"_shards": {"failed": 0}}
+
+def _select(source, fields):
+    """ Apply _source filtering with dotted field names """
+    if fields is None:
+        return source
+    if fields is False:
+        return {}
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    selected = {}
+    for field in fields:
+        value = source
+        path = field.split(".")
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = selected
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+    return selected
+
+class FakeElasticsearch():
+    """
+    In-process stand-in for the Elasticsearch client.
+
+    Implements the calls made by ESHandler and the elasticsearch.helpers
+    bulk and scan functions. Documents are kept as JSON strings per index,
+    so serialization costs are similar to a real cluster. Search scores
+    documents by how many query words appear in them, which is enough to
+    exercise the query path.
+
+    Attributes:
+        latency (float) : seconds slept per request to imitate a network round trip
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        # Index name -> document id -> JSON source
+        self.stores = {}
+        self.requests = 0
+        self.transport = _Transport()
+        self.snapshot = _Namespace()
+        self.indices = _Indices(self)
+        self._scroll_ids = itertools.count()
+
+    def _request(self):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _docs(self, index):
+        return self.stores.setdefault(index, {})
+
+    def ping(self, **kwargs):
+        return True
+
+    def index(self, index, body, id, **kwargs):
+        self._request()
+        docs = self._docs(index)
+        result = "updated" if id in docs else "created"
+        docs[id] = body if isinstance(body, str) else json.dumps(body)
+        return {"_id": id, "result": result}
+
+    def get(self, index, id, **kwargs):
+        self._request()
+        from elasticsearch.exceptions import NotFoundError
+        docs = self._docs(index)
+        if id not in docs:
+            raise NotFoundError(404, "not_found", {})
+        return {"_id": id, "found": True, "_source": json.loads(docs[id])}
+
+    def mget(self, body, index=None, _source_includes=None, **kwargs):
+        self._request()
+        if isinstance(body, str):
+            body = json.loads(body)
+        ids = body.get("ids") or [doc["_id"] for doc in body["docs"]]
+        stored = self._docs(index)
+        docs = []
+        for id in ids:
+            if id in stored:
+                source = _select(json.loads(stored[id]), _source_includes)
+                docs.append({"_id": id, "found": True, "_source": source})
+            else:
+                docs.append({"_id": id, "found": False})
+        return {"docs": docs}
+
+    def _hits(self, index, body, size, from_):
+        docs = self._docs(index)
+        query = body.get("query", {})
+        if "query_string" in query:
+            words = set(query["query_string"]["query"].lower().split())
+            scored = []
+            for id, raw in docs.items():
+                score = sum(1 for word in words if word in raw.lower())
+                if score:
+                    scored.append((score, id))
+            scored.sort(reverse=True)
+        else:
+            scored = [(1.0, id) for id in docs]
+        if "collapse" in body:
+            # Keep the best hit of every value of the collapse field
+            field = body["collapse"]["field"]
+            seen = set()
+            collapsed = []
+            for score, id in scored:
+                value = json.loads(docs[id]).get(field)
+                if value not in seen:
+                    seen.add(value)
+                    collapsed.append((score, id))
+            scored = collapsed
+
+        hits = []
+        for score, id in scored[from_:from_ + size]:
+            source = json.loads(docs[id])
+            if "_source" in body:
+                source = _select(source, body["_source"])
+            hits.append({"_id": id, "_score": float(score), "_source": source})
+        return {"total": {"value": len(scored), "relation": "eq"}, "hits": hits}
+
+    def search(self, body=None, index=None, size=10, from_=0, scroll=None, **kwargs):
+        self._request()
+        body = body or {}
+        if scroll is not None:
+            # Scans get everything in a single page
+            size = len(self._docs(index))
+        resp = {
+            "took": 1,
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": self._hits(index, body, size, from_)
+        }
+        if scroll is not None:
+            resp["_scroll_id"] = str(next(self._scroll_ids))
+        return resp
+
+    def msearch(self, body, index=None, **kwargs):
+        self._request()
+        if isinstance(body, str):
+            body = [json.loads(line) for line in body.splitlines() if line.strip()]
+        responses = []
+        for header, query in zip(body[::2], body[1::2]):
+            size = query.get("size", 10)
+            from_ = query.get("from", 0)
+            responses.append({"hits": self._hits(header.get("index", index), query, size, from_),
+                "status": 200})
+        return {"responses": responses}
+
+    def scroll(self, **kwargs):
+        self._request()
+        return {
+            "_scroll_id": kwargs.get("scroll_id") or kwargs.get("body", {}).get("scroll_id"),
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {"hits": []}
+        }
+
+    def clear_scroll(self, **kwargs):
+        return {"succeeded": True}
+
+    def delete_by_query(self, index, body, **kwargs):
+        """ Supports the terms query used to delete passages """
+        self._request()
+        docs = self._docs(index)
+        (field, values), = body["query"]["terms"].items()
+        values = set(values)
+        deleted = [id for id, raw in docs.items() if json.loads(raw).get(field) in values]
+        for id in deleted:
+            del docs[id]
+        return {"deleted": len(deleted), "failures": []}
+
+    def bulk(self, body, *args, **kwargs):
+        self._request()
+        lines = iter(line for line in body.split("\n") if line)
+        items = []
+        for line in lines:
+            action = json.loads(line)
+            op_type, meta = next(iter(action.items()))
+            id = meta.get("_id")
+            docs = self._docs(meta.get("_index"))
+            if op_type == "delete":
+                status = 200 if docs.pop(id, None) is not None else 404
+                items.append({op_type: {"_id": id, "status": status}})
+                continue
+            data = next(lines)
+            if op_type == "update":
+                if id not in docs:
+                    items.append({op_type: {"_id": id, "status": 404}})
+                    continue
+                source = json.loads(docs[id])
+                _merge(source, json.loads(data)["doc"])
+                docs[id] = json.dumps(source)
+                items.append({op_type: {"_id": id, "status": 200}})
+            else:
+                status = 200 if id in docs else 201
+                docs[id] = data
+                items.append({op_type: {"_id": id, "status": status}})
+        errors = any(not 200 <= next(iter(item.values()))["status"] < 300 for item in items)
+        return {"took": 1, "errors": errors, "items": items}
+
+def _merge(target, fields):
+    """ Merge fields into target like a partial update """
+    for key, value in fields.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+StubConcept = namedtuple("StubConcept", "index mm score preferred_name cui semtypes "
+    "trigger location pos_info tree_codes")
+
+class StubMetaMap():
+    """
+    Stand-in for MetamapProcess that returns one made-up concept per
+    word of the input after sleeping latency seconds.
+    """
+    def __init__(self, latency=0.05):
+        self.latency = latency
+
+    def extract_concepts(self, sentences, ids=None, **kwargs):
+        time.sleep(self.latency)
+        concepts = []
+        for i, sentence in enumerate(sentences):
+            index = ids[i] if ids else str(i)
+            for word in sentence.split()[:10]:
+                # crc32 rather than hash so every worker process agrees on the CUI
+                cui = "C{:07d}".format(zlib.crc32(word.lower().encode("utf-8")) % 10000000)
+                concepts.append(StubConcept(index, "MMI", "1.00", word, cui,
+                    "[fake]", word, "TX", "0/1", ""))
+        return concepts, ""
+
+class WhitespaceTokenizer():
+    """
+    Tokenizer with the SciSpacyTokenizer interface that splits on whitespace,
+    so index benchmarks do not depend on spaCy
+    """
+    def __call__(self, text):
+        return text.lower().split()
+
+    def tokenize_texts(self, texts):
+        return [self(text) for text in texts]
+
+    def tokenize_stream(self, documents, workers=4, chunk_size=64, max_pending=None):
+        for doc in documents:
+            yield self(doc.text)
+
+    def tokenize_doc_parallel(self, documents, workers=4):
+        return list(self.tokenize_stream(documents, workers))
+
+    def close(self):
+        pass
@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+from os.path import dirname as parent
+
+sys.path.insert(0, parent(parent(os.path.realpath(__file__))))
+
+from benchmarks.synthetic import SyntheticCorpus
+from benchmarks.fakes import FakeElasticsearch, StubMetaMap, WhitespaceTokenizer
+
+def timed(fn, repeat):
+    """ Run fn repeat times and return the wall time of each run """
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return runs
+
+def bench_parser(corpus, args, workdir):
+    from crawler import COVIDChallengeDocParser
+    data_dir = workdir + "/release"
+    files = corpus.write(data_dir)
+    parser = COVIDChallengeDocParser()
+
+    def run():
+        parser.load_meta_csv(data_dir + "/metadata.csv")
+        parser.parse_many(files)
+    return timed(run, args.repeat), len(files)
+
+def bench_tokenizer(corpus, args, workdir):
+    from backend.tokenizer import SciSpacyTokenizer
+    documents = list(corpus.documents())
+    results = {}
+    for batch_size in args.batch_sizes:
+        tokenizer = SciSpacyTokenizer(batch_size)
+        for workers in args.workers:
+            def run():
+                for _ in tokenizer.tokenize_stream(documents, workers):
+                    pass
+            name = "tokenizer.batch{}.workers{}".format(batch_size, workers)
+            results[name] = (timed(run, args.repeat), len(documents))
+        tokenizer.close()
+    return results
+
+def _es_handler(documents=None):
+    from backend.utils import ESHandler
+    handler = ESHandler(client=FakeElasticsearch())
+    if documents:
+        handler.insert_many(documents)
+    return handler
+
+def bench_es_ingest(corpus, args, workdir):
+    documents = list(corpus.documents())
+
+    def run():
+        _es_handler().insert_many(documents)
+    return timed(run, args.repeat), len(documents)
+
+def bench_gensim(corpus, args, workdir):
+    from backend.index import GensimIndex
+    documents = list(corpus.documents())
+    handler = _es_handler(documents)
+    GensimIndex.SAVE_PATH = workdir + "/gensim"
+    GensimIndex.TOKEN_CACHE_PATH = workdir + "/tokens/tokens.sqlite"
+    queries = ["incubation period", "ace2 receptor binding", "vaccine trial",
+        "transmission rate estimate", "cytokine response severe patient"]
+
+    results = {}
+    for model in args.models:
+        index = GensimIndex(WhitespaceTokenizer())
+        index._es_handler = handler
+
+        def build():
+            # Start from an empty token cache so every run does the same work
+            shutil.rmtree(workdir + "/tokens", ignore_errors=True)
+            index.init(model)
+        results["gensim.init." + model] = (timed(build, args.repeat), len(documents))
+
+        def query():
+            for q in queries:
+                list(index.query(q, size=10))
+        results["gensim.query." + model] = (timed(query, args.repeat), len(queries))
+
+        def query_many():
+            for batch in index.query_many(queries, size=10):
+                list(batch)
+        results["gensim.query_many." + model] = (timed(query_many, args.repeat), len(queries))
+    return results
+
+def bench_codec(corpus, args, workdir):
+    from backend.document import Document
+    documents = list(corpus.documents())
+    codecs = {
+        "json": (lambda doc: doc.to_json(), Document.from_json),
+        "pickle": (pickle.dumps, pickle.loads),
+        "bytes": (lambda doc: doc.to_bytes(), Document.from_bytes)
+    }
+    results = {}
+    for name, (encode, decode) in codecs.items():
+        encoded = [encode(doc) for doc in documents]
+
+        def run_encode():
+            for doc in documents:
+                encode(doc)
+
+        def run_decode():
+            for data in encoded:
+                decode(data).title
+        results["codec.{}.encode".format(name)] = (timed(run_encode, args.repeat), len(documents))
+        results["codec.{}.decode".format(name)] = (timed(run_decode, args.repeat), len(documents))
+
+    def run_text():
+        for data in encoded:
+            Document.from_bytes(data).text
+    results["codec.text"] = (timed(run_text, args.repeat), len(documents))
+    return results
+
+def bench_metamap(corpus, args, workdir):
+    import backend.ner as ner
+    # Worker processes are forked, so they inherit the stubbed MetaMap
+    ner.MetamapProcess = lambda path, read_timeout=None: StubMetaMap(args.metamap_latency)
+    metamap = object.__new__(ner.Metamap)
+    metamap.cache = ner.MetamapCache(workdir + "/metamap/concepts.sqlite")
+    metamap.pool = ner.MetamapPool("stub", workers=max(args.workers), timeout=10.0)
+    queries = ["query {}".format(i) for i in range(50)]
+
+    def run():
+        for q in queries:
+            metamap(q)
+    results = {
+        "metamap.miss": (timed(run, 1), len(queries)),
+        "metamap.hit": (timed(run, args.repeat), len(queries))
+    }
+    metamap.pool.shutdown()
+    return results
+
+COMPONENTS = {
+    "parser": bench_parser,
+    "tokenizer": bench_tokenizer,
+    "es_ingest": bench_es_ingest,
+    "gensim": bench_gensim,
+    "codec": bench_codec,
+    "metamap": bench_metamap
+}
+
+def summarize(runs, items):
+    median = statistics.median(runs)
+    return {
+        "runs": runs,
+        "median": median,
+        "best": min(runs),
+        "items": items,
+        "items_per_sec": items / median if median > 0 else 0.0
+    }
+
+def compare(results, baseline, threshold):
+    """ Return names of benchmarks whose median got slower than baseline by more than threshold """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = result["median"] / baseline[name]["median"]
+        flag = "REGRESSION" if ratio > 1 + threshold else ""
+        print("{:40s} {:10.4f}s {:10.4f}s {:7.2f}x {}".format(
+            name, baseline[name]["median"], result["median"], ratio, flag))
+        if flag:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Run component benchmarks")
+    parser.add_argument("--scale", type=int, default=1000, help="number of synthetic papers")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--components", nargs="+", default=sorted(COMPONENTS),
+        choices=sorted(COMPONENTS))
+    parser.add_argument("--models", nargs="+", default=["tfidf", "inverted", "lsi"])
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[32, 128])
+    parser.add_argument("--metamap-latency", type=float, default=0.05)
+    parser.add_argument("--output", type=str, default=None, help="write results as JSON")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+        help="slowdown ratio above which a benchmark is a regression")
+    args = parser.parse_args()
+
+    corpus = SyntheticCorpus(args.scale, seed=args.seed)
+    results = {}
+    skipped = {}
+    workdir = tempfile.mkdtemp(prefix="covidqa-bench-")
+    try:
+        for name in args.components:
+            print("Running", name, "...")
+            component_dir = workdir + "/" + name
+            os.makedirs(component_dir)
+            try:
+                measured = COMPONENTS[name](corpus, args, component_dir)
+            except ImportError as err:
+                print("Skipped {}: {}".format(name, err))
+                skipped[name] = str(err)
+                continue
+            if isinstance(measured, tuple):
+                measured = {name: measured}
+            for bench_name, (runs, items) in measured.items():
+                results[bench_name] = summarize(runs, items)
+                print("{:40s} {:10.4f}s {:12.1f} items/sec".format(
+                    bench_name, results[bench_name]["median"],
+                    results[bench_name]["items_per_sec"]))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "scale": args.scale,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "time": int(time.time())
+        },
+        "results": results,
+        "skipped": skipped
+    }
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as fp:
+            baseline = json.load(fp)["results"]
+        print("\nComparison with", args.baseline)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("{} regression(s) found".format(len(regressions)))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
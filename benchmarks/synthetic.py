@@ -0,0 +1,129 @@
+import os
+import csv
+import json
+import random
+import hashlib
+
+# Words mixed into generated text so the vocabulary looks roughly biomedical
+WORDS = [
+    "coronavirus", "sars-cov-2", "covid-19", "patient", "infection", "viral",
+    "respiratory", "protein", "ace2", "receptor", "spike", "incubation",
+    "period", "transmission", "clinical", "trial", "vaccine", "antibody",
+    "cell", "lung", "fever", "cough", "symptom", "hospital", "mortality",
+    "risk", "factor", "cohort", "study", "analysis", "model", "epidemic",
+    "outbreak", "sequence", "genome", "rna", "replication", "host", "immune",
+    "response", "cytokine", "treatment", "drug", "inhibitor", "binding",
+    "structure", "mutation", "strain", "sample", "test", "pcr", "diagnosis",
+    "severe", "acute", "syndrome", "china", "wuhan", "bat", "animal", "human",
+    "population", "rate", "estimate", "data", "result", "method", "increase",
+    "decrease", "significant", "effect", "case", "report", "review", "health"
+]
+
+FIRST_NAMES = ["Wei", "Maria", "John", "Aisha", "Li", "Carlos", "Anna", "Yuki", "Omar", "Sara"]
+LAST_NAMES = ["Zhang", "Smith", "Garcia", "Kim", "Chen", "Muller", "Rossi", "Khan", "Sato", "Brown"]
+
+class SyntheticCorpus():
+    """
+    Generator of CORD-19-shaped papers.
+
+    Words are drawn from a Zipf-like distribution over WORDS plus generated
+    rare words, so term statistics resemble real text. The same seed always
+    gives the same corpus.
+    """
+    def __init__(self, num_papers, seed=0, paragraphs=8, paragraph_words=120,
+            vocab_size=20000):
+        self.num_papers = num_papers
+        self.seed = seed
+        self.paragraphs = paragraphs
+        self.paragraph_words = paragraph_words
+        self.vocab = WORDS + ["term{}".format(i) for i in range(vocab_size)]
+        self.weights = [1.0 / (rank + 1) for rank in range(len(self.vocab))]
+
+    def _text(self, rng, num_words):
+        words = rng.choices(self.vocab, weights=self.weights, k=num_words)
+        return " ".join(words).capitalize() + "."
+
+    def _sha(self, i):
+        return hashlib.sha1("{}-{}".format(self.seed, i).encode("utf-8")).hexdigest()
+
+    def paper(self, i):
+        """ Return paper i as a dict in the CORD-19 json layout """
+        rng = random.Random(self.seed * 1000003 + i)
+        authors = [{
+            "first": rng.choice(FIRST_NAMES),
+            "middle": [],
+            "last": rng.choice(LAST_NAMES)
+        } for _ in range(rng.randint(1, 6))]
+        return {
+            "paper_id": self._sha(i),
+            "metadata": {
+                "title": self._text(rng, rng.randint(6, 16)),
+                "authors": authors
+            },
+            "abstract": [{"text": self._text(rng, self.paragraph_words), "section": "Abstract"}],
+            "body_text": [{"text": self._text(rng, self.paragraph_words), "section": "Body"}
+                for _ in range(self.paragraphs)],
+            "ref_entries": {"FIGREF0": {"text": self._text(rng, 20), "type": "figure"}}
+        }
+
+    def papers(self):
+        for i in range(self.num_papers):
+            yield self.paper(i)
+
+    def metadata_row(self, i):
+        rng = random.Random(self.seed * 7919 + i)
+        sha = self._sha(i)
+        # Some rows list several pdfs in one cell, like the real metadata.csv
+        if rng.random() < 0.1:
+            sha = sha + "; " + self._sha(self.num_papers + i)
+        return {
+            "cord_uid": "uid{}".format(i),
+            "sha": sha,
+            "pmcid": "PMC{}".format(1000000 + i) if rng.random() < 0.5 else "",
+            "doi": "10.1000/synthetic.{}".format(i),
+            "title": "",
+            "url": "https://doi.org/10.1000/synthetic.{}".format(i),
+            "publish_time": "2020-{:02d}-{:02d}".format(rng.randint(1, 12), rng.randint(1, 28))
+        }
+
+    def write(self, path):
+        """
+        Write the corpus like an unzipped CORD-19 release:
+        document_parses/pdf_json/<paper_id>.json and metadata.csv
+        Returns:
+            list of written json file names
+        """
+        json_dir = path + "/document_parses/pdf_json"
+        if not os.path.exists(json_dir):
+            os.makedirs(json_dir)
+
+        files = []
+        for paper in self.papers():
+            file_name = json_dir + "/" + paper["paper_id"] + ".json"
+            with open(file_name, "w") as fp:
+                json.dump(paper, fp)
+            files.append(file_name)
+
+        fields = ["cord_uid", "sha", "pmcid", "doi", "title", "url", "publish_time"]
+        with open(path + "/metadata.csv", "w", newline="") as fp:
+            writer = csv.DictWriter(fp, fieldnames=fields)
+            writer.writeheader()
+            for i in range(self.num_papers):
+                writer.writerow(self.metadata_row(i))
+        return files
+
+    def documents(self):
+        """ Yield the papers as Document objects, as the crawler would produce them """
+        from backend.document import Document
+        for i, paper in enumerate(self.papers()):
+            row = self.metadata_row(i)
+            authors = [author["first"] + " " + author["last"]
+                for author in paper["metadata"]["authors"]]
+            content = {
+                "abstract": "\n".join(p["text"] for p in paper["abstract"]),
+                "body": "\n".join(p["text"] for p in paper["body_text"]),
+                "supplementary": "\n".join(r["text"] for r in paper["ref_entries"].values())
+            }
+            metadata = {"authors": authors, "doi": row["doi"], "url": row["url"],
+                "publish_time": row["publish_time"]}
+            yield Document(paper["paper_id"], paper["metadata"]["title"], metadata, content)
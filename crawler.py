@@ -1,5 +1,4 @@
 import pandas as pd
-import kaggle
 import os, subprocess
 import time
 import pickle
@@ -7,8 +6,28 @@ import argparse
 import glob
 import json
 import math
+import hashlib
+import itertools
 from backend.document import Document
 from backend.utils import ESHandler, CONFIG
+from backend.metrics import REGISTRY, serve_metrics
+
+DOCS_PARSED = REGISTRY.counter(
+    "covidqa_crawler_docs_parsed",
+    "Papers parsed by the crawler"
+)
+PARSE_SECONDS = REGISTRY.counter(
+    "covidqa_crawler_parse_seconds",
+    "Time spent parsing papers"
+)
+DOCS_SKIPPED = REGISTRY.counter(
+    "covidqa_crawler_docs_skipped",
+    "Papers not parsed again because they did not change since the last release"
+)
+DOCS_WITHDRAWN = REGISTRY.counter(
+    "covidqa_crawler_docs_withdrawn",
+    "Papers removed because they are missing from the latest release"
+)
 
 class COVIDChallengeCrawler():
 
@@ -33,6 +52,7 @@ class COVIDChallengeCrawler():
 
         self.parser = COVIDChallengeDocParser()
         self.eshandler = ESHandler()
+        self.manifest = CrawlManifest(self.save_dir + "/manifest.json")
 
     def run(self):
         while True:
@@ -58,8 +78,8 @@ class COVIDChallengeCrawler():
                 print("Found document to collect...")
                 self.last_fetched = date
                 self._download_data()
-                documents = self._parse_data()
-                self._save_data(documents)
+                documents, withdrawn = self._parse_data()
+                self._save_data(documents, withdrawn)
                 print("Completed collection")
 
             # Sleep for a day
@@ -67,36 +87,117 @@ class COVIDChallengeCrawler():
             time.sleep(86400)
             print("Wake up")
 
-    def _save_data(self, documents):
+    def _save_data(self, documents, withdrawn):
         timestamp = int(time.time())
         print("Saving collected documents in Elastic Search at:", timestamp)
-        file_path = self.save_dir + "/" + str(timestamp) + "_kaggle.corp"
-        self.eshandler.insert_many(documents)
+        stats = self.eshandler.insert_many(documents, disable_refresh=True)
+        print("Inserted {} documents in {:.1f}s ({:.1f} docs/sec)".format(
+            stats["total"], stats["elapsed"], stats["docs_per_sec"]))
+        failed = set()
+        for error in stats["errors"]:
+            print("Failed to insert document:", error)
+            failed.add(error.get("index", {}).get("_id"))
+
+        stats = self.eshandler.insert_passages(
+            [doc for doc in documents if doc.id not in failed], disable_refresh=True)
+        print("Inserted {} passages in {:.1f}s".format(stats["total"], stats["elapsed"]))
+        for error in stats["errors"]:
+            print("Failed to insert passage:", error)
+            # Index the paper again next time so its passages are retried
+            failed.add(error.get("index", {}).get("_id", "").rsplit("-", 1)[0])
+
+        if withdrawn:
+            stats = self.eshandler.delete_many(withdrawn)
+            print("Deleted {} withdrawn documents".format(stats["total"]))
+            for error in stats["errors"]:
+                print("Failed to delete document:", error)
+            self.eshandler.delete_passages(withdrawn)
         self.eshandler.save()
 
+        # Only record papers that made it into the index so failures are retried next time
+        for paper_id in failed:
+            self.manifest.discard(paper_id)
+        for paper_id in withdrawn:
+            self.manifest.remove(paper_id)
+        self.manifest.commit()
+
+    def _hash_file(self, file, csv_data):
+        """
+            Content hash of a json file together with its metadata.csv row,
+            so corrections to either one are picked up
+        """
+        sha = hashlib.sha1()
+        with open(file, "rb") as fp:
+            sha.update(fp.read())
+        sha.update(json.dumps(csv_data, sort_keys=True).encode("utf-8"))
+        return sha.hexdigest()
+
     def _parse_data(self):
+        """
+            Parse only papers that are new or changed since the last release.
+            Returns:
+                documents (list[Document]) : new or changed documents to index
+                withdrawn (list[str]) : ids of papers missing from this release
+        """
         data_dir = self.data_dir + "/" + self.last_fetched
         self.parser.load_meta_csv((data_dir + "/metadata.csv"))
         json_files = [file for sub_dir in os.walk(data_dir) \
                 for file in glob.glob(sub_dir[0] + "/*.json")]
 
-        seen_doi = set()
-        documents = []
-
+        # CORD-19 names each file after its paper_id, e.g. <sha>.json or <pmcid>.xml.json
+        seen_ids = set()
+        changed_files = []
+        changed_ids = []
         for file in json_files:
-            doc = self.parser(file)
-            if "doi" in doc.metadata and doc.metadata["doi"] in seen_doi:
-                continue
+            paper_id = os.path.basename(file).split(".")[0]
+            seen_ids.add(paper_id)
+            csv_data = self.parser.meta_index.lookup(paper_id)
+            content_hash = self._hash_file(file, csv_data)
+            if self.manifest.is_changed(paper_id, content_hash):
+                changed_files.append(file)
+                changed_ids.append((paper_id, content_hash))
             else:
+                self.manifest.mark_seen(paper_id, self.last_fetched)
+
+        withdrawn = self.manifest.withdrawn(seen_ids)
+        print("Papers: {} total, {} new or changed, {} withdrawn".format(
+            len(seen_ids), len(changed_files), len(withdrawn)))
+        DOCS_SKIPPED.inc(len(seen_ids) - len(changed_files))
+        DOCS_WITHDRAWN.inc(len(withdrawn))
+
+        # Papers already indexed keep their doi so duplicates of them are skipped.
+        # A changed paper must not be a duplicate of its own earlier version.
+        seen_doi = self.manifest.indexed_dois(
+            seen_ids - set(paper_id for paper_id, _ in changed_ids))
+        documents = []
+
+        start = time.time()
+        parsed = self.parser.parse_many(changed_files)
+        elapsed = time.time() - start
+        DOCS_PARSED.inc(len(parsed))
+        PARSE_SECONDS.inc(elapsed)
+        print("Parsed {} papers in {:.1f}s ({:.1f} docs/sec)".format(
+            len(parsed), elapsed, len(parsed) / elapsed if elapsed > 0 else 0.0))
+        for (paper_id, content_hash), doc in zip(changed_ids, parsed):
+            doi = doc.metadata.get("doi")
+            indexed = doi is None or doi not in seen_doi
+            if not indexed and self.manifest.is_indexed(paper_id):
+                # Now a duplicate of another paper, so its earlier version is removed
+                withdrawn.append(paper_id)
+            self.manifest.update(paper_id, content_hash, self.last_fetched,
+                doi, indexed)
+            if indexed:
                 documents.append(doc)
-                if "doi" in doc.metadata:
-                    seen_doi.add(doc.metadata["doi"]) 
+                if doi is not None:
+                    seen_doi.add(doi)
 
-        return documents
+        return documents, withdrawn
 
     def _download_data(self):
         # Download data from kaggle
         dest_dir = self.data_dir + "/" + self.last_fetched
+        # kaggle authenticates on import, so only import it when downloading
+        import kaggle
         kaggle.api.authenticate()
         kaggle.api.dataset_download_files(
             COVIDChallengeCrawler.DATASET_NAME,
@@ -104,13 +205,148 @@ class COVIDChallengeCrawler():
             unzip=True
         )
 
+class CrawlManifest():
+    """
+    Persistent record of the papers that have been crawled.
+
+    Maps paper_id to {"hash": <content hash>, "release": <date last seen>,
+    "doi": <doi or None>, "indexed": <whether the paper was sent to ES>}.
+    Changes are staged in memory and written atomically by commit.
+    """
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            with open(path, "r") as fp:
+                self.entries = json.load(fp)
+        else:
+            self.entries = {}
+
+    def is_changed(self, paper_id, content_hash):
+        entry = self.entries.get(paper_id)
+        return entry is None or entry["hash"] != content_hash
+
+    def is_indexed(self, paper_id):
+        entry = self.entries.get(paper_id)
+        return entry is not None and entry["indexed"]
+
+    def mark_seen(self, paper_id, release):
+        self.entries[paper_id]["release"] = release
+
+    def update(self, paper_id, content_hash, release, doi=None, indexed=True):
+        self.entries[paper_id] = {
+            "hash": content_hash,
+            "release": release,
+            "doi": doi,
+            "indexed": indexed
+        }
+
+    def discard(self, paper_id):
+        """ Forget a paper so that it is treated as new on the next crawl """
+        self.entries.pop(paper_id, None)
+
+    def remove(self, paper_id):
+        self.entries.pop(paper_id, None)
+
+    def withdrawn(self, seen_ids):
+        """ Return ids of indexed papers that are not in seen_ids """
+        return [paper_id for paper_id, entry in self.entries.items()
+            if paper_id not in seen_ids and entry["indexed"]]
+
+    def indexed_dois(self, seen_ids):
+        """ Return dois of indexed papers in seen_ids """
+        return set(entry["doi"] for paper_id, entry in self.entries.items()
+            if paper_id in seen_ids and entry["indexed"] and entry["doi"])
+
+    def commit(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(self.entries, fp)
+        os.replace(tmp_path, self.path)
+
+class MetaCSVIndex():
+    """
+    Compact lookup index over metadata.csv.
+
+    The csv is read once and only the columns needed to enrich documents are
+    kept. Every sha (including each sha of multi-sha "a; b" cells), pmcid and
+    doi is mapped to a row number so lookups are a single dict access.
+
+    Attributes:
+        records (pd.DataFrame) : doi, url and publish_time columns, one row per csv row
+        rows (dict[str, int]) : maps sha/pmcid/doi to a row of records
+    """
+    KEYS = ["sha", "pmcid", "doi"]
+    FIELDS = ["doi", "url", "publish_time"]
+
+    def __init__(self, meta_csv):
+        columns = set(MetaCSVIndex.KEYS + MetaCSVIndex.FIELDS)
+        frame = pd.read_csv(
+            meta_csv,
+            usecols=lambda column: column in columns,
+            dtype=str
+        )
+        frame = frame.reset_index(drop=True)
+        for column in columns:
+            if column not in frame:
+                frame[column] = None
+
+        self.records = frame[MetaCSVIndex.FIELDS].astype(object)
+        self.records = self.records.where(self.records.notna(), None)
+
+        # Multi-sha cells look like "sha1; sha2", so explode them into one key per row
+        keys = [frame["sha"].str.split(";").explode().str.strip()]
+        keys.append(frame["pmcid"].str.strip())
+        keys.append(frame["doi"].str.strip())
+        keys = pd.concat(keys).dropna()
+        keys = keys[keys != ""]
+        # First occurrence wins, matching the old row-scan behaviour
+        keys = keys[~keys.duplicated(keep="first")]
+        self.rows = dict(zip(keys.values, keys.index.values))
+
+    def __len__(self):
+        return len(self.records)
+
+    def lookup(self, key):
+        """
+        Args:
+            key (str) : sha, pmcid or doi of a paper
+        Returns:
+            dict with doi, url and publish_time (None when missing), or None if key is unknown
+        """
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        return dict(zip(MetaCSVIndex.FIELDS, self.records.iloc[row].values))
+
+    def join(self, keys):
+        """
+        Vectorized lookup of many keys at once.
+        Args:
+            keys (list[str]) : sha, pmcid or doi of each paper
+        Returns:
+            pd.DataFrame indexed like keys with doi, url and publish_time columns.
+            Rows of unknown keys are all None.
+        """
+        rows = pd.Series(keys, dtype=object).map(self.rows)
+        found = rows.notna()
+        # Filled with None explicitly, DataFrame(None, ...) would fill with NaN
+        joined = pd.DataFrame(
+            [[None] * len(MetaCSVIndex.FIELDS)] * len(rows),
+            index=rows.index,
+            columns=MetaCSVIndex.FIELDS,
+            dtype=object
+        )
+        if found.any():
+            joined.loc[found] = self.records.iloc[rows[found].astype(int)].values
+        return joined
+
 class COVIDChallengeDocParser():
 
     def __init__(self):
-        self.meta_csv = None
+        self.meta_index = None
 
     def load_meta_csv(self, meta_csv):
-        self.meta_csv = pd.read_csv(meta_csv)
+        self.meta_index = MetaCSVIndex(meta_csv)
 
     def _parse_authors(self, authors):
         names = []
@@ -129,17 +365,43 @@ class COVIDChallengeDocParser():
 
     def _format_doi(self, doi):
         # Find the pattern "doi.org/" and remove it if it exists.
-        if type(doi) == float:
-            print(doi)
-        loc = doi.find("doi.org/")
+        tofind = "doi.org/"
+        loc = doi.find(tofind)
         if loc >= 0:
-            return doi[idx+len(tofind):]
+            return doi[loc+len(tofind):]
         else:
             return doi
 
-    def __call__(self, file_name):
+    def _add_metadata(self, metadata, csv_data):
+        """ Copy doi/url/publish_time looked up from metadata.csv into metadata """
+        if csv_data["doi"] is not None:
+            metadata["doi"] = self._format_doi(csv_data["doi"])
+        if csv_data["url"] is not None:
+            metadata["url"] = csv_data["url"]
+        if csv_data["publish_time"] is not None:
+            metadata["publish_time"] = csv_data["publish_time"]
+
+    def enrich_many(self, documents):
         """
-            Take in name of json file to parse and return Document object
+            Look up metadata.csv for a whole batch of documents in one join
+        """
+        joined = self.meta_index.join([doc.id for doc in documents])
+        for doc, csv_data in zip(documents, joined.to_dict("records")):
+            self._add_metadata(doc.metadata, csv_data)
+        return documents
+
+    def parse_many(self, file_names):
+        """
+            Parse a batch of json files and enrich them with a single metadata join
+        """
+        documents = [self(file_name, lookup=False) for file_name in file_names]
+        return self.enrich_many(documents)
+
+    def __call__(self, file_name, lookup=True):
+        """
+            Take in name of json file to parse and return Document object.
+            Set lookup to False to skip metadata.csv, e.g. when enrich_many
+            is used afterwards.
         """
         with open(file_name, "r") as fp:
             data = json.load(fp)
@@ -151,22 +413,16 @@ class COVIDChallengeDocParser():
             metadata = {"authors": authors}
 
             # Look up metadata from metadata.csv
-            csv_data = self.meta_csv[self.meta_csv["sha"] == paper_id]
-            if not csv_data.empty: 
-                doi = csv_data["doi"].iloc[0]
-                if not type(doi) is float:
-                    doi = self._format_doi(doi)
-                    metadata["doi"] = doi
-                
-                url = csv_data["url"].iloc[0]
-                if not type(url) is float:
-                    metadata["url"] = url    
+            if lookup:
+                csv_data = self.meta_index.lookup(paper_id)
+                if csv_data is not None:
+                    self._add_metadata(metadata, csv_data)
 
             text = {}
             if "abstract" in data:
                 abstract = self._parse_text(data["abstract"])
                 text["abstract"] = abstract
-            if "body_test" in data:
+            if "body_text" in data:
                 body_text = self._parse_text(data["body_text"])
                 text["body"] = body_text
             if "ref_entries" in data:
@@ -182,11 +438,40 @@ class COVIDChallengeDocParser():
 
         return doc
 
+def index_passages(batch_size=500):
+    """
+    Rebuild the passage index from every document in Elastic Search, e.g.
+    to fill it for the first time. The annotator refreshes the passages of
+    the documents it annotates by itself.
+    """
+    eshandler = ESHandler()
+    documents = eshandler.iter_docs(fields=["title", "metadata", "content"])
+    total = 0
+    start = time.time()
+    while True:
+        batch = list(itertools.islice(documents, batch_size))
+        if not batch:
+            break
+        stats = eshandler.insert_passages(batch)
+        for error in stats["errors"]:
+            print("Failed to insert passage:", error)
+        total += len(batch)
+        print("Split {} documents into passages ({:.1f} docs/sec)".format(
+            total, total / (time.time() - start)))
+    print("Finished!")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Start crawler")
     parser.add_argument("--target", type=str)
+    parser.add_argument("--metrics-port", type=int, default=None,
+        help="serve Prometheus metrics on this port")
     args = parser.parse_args()
 
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+
     if args.target.lower() == "kaggle":
         crawler = COVIDChallengeCrawler()
         crawler.run()
+    elif args.target.lower() == "passages":
+        index_passages()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the metamap executable in interactive mode with
+-N --sldiID --indicate_citation_end.
+
+Reads "id|text" lines from stdin and prints one fielded MMI line per known
+word, then 'EOT'. for the end of the citation. Its behaviour is set through
+environment variables:
+    METAMAP_STUB_LOG : file to which a line is appended on every start
+    METAMAP_STUB_DELAY : seconds to sleep before answering a text
+    METAMAP_STUB_CRASH : word that makes the stub exit without answering
+    METAMAP_STUB_HANG : word that makes the stub stop answering
+"""
+import os
+import sys
+import time
+
+CONCEPTS = {
+    "fever": ("Fever", "C0015967", "[sosy]"),
+    "cough": ("Coughing", "C0010200", "[sosy]"),
+    "covid": ("COVID-19", "C5203670", "[dsyn]")
+}
+
+def main():
+    if os.environ.get("METAMAP_STUB_LOG"):
+        with open(os.environ["METAMAP_STUB_LOG"], "a") as fp:
+            fp.write("{}\n".format(os.getpid()))
+    delay = float(os.environ.get("METAMAP_STUB_DELAY", "0"))
+    crash = os.environ.get("METAMAP_STUB_CRASH")
+    hang = os.environ.get("METAMAP_STUB_HANG")
+    for line in sys.stdin:
+        if "|" not in line:
+            continue
+        text_id, text = line.rstrip("\n").split("|", 1)
+        words = text.lower().split()
+        if crash and crash in words:
+            sys.exit(1)
+        if hang and hang in words:
+            time.sleep(3600)
+        time.sleep(delay)
+        for position, word in enumerate(words):
+            if word in CONCEPTS:
+                name, cui, semtypes = CONCEPTS[word]
+                print("{}|MMI|10.00|{}|{}|{}|[\"{}\"-tx-1-\"{}\"-noun-0]|TX|{}/{}|".format(
+                    text_id, name, cui, semtypes, word, word, position, len(word)))
+        print("'EOT'.")
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import logging
+import unittest
+from unittest import mock
+
+from backend.settings import CONFIG
+from tests.test_index import _index
+
+class _Loader():
+    """ IndexLoader that is ready at once with a given index """
+    index = None
+    ready = True
+
+    def __init__(self, *args):
+        pass
+
+    def start(self):
+        return self
+
+    def get(self, timeout=None):
+        return _Loader.index
+
+    def status(self):
+        return {"ready": True}
+
+class ApplicationTest(unittest.TestCase):
+
+    def setUp(self):
+        _Loader.index = _index([])
+        # application builds an app on import, which must not load a real index
+        with mock.patch("backend.loader.IndexLoader", _Loader):
+            import application
+        with mock.patch.object(application, "IndexLoader", _Loader):
+            self.app = application.create_app()
+        self.client = self.app.test_client()
+
+    def test_trace_handler_is_added_once(self):
+        import application
+        trace_logger = logging.getLogger("covidqa.trace")
+        handlers = list(trace_logger.handlers)
+        self.addCleanup(setattr, trace_logger, "handlers", handlers)
+        trace_logger.handlers = []
+        with mock.patch.dict(CONFIG, TRACE_LOGGING=True), \
+                mock.patch.object(application, "IndexLoader", _Loader):
+            application.create_app()
+            application.create_app()
+        self.assertEqual(len(trace_logger.handlers), 1)
+
+    def test_query_renders_results(self):
+        resp = self.client.get("/query?query=fever&size=10")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"Fever 0", resp.data)
+
+    def test_query_errors_go_through_app_handlers(self):
+        handled = []
+        self.app.register_error_handler(RuntimeError,
+            lambda err: handled.append(err) or ("handled", 500))
+        with mock.patch.object(_Loader.index, "aquery", side_effect=RuntimeError("boom")):
+            resp = self.client.get("/query?query=fever")
+        self.assertEqual((resp.status_code, resp.data), (500, b"handled"))
+        self.assertEqual(len(handled), 1)
+
+    def test_page_is_capped(self):
+        pages = []
+        aquery = _Loader.index.aquery
+        async def spy(query, page=1, size=100):
+            pages.append((page, size))
+            return await aquery(query, page, size)
+        with mock.patch.object(_Loader.index, "aquery", spy):
+            self.client.get("/query?query=fever&page=999999&size=10")
+        self.assertEqual(pages, [(CONFIG["MAX_RESULT_WINDOW"] // 10, 10)])
+
+    def test_batch_rejects_malformed_paging(self):
+        resp = self.client.post("/query_batch", json={"queries": ["fever"], "page": "x"})
+        self.assertEqual(resp.status_code, 400)
+
+if __name__ == "__main__":
+    unittest.main()
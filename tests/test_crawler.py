@@ -0,0 +1,114 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from benchmarks.fakes import FakeElasticsearch
+from backend.utils import ESHandler
+from backend.passages import to_passages
+from crawler import MetaCSVIndex, COVIDChallengeDocParser, COVIDChallengeCrawler, CrawlManifest
+
+METADATA_CSV = """sha,pmcid,doi,url,publish_time
+abc,PMC1,https://doi.org/10.1/abc,http://example.com/abc,2020-01-01
+def; ghi,,,,2020-02-02
+"""
+
+def _paper(paper_id, title=None):
+    return {
+        "paper_id": paper_id,
+        "metadata": {
+            "title": title or "Title of " + paper_id,
+            "authors": [{"first": "Jane", "middle": [], "last": "Doe"}]
+        },
+        "abstract": [{"text": "Abstract of " + paper_id}],
+        "body_text": [{"text": "First body paragraph of " + paper_id, "section": "Intro"},
+            {"text": "Second body paragraph of " + paper_id, "section": "Results"}]
+    }
+
+class MetaCSVIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.meta_csv = self.dir + "/metadata.csv"
+        with open(self.meta_csv, "w") as fp:
+            fp.write(METADATA_CSV)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_join_fills_unknown_keys_with_none(self):
+        index = MetaCSVIndex(self.meta_csv)
+        records = index.join(["abc", "zzz"]).to_dict("records")
+        self.assertEqual(records[0]["url"], "http://example.com/abc")
+        self.assertEqual(records[1], {"doi": None, "url": None, "publish_time": None})
+
+    def test_join_missing_fields_are_none(self):
+        index = MetaCSVIndex(self.meta_csv)
+        records = index.join(["ghi"]).to_dict("records")
+        self.assertEqual(records[0], {"doi": None, "url": None, "publish_time": "2020-02-02"})
+
+    def test_parse_many_with_unknown_sha(self):
+        files = []
+        for paper_id in ["abc", "zzz"]:
+            file_name = os.path.join(self.dir, paper_id + ".json")
+            with open(file_name, "w") as fp:
+                json.dump(_paper(paper_id), fp)
+            files.append(file_name)
+
+        parser = COVIDChallengeDocParser()
+        parser.load_meta_csv(self.meta_csv)
+        known, unknown = parser.parse_many(files)
+        self.assertEqual(known.metadata["doi"], "10.1/abc")
+        self.assertEqual(unknown.metadata, {"authors": ["Jane  Doe"]})
+
+    def test_body_paragraphs_become_passages(self):
+        file_name = os.path.join(self.dir, "abc.json")
+        with open(file_name, "w") as fp:
+            json.dump(_paper("abc"), fp)
+        doc = COVIDChallengeDocParser()(file_name, lookup=False)
+        self.assertIn("Second body paragraph of abc", doc.content["body"])
+        passages = [passage for _, passage in to_passages(doc, max_words=5, overlap=0)]
+        self.assertEqual([(passage["field"], passage["text"]) for passage in passages
+            if passage["field"] == "body"], [
+            ("body", "First body paragraph of abc"),
+            ("body", "Second body paragraph of abc")])
+
+class CrawlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.crawler = COVIDChallengeCrawler.__new__(COVIDChallengeCrawler)
+        self.crawler.data_dir = self.dir + "/kaggle"
+        self.crawler.parser = COVIDChallengeDocParser()
+        self.crawler.eshandler = ESHandler(client=FakeElasticsearch())
+        self.crawler.manifest = CrawlManifest(self.dir + "/manifest.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _release(self, release, papers):
+        """ Write a release with papers given as {paper_id: title} and crawl it """
+        release_dir = os.path.join(self.crawler.data_dir, release)
+        os.makedirs(release_dir)
+        with open(release_dir + "/metadata.csv", "w") as fp:
+            fp.write(METADATA_CSV)
+        for paper_id, title in papers.items():
+            with open(os.path.join(release_dir, paper_id + ".json"), "w") as fp:
+                json.dump(_paper(paper_id, title), fp)
+        self.crawler.last_fetched = release
+        documents, withdrawn = self.crawler._parse_data()
+        self.crawler._save_data(documents, withdrawn)
+        return documents
+
+    def test_changed_paper_with_doi_is_indexed_again(self):
+        self._release("2020-01-01", {"abc": "First title", "ghi": "Other"})
+        documents = self._release("2020-01-08", {"abc": "Second title", "ghi": "Other"})
+        self.assertEqual([doc.id for doc in documents], ["abc"])
+        doc = self.crawler.eshandler.get_many(["abc"])[0]
+        self.assertEqual(doc.title, "Second title")
+        entry = self.crawler.manifest.entries["abc"]
+        self.assertEqual((entry["doi"], entry["indexed"]), ("10.1/abc", True))
+
+if __name__ == "__main__":
+    unittest.main()
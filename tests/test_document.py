@@ -0,0 +1,34 @@
+import pickle
+import unittest
+
+from backend.document import Document
+
+def _document():
+    concept = ["0", "MMI", "10.00", "Fever", "C0015967", "[sosy]", "fever", "TX", "0/5", ""]
+    return Document("doc0", "Fever", {"authors": ["Jane Doe"]},
+        {"abstract": "fever and cough", "concepts": ["C0015967"]}, {"metamap": [concept]})
+
+class CodecTest(unittest.TestCase):
+
+    def _assert_same(self, doc, copy):
+        self.assertEqual(copy.to_dict(), Document.from_dict(doc.to_dict()).to_dict())
+        self.assertEqual(copy.text, doc.text)
+
+    def test_bytes_round_trip(self):
+        doc = _document()
+        self._assert_same(doc, Document.from_bytes(doc.to_bytes()))
+
+    def test_pickle_uses_bytes_codec(self):
+        doc = _document()
+        self.assertEqual(doc.__reduce__(), (Document.from_bytes, (doc.to_bytes(),)))
+        for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+            self._assert_same(doc, pickle.loads(pickle.dumps(doc, protocol)))
+
+    def test_pickle_decoded_annotations(self):
+        doc = _document()
+        self.assertEqual(doc.annotations["metamap"][0].cui, "C0015967")
+        copy = pickle.loads(pickle.dumps(doc))
+        self.assertEqual(copy.annotations["metamap"][0].cui, "C0015967")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import shutil
+import asyncio
+import tempfile
+import unittest
+
+from benchmarks.fakes import FakeElasticsearch, WhitespaceTokenizer
+from backend.breaker import CircuitBreaker
+from backend.cache import QueryCache
+from backend.document import Document
+from backend.index import ElasticSearchIndex, GensimIndex
+from backend.settings import CONFIG
+from backend.utils import ESHandler, AsyncESHandler, EventLoopThread
+
+class _AsyncClient():
+    """ Async facade over FakeElasticsearch for AsyncESHandler """
+    def __init__(self, client):
+        self._client = client
+
+    async def search(self, **kwargs):
+        kwargs.pop("request_timeout", None)
+        return self._client.search(**kwargs)
+
+class _Metamap():
+    """ Answers extract_async with concepts, or None as when MetaMap is late """
+    def __init__(self, concepts):
+        self.concepts = concepts
+
+    async def extract_async(self, text, timeout=None):
+        return self.concepts
+
+    def extract_many(self, texts, timeout=None):
+        self.timeout = timeout
+        return [self.concepts] * len(texts)
+
+def _index(concepts):
+    client = FakeElasticsearch()
+    es_handler = ESHandler(client=client)
+    es_handler.insert_many([Document("doc{}".format(i), "Fever {}".format(i),
+        {"authors": []}, {"abstract": "fever and cough"}) for i in range(3)])
+
+    index = ElasticSearchIndex.__new__(ElasticSearchIndex)
+    index.es_handler = es_handler
+    index.async_handler = AsyncESHandler()
+    index.async_handler.breaker = CircuitBreaker("test")
+    index.async_handler._client = _AsyncClient(client)
+    index.loop = EventLoopThread()
+    index.metamap = _Metamap(concepts)
+    index.passages = False
+    index.search_index = es_handler.index
+    index.cache = QueryCache(ttl=3600)
+    return index
+
+class QueryCacheTest(unittest.TestCase):
+
+    def test_put_with_ttl_overrides_default(self):
+        cache = QueryCache(ttl=3600)
+        cache.put("short", 1, ttl=0)
+        cache.put("long", 2)
+        self.assertIsNone(cache.get("short"))
+        self.assertEqual(cache.get("long"), 2)
+
+class ElasticSearchIndexCacheTest(unittest.TestCase):
+
+    def test_plain_text_fallback_uses_degraded_ttl(self):
+        full = _index(["C0015967"])
+        degraded = _index(None)
+        full.query("fever", size=10)
+        degraded.query("fever", size=10)
+        _, full_expires, _ = next(iter(full.cache._entries.values()))
+        _, degraded_expires, _ = next(iter(degraded.cache._entries.values()))
+        self.assertAlmostEqual(full_expires - degraded_expires,
+            3600 - CONFIG["QUERY_CACHE_DEGRADED_TTL"], delta=5)
+
+    def test_batch_plain_text_fallback_is_not_cached(self):
+        index = _index(None)
+        batch = index.query_many(["fever", "cough"], size=10)
+        self.assertEqual([len(results) for results in batch], [3, 3])
+        self.assertEqual(len(index.cache._entries), 0)
+
+    def test_batch_deadline_grows_with_batch_size(self):
+        index = _index([])
+        index.query_many(["fever"], size=10)
+        single = index.metamap.timeout
+        index.query_many(["query {}".format(i) for i in range(100)], size=10)
+        self.assertGreater(index.metamap.timeout, single)
+        self.assertEqual(len(index.cache._entries), 101)
+
+    def test_aquery_from_another_loop(self):
+        index = _index([])
+        results = asyncio.run(index.aquery("fever", size=10))
+        self.assertEqual(sorted(doc.id for doc, _ in results), ["doc0", "doc1", "doc2"])
+
+class GensimIndexUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = (GensimIndex.SAVE_PATH, GensimIndex.TOKEN_CACHE_PATH)
+        GensimIndex.SAVE_PATH = self.dir + "/gensim"
+        GensimIndex.TOKEN_CACHE_PATH = self.dir + "/tokens/tokens.sqlite"
+        self.es_handler = ESHandler(client=FakeElasticsearch())
+        self.es_handler.insert_many([self._document(i) for i in range(4)])
+        self.index = GensimIndex(WhitespaceTokenizer())
+        self.index._es_handler = self.es_handler
+        self.index.init("tfidf")
+
+    def tearDown(self):
+        GensimIndex.SAVE_PATH, GensimIndex.TOKEN_CACHE_PATH = self.paths
+        shutil.rmtree(self.dir)
+
+    def _document(self, i):
+        return Document("doc{}".format(i), "Fever", {"authors": []},
+            {"abstract": "fever and cough " * (i + 1)})
+
+    def _ids(self, index):
+        return sorted(doc.id for doc, _ in index.query("fever cough", size=4))
+
+    def test_removed_documents_are_left_out(self):
+        self.es_handler.delete_many(["doc1", "doc2"])
+        self.index.update()
+        self.assertEqual(self._ids(self.index), ["doc0", "doc3"])
+        self.assertEqual([sorted(doc.id for doc, _ in results) for results
+            in self.index.query_many(["fever", "cough"], size=2)], [["doc0", "doc3"]] * 2)
+        self.assertEqual(self._ids(GensimIndex.load_latest()), ["doc0", "doc3"])
+
+    def test_removed_document_can_come_back(self):
+        self.es_handler.delete_many(["doc1"])
+        self.index.update()
+        self.es_handler.insert_many([self._document(1)])
+        self.index.update()
+        self.assertEqual(self._ids(self.index), ["doc0", "doc1", "doc2", "doc3"])
+        self.assertEqual(self.index.doc_ids.count("doc1"), 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from backend.ner import Metamap, MetamapCache, MetamapPool, MetamapProcess
+
+STUB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "metamap_stub.py")
+
+class MetamapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, "starts.log")
+        self.env = dict(os.environ)
+        # Workers are forked after this, so they and their MetaMap see it
+        os.environ["METAMAP_STUB_LOG"] = self.log
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.dir)
+
+    def _metamap(self, timeout=5.0):
+        metamap = Metamap.__new__(Metamap)
+        metamap.cache = MetamapCache(os.path.join(self.dir, "concepts.sqlite"))
+        metamap.pool = MetamapPool(STUB_PATH, workers=1, queue_size=4, timeout=timeout)
+        self.addCleanup(metamap.pool.shutdown)
+        return metamap
+
+    def _starts(self):
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log) as fp:
+            return len(fp.readlines())
+
+    def test_process_answers_many_requests(self):
+        process = MetamapProcess(STUB_PATH)
+        self.addCleanup(process.close)
+        concepts, _ = process.extract_concepts(["fever and cough", "nothing"], ids=["0", "1"])
+        self.assertEqual([(c.index, c.cui) for c in concepts],
+            [("0", "C0015967"), ("0", "C0010200")])
+        concepts, _ = process.extract_concepts(["covid"])
+        self.assertEqual([c.cui for c in concepts], ["C5203670"])
+        self.assertEqual(self._starts(), 1)
+
+    def test_process_request_without_concepts(self):
+        process = MetamapProcess(STUB_PATH, read_timeout=5.0)
+        self.addCleanup(process.close)
+        self.assertEqual(process.extract_concepts(["nothing here", "none"]), ([], None))
+        concepts, _ = process.extract_concepts(["fever"])
+        self.assertEqual([c.cui for c in concepts], ["C0015967"])
+
+    def test_process_large_request(self):
+        # More input and output than fits in the pipes at once
+        process = MetamapProcess(STUB_PATH, read_timeout=5.0)
+        self.addCleanup(process.close)
+        texts = ["fever cough " * 500] * 200
+        concepts, _ = process.extract_concepts(texts)
+        self.assertEqual(len(concepts), 200 * 1000)
+
+    def test_process_that_stops_answering_is_restarted(self):
+        os.environ["METAMAP_STUB_HANG"] = "hang"
+        process = MetamapProcess(STUB_PATH, read_timeout=0.5)
+        self.addCleanup(process.close)
+        with self.assertRaises(TimeoutError):
+            process.extract_concepts(["fever", "hang"])
+        concepts, _ = process.extract_concepts(["cough"])
+        self.assertEqual([c.cui for c in concepts], ["C0010200"])
+        self.assertEqual(self._starts(), 2)
+
+    def test_metamap_is_started_once_per_worker(self):
+        metamap = self._metamap()
+        self.assertEqual(metamap("fever"), ["C0015967"])
+        self.assertEqual(metamap("cough"), ["C0010200"])
+        self.assertEqual(metamap.extract_many(["covid", "fever cough"]),
+            [["C5203670"], ["C0015967", "C0010200"]])
+        self.assertEqual(self._starts(), 1)
+
+    def test_timeout_falls_back_and_caches_late_answer(self):
+        os.environ["METAMAP_STUB_DELAY"] = "0.5"
+        metamap = self._metamap(timeout=0.1)
+        self.assertEqual(metamap("fever"), [])
+        deadline = time.monotonic() + 10
+        while metamap.cache.get("fever") is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(metamap.cache.get("fever"), ["C0015967"])
+
+    def test_metamap_crash_falls_back_and_restarts(self):
+        os.environ["METAMAP_STUB_CRASH"] = "crash"
+        metamap = self._metamap()
+        self.assertEqual(metamap("crash"), [])
+        self.assertEqual(metamap("fever"), ["C0015967"])
+        self.assertEqual(self._starts(), 2)
+
+    def test_dead_worker_is_replaced(self):
+        metamap = self._metamap()
+        self.assertEqual(metamap("fever"), ["C0015967"])
+        # Kill the worker process, which breaks the pool
+        future = metamap.pool._get_executor().submit(os._exit, 1)
+        self.assertIsNotNone(future.exception(timeout=5.0))
+        self.assertEqual(metamap("cough"), ["C0010200"])
+        # Every slot was released
+        for _ in range(4):
+            self.assertTrue(metamap.pool._slots.acquire(blocking=False))
+
+    def test_cache_hit_does_not_use_metamap(self):
+        metamap = self._metamap()
+        self.assertEqual(metamap("Fever "), ["C0015967"])
+        metamap.pool.shutdown()
+        metamap.pool.mm_path = os.path.join(self.dir, "missing")
+        self.assertEqual(metamap("fever"), ["C0015967"])
+        self.assertEqual(metamap("cough"), [])
+        self.assertEqual(self._starts(), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from backend.tokencache import TokenCache
+
+class TokenCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "tokens.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _cache(self):
+        cache = TokenCache(self.path)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_caches_sharing_a_database(self):
+        first = self._cache()
+        second = self._cache()
+        first.put_many([("a", "h1", ["fever", "cough"])])
+        second.put_many([("b", "h2", ["covid", "fever"])])
+        first.put_many([("c", "h3", ["covid", "lung"])])
+        self.assertEqual(first.get_many([("a", "h1"), ("b", "h2"), ("c", "h3")]),
+            [["fever", "cough"], ["covid", "fever"], ["covid", "lung"]])
+        self.assertEqual(second.get_many([("c", "h3"), ("a", "h1")]),
+            [["covid", "lung"], ["fever", "cough"]])
+        self.assertEqual(self._cache().id2token, ["fever", "cough", "covid", "lung"])
+
+    def test_failed_commit_leaves_vocabulary_unchanged(self):
+        cache = self._cache()
+        cache.put_many([("a", "h1", ["fever"])])
+        with self.assertRaises(sqlite3.Error):
+            # A list is not a valid hash, so the insert of the documents fails
+            cache.put_many([("b", ["h2"], ["cough"])])
+        self.assertEqual(cache.id2token, ["fever"])
+        self.assertEqual(self._cache().id2token, ["fever"])
+        cache.put_many([("b", "h2", ["cough"])])
+        self.assertEqual(cache.get_many([("b", "h2")]), [["cough"]])
+
+if __name__ == "__main__":
+    unittest.main()
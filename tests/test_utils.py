@@ -0,0 +1,100 @@
+import unittest
+
+from benchmarks.fakes import FakeElasticsearch
+from backend.breaker import CircuitBreaker, CircuitOpenError
+from backend.document import Document
+from backend.utils import ESHandler, CONFIG
+
+def _documents(count):
+    return [Document("doc{}".format(i), "Title {}".format(i), {"authors": []},
+        {"abstract": "abstract {}".format(i)}) for i in range(count)]
+
+class BulkTest(unittest.TestCase):
+
+    def test_insert_many_creates_missing_index_with_refresh_disabled(self):
+        client = FakeElasticsearch()
+        handler = ESHandler(client=client)
+        stats = handler.insert_many(_documents(5), disable_refresh=True)
+        self.assertEqual(stats["total"], 5)
+        self.assertEqual(stats["errors"], [])
+        self.assertEqual(len(client.stores[handler.index]), 5)
+
+    def test_refresh_interval_is_restored(self):
+        client = FakeElasticsearch()
+        handler = ESHandler(client=client)
+        client.indices.create(index=handler.index)
+        client.indices.put_settings(index=handler.index,
+            body={"index": {"refresh_interval": "30s"}})
+        handler.insert_many(_documents(5), disable_refresh=True)
+        settings = client.indices.get_settings(index=handler.index)
+        self.assertEqual(settings[handler.index]["settings"]["index"]["refresh_interval"], "30s")
+
+    def test_update_many_merges_fields(self):
+        client = FakeElasticsearch()
+        handler = ESHandler(client=client)
+        handler.insert_many(_documents(2))
+        stats = handler.update_many([("doc1", {"content": {"concepts": ["C0015967"]}})])
+        self.assertEqual(stats["errors"], [])
+        doc = handler.get_many(["doc1"])[0]
+        self.assertEqual(doc.content["concepts"], ["C0015967"])
+        self.assertEqual(doc.content["abstract"], "abstract 1")
+
+class GetManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeElasticsearch()
+        self.handler = ESHandler(client=self.client)
+        self.handler.insert_many(_documents(5))
+        self.chunk_size = CONFIG["ES_MGET_CHUNK_SIZE"]
+        CONFIG["ES_MGET_CHUNK_SIZE"] = 2
+
+    def tearDown(self):
+        CONFIG["ES_MGET_CHUNK_SIZE"] = self.chunk_size
+
+    def test_ids_are_fetched_in_chunks(self):
+        calls = []
+        mget = self.client.mget
+        self.client.mget = lambda **kwargs: calls.append(kwargs) or mget(**kwargs)
+        ids = ["doc4", "missing", "doc0", "doc2", "doc1"]
+        docs = self.handler.get_many(ids)
+        self.assertEqual([doc.id if doc else None for doc in docs],
+            ["doc4", None, "doc0", "doc2", "doc1"])
+        self.assertEqual(len(calls), 3)
+
+    def test_maintenance_bypasses_breaker(self):
+        self.handler.breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=60)
+        self.handler.breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            self.handler.get_many(["doc0"])
+        docs = self.handler.get_many(["doc0", "doc1", "doc2"], maintenance=True)
+        self.assertEqual([doc.id for doc in docs], ["doc0", "doc1", "doc2"])
+
+class GenerationTest(unittest.TestCase):
+
+    def setUp(self):
+        # Handlers of the crawler and of a web node on another host
+        self.client = FakeElasticsearch()
+        self.writer = ESHandler(client=self.client)
+        self.reader = ESHandler(client=self.client)
+
+    def test_writes_change_generation_seen_by_other_handlers(self):
+        self.assertEqual(self.reader.generation(), "")
+        self.writer.insert_many(_documents(2))
+        inserted = self.reader.generation()
+        self.assertNotEqual(inserted, "")
+        self.writer.update_many([("doc1", {"content": {"concepts": []}})])
+        updated = self.reader.generation()
+        self.assertNotEqual(updated, inserted)
+        self.writer.save()
+        self.assertEqual(self.reader.generation(), self.writer.t)
+
+    def test_last_generation_is_kept_while_unavailable(self):
+        self.writer.insert_many(_documents(2))
+        generation = self.reader.generation()
+        self.reader.breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=60)
+        self.reader.breaker.record_failure()
+        self.writer.delete_many(["doc0"])
+        self.assertEqual(self.reader.generation(), generation)
+
+if __name__ == "__main__":
+    unittest.main()